@@ -2,6 +2,26 @@
 '''
 cache_utils: utilities for caching data in pickle files.
 
+The functions save_cached_value() and cached_value() store one whole value
+per cache name.  CacheStore is for larger caches: it maps keys to values,
+and spreads the entries over a number of "shard" files according to a hash
+of the key, so that reading or writing an entry only involves one shard.
+Each shard is replaced atomically (written to a temporary file, then renamed
+over the old one), and shards are locked while they are being updated, so
+that several worker processes can share a store.  Example of use:
+
+    store = CacheStore('/data/repos', 'readmes')
+    store.put(16335, text)
+    ...
+    text = store.get(16335)
+
+Values saved with save_cached_value(..., fingerprint='stat') or 'content'
+are checked against a fingerprint of the original directory when they are
+read back, and cached_value() treats them as missing if the directory has
+changed since.  set_cache_budget() limits the total size of the caches;
+when it is exceeded, the least recently used cache files are deleted.
+cache_stats() reports hits, misses, stale values, evictions and sizes.
+Finally, the decorator memoize() caches the results of a function on disk.
 '''
 __version__ = '1.0.0'
 __author__  = 'Michael Hucka <mhucka@caltech.edu>'
@@ -9,10 +29,24 @@ __email__   = 'mhucka@caltech.edu'
 __license__ = 'GPLv3'
 
 from   .logger import *
+import collections
+from   contextlib import contextmanager
+import functools
+import hashlib
+import json
 import os
 import pickle
+import tempfile
+import threading
+import time
+import types
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
-
 # Cache utilities.
 # .............................................................................
 
@@ -28,32 +62,695 @@ def cache_file(orig_dir, cache_name):
     return os.path.join(cache_dir(orig_dir), file)
 
 
-def save_cached_value(orig_dir, cache_name, data_structure):
+def save_cached_value(orig_dir, cache_name, data_structure, fingerprint=None):
+    '''Saves 'data_structure' as the cached value 'cache_name' for the
+    directory 'orig_dir'.  If 'fingerprint' is 'stat' or 'content', a
+    fingerprint of the directory is saved with it (see dir_fingerprint()),
+    and cached_value() will ignore the value once the directory changes.'''
     dest_dir  = cache_dir(orig_dir)
     dest_file = cache_file(orig_dir, cache_name)
+    meta_file = _meta_file(dest_file)
     try:
         os.makedirs(dest_dir, exist_ok=True)
-        with open(dest_file, 'wb') as pickle_file:
-            pickle.dump(data_structure, pickle_file)
+        if fingerprint:
+            meta = {'fingerprint' : dir_fingerprint(orig_dir, fingerprint == 'content'),
+                    'method'      : fingerprint}
+        atomic_pickle(dest_file, data_structure)
+        if fingerprint:
+            atomic_write(meta_file, json.dumps(meta).encode('utf-8'))
+        elif os.path.exists(meta_file):
+            os.unlink(meta_file)
     except IOError as err:
         log = Logger().get_log()
         log.error('encountered error trying to dump pickle {}'.format(dest_file))
         log.error(err)
-    except PickleError as err:
+    except pickle.PickleError as err:
         log = Logger().get_log()
         log.error('pickling error for {}'.format(dest_file))
         log.error(err)
+    else:
+        _register_cache_dir(dest_dir)
+        _note_written(_file_size(dest_file))
 
 
 def cached_value(orig_dir, cache_name):
+    '''Returns the value saved by save_cached_value(), or None if there is
+    none or it was saved with a fingerprint that no longer matches.'''
     cache = cache_file(orig_dir, cache_name)
     if not os.path.exists(cache):
+        _count('misses')
+        return None
+    if _is_stale(orig_dir, cache):
+        _count('stale')
         return None
     try:
         with open(cache, 'rb') as saved_elements:
-            return pickle.load(saved_elements)
+            value = pickle.load(saved_elements)
+            _touch(saved_elements.fileno())
     except Exception as err:
         log = Logger().get_log()
         log.error('cache exists but unpickle failed for {}'.format(cache))
         log.error(err)
+        _count('misses')
         return None
+    _count('hits')
+    return value
+
+
+def dir_fingerprint(path, content=False):
+    '''Returns a string that changes when any file under the directory
+    'path' is added, removed, or modified.  By default, it is computed from
+    the names, sizes and modification times of the files; if 'content' is
+    True, it is computed from their names and contents instead, which is
+    slower but ignores changes of modification times alone (as made by,
+    e.g., git checkouts).'''
+    digest = hashlib.blake2b(digest_size=16)
+    for (name, stat) in sorted(_walk_files(path, '')):
+        digest.update(name.encode('utf-8', 'surrogateescape') + b'\0')
+        if content:
+            with open(os.path.join(path, name), 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            digest.update(b'\0')
+        else:
+            digest.update('{} {}\0'.format(stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def atomic_pickle(path, value):
+    '''Pickles 'value' into the file 'path' in such a way that readers see
+    either the old file or the complete new one, never a partial file.'''
+    _atomic_replace(path, lambda f: pickle.dump(value, f, pickle.HIGHEST_PROTOCOL))
+
+
+def atomic_write(path, data):
+    '''Writes the bytes 'data' to the file 'path' like atomic_pickle().'''
+    _atomic_replace(path, lambda f: f.write(data))
+
+
+def _atomic_replace(path, write):
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                      prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    '''Context manager holding an advisory lock on the file 'path' (which is
+    created if necessary).  Locks are exclusive unless 'shared' is True.  On
+    systems without fcntl, this does nothing.'''
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a+b') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# Sharded cache store.
+# .............................................................................
+
+_DEFAULT_SHARDS = 64
+
+class CacheStore():
+    def __init__(self, orig_dir, cache_name, shards=_DEFAULT_SHARDS):
+        '''Opens (creating it if needed) the store 'cache_name' in the cache
+        directory for 'orig_dir' (see cache_dir()).  The number of 'shards' is
+        fixed when the store is created; later values are ignored.  Keys can
+        be any values whose repr() identifies them, such as numbers, strings
+        and tuples of those; values can be anything that can be pickled.'''
+        self.path = os.path.join(cache_dir(orig_dir), cache_name + '.store')
+        os.makedirs(self.path, exist_ok=True)
+        self.shards = self._shard_count(shards)
+        self._loaded = {}          # shard number -> (file identity, dict)
+        _register_cache_dir(cache_dir(orig_dir))
+
+
+    def __contains__(self, key):
+        return key in self._read(self._shard(key))
+
+
+    def __len__(self):
+        return sum(len(self._read(shard)) for shard in range(self.shards))
+
+
+    def get(self, key, default=None):
+        '''Returns the value stored under 'key', or 'default'.'''
+        return self._read(self._shard(key)).get(key, default)
+
+
+    def get_many(self, keys):
+        '''Returns a dictionary of the values of those 'keys' that are in the
+        store, reading each shard involved once.'''
+        found = {}
+        for (shard, shard_keys) in self._by_shard(keys).items():
+            entries = self._read(shard)
+            found.update((key, entries[key]) for key in shard_keys
+                         if key in entries)
+        return found
+
+
+    def put(self, key, value):
+        '''Stores 'value' under 'key'.'''
+        self.put_many({key: value})
+
+
+    def put_many(self, items):
+        '''Stores the (key, value) pairs of the dictionary 'items', rewriting
+        each shard involved once.'''
+        written = 0
+        for (shard, shard_keys) in self._by_shard(items).items():
+            with self._update(shard) as entries:
+                for key in shard_keys:
+                    entries[key] = items[key]
+            written += _file_size(self._shard_file(shard))
+        _note_written(written)
+
+
+    def delete(self, key):
+        '''Removes 'key' from the store, if it is there.'''
+        with self._update(self._shard(key)) as entries:
+            entries.pop(key, None)
+
+
+    def keys(self):
+        '''Generator over the keys in the store.'''
+        for shard in range(self.shards):
+            yield from list(self._read(shard))
+
+
+    def items(self):
+        '''Generator over the (key, value) pairs in the store.'''
+        for shard in range(self.shards):
+            yield from list(self._read(shard).items())
+
+
+    def clear(self):
+        '''Removes everything from the store.'''
+        for shard in range(self.shards):
+            with self._update(shard) as entries:
+                entries.clear()
+
+
+    def _shard(self, key):
+        digest = hashlib.md5(repr(key).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'little') % self.shards
+
+
+    def _by_shard(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._shard(key), []).append(key)
+        return groups
+
+
+    def _shard_file(self, shard):
+        return os.path.join(self.path, 'shard-{:04}.pickle'.format(shard))
+
+
+    def _lock_file(self, shard):
+        return os.path.join(self.path, 'shard-{:04}.lock'.format(shard))
+
+
+    def _read(self, shard):
+        # Shards are cached in memory, and reloaded when the file has been
+        # replaced (by this or another process) since it was last read.
+        path = self._shard_file(shard)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._loaded.pop(shard, None)
+            return {}
+        loaded = self._loaded.get(shard)
+        if loaded and loaded[0] == _identity(stat):
+            return loaded[1]
+        try:
+            with open(path, 'rb') as f:
+                entries = pickle.load(f)
+                # Record the time of use for evict_caches().
+                _touch(f.fileno())
+                identity = _identity(os.fstat(f.fileno()))
+        except FileNotFoundError:
+            # Removed by evict_caches() since the os.stat() above.
+            self._loaded.pop(shard, None)
+            return {}
+        except Exception as err:
+            log = Logger().get_log()
+            log.error('unpickle failed for cache shard {}'.format(path))
+            log.error(err)
+            entries = {}
+            identity = None
+        self._loaded[shard] = (identity, entries)
+        return entries
+
+
+    @contextmanager
+    def _update(self, shard):
+        # Read-modify-write of a shard, holding its lock throughout.
+        with file_lock(self._lock_file(shard)):
+            entries = dict(self._read(shard))
+            yield entries
+            atomic_pickle(self._shard_file(shard), entries)
+            self._loaded.pop(shard, None)
+
+
+    def _shard_count(self, shards):
+        path = os.path.join(self.path, 'shards')
+        with file_lock(path + '.lock'):
+            if os.path.exists(path):
+                with open(path) as f:
+                    return int(f.read())
+            with open(path, 'w') as f:
+                f.write(str(shards))
+            return shards
+
+
+# Memoization.
+# .............................................................................
+# memoize() is a decorator that saves the results of a function on disk,
+# in files named by a hash of the function's code and arguments, so that
+# they are reused by later calls from any process.  Changing the code of
+# the function (or the 'version' given to memoize()) changes the hash, so
+# results computed by older code are not used.  Recently used results are
+# also kept in memory.  Calls with the same arguments made at the same time
+# by different threads or processes are "single-flight": one of them calls
+# the function while the others wait for, then use, its result.  Example:
+#
+#    @memoize('/data/repos')
+#    def file_list(repo_id):
+#        ...
+
+_MEMO_SUFFIX = '.memo'
+
+_MEMO_LOCK_STRIPES = 256
+'''Number of lock files per memoized function.  Different arguments may map
+to the same lock, which only means they are not computed in parallel.'''
+
+_MISSING = object()
+
+
+def memoize(orig_dir, name=None, max_memory=128, serializer=pickle,
+            version=None, key=None):
+    '''Returns a decorator that memoizes a function in the cache directory of
+    'orig_dir' (see cache_dir()), under 'name' (by default, the qualified
+    name of the function).  Parameter 'max_memory' is the number of results
+    kept in memory, 'serializer' is a module or object with dumps() and
+    loads() functions (such as pickle or json), 'version' is any value to be
+    combined with the hash of the code of the function, and 'key' is an
+    optional function that takes the arguments of the function and returns
+    the value (a string or bytes) that identifies them; by default, the
+    arguments are pickled, after putting the elements of sets, frozensets
+    and dictionaries (at any depth in lists, tuples, sets and dictionaries)
+    in a fixed order, since their order can differ between processes.
+    Arguments that are other objects holding sets or dictionaries need a
+    'key' function.  The decorated function has cache_info() and
+    cache_clear() methods.'''
+    def decorator(func):
+        memo = _Memo(func, orig_dir, name, max_memory, serializer, version, key)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return memo.call(args, kwargs)
+        wrapper.cache_info  = memo.info
+        wrapper.cache_clear = memo.clear
+        return wrapper
+    return decorator
+
+
+class _Memo():
+    def __init__(self, func, orig_dir, name, max_memory, serializer, version,
+                 key):
+        self.func       = func
+        self.max_memory = max_memory
+        self.serializer = serializer
+        self.key        = key
+        self.code_hash  = _code_hash(func.__code__, version)
+        self.path       = os.path.join(cache_dir(orig_dir),
+                                       (name or _func_name(func)) + '.memoize')
+        self.memory     = collections.OrderedDict()
+        self.lock       = threading.Lock()
+        self.stripes    = [threading.Lock() for _ in range(_MEMO_LOCK_STRIPES)]
+        self.stats      = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0,
+                           'waits': 0}
+        os.makedirs(self.path, exist_ok=True)
+        _register_cache_dir(cache_dir(orig_dir))
+
+
+    def call(self, args, kwargs):
+        digest = self._digest(args, kwargs)
+        value = self._from_memory(digest)
+        if value is not _MISSING:
+            return value
+        value = self._from_disk(digest)
+        if value is not _MISSING:
+            self._count('disk_hits')
+            self._to_memory(digest, value)
+            return value
+        stripe = int(digest[:8], 16) % _MEMO_LOCK_STRIPES
+        lock_file = os.path.join(self.path, 'lock-{:03}'.format(stripe))
+        written = 0
+        with self.stripes[stripe], file_lock(lock_file):
+            # Another thread or process may have computed it while we waited.
+            value = self._from_disk(digest)
+            if value is not _MISSING:
+                self._count('waits')
+            else:
+                self._count('misses')
+                value = self.func(*args, **kwargs)
+                data = self.serializer.dumps(value)
+                if isinstance(data, str):
+                    data = data.encode('utf-8')
+                atomic_write(self._file(digest), data)
+                written = len(data)
+        self._to_memory(digest, value)
+        _note_written(written)
+        return value
+
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, memory_size=len(self.memory))
+
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        for file in os.listdir(self.path):
+            if file.endswith(_MEMO_SUFFIX):
+                try:
+                    os.unlink(os.path.join(self.path, file))
+                except FileNotFoundError:
+                    pass
+
+
+    def _digest(self, args, kwargs):
+        if self.key:
+            data = self.key(*args, **kwargs)
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+        else:
+            data = pickle.dumps(_canonical((args, kwargs)), protocol=4)
+        return hashlib.blake2b(self.code_hash + data, digest_size=20).hexdigest()
+
+
+    def _file(self, digest):
+        return os.path.join(self.path, digest + _MEMO_SUFFIX)
+
+
+    def _from_memory(self, digest):
+        with self.lock:
+            value = self.memory.get(digest, _MISSING)
+            if value is not _MISSING:
+                self.memory.move_to_end(digest)
+                self.stats['memory_hits'] += 1
+            return value
+
+
+    def _to_memory(self, digest, value):
+        if self.max_memory <= 0:
+            return
+        with self.lock:
+            self.memory[digest] = value
+            self.memory.move_to_end(digest)
+            while len(self.memory) > self.max_memory:
+                self.memory.popitem(last=False)
+
+
+    def _from_disk(self, digest):
+        try:
+            with open(self._file(digest), 'rb') as f:
+                data = f.read()
+                _touch(f.fileno())
+        except FileNotFoundError:
+            return _MISSING
+        try:
+            return self.serializer.loads(data)
+        except Exception as err:
+            log = Logger().get_log()
+            log.error('unable to load memoized value {}'.format(self._file(digest)))
+            log.error(err)
+            return _MISSING
+
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+
+def _code_hash(code, version=None):
+    # Hash of the bytecode and constants of a function, including those of
+    # functions defined inside it, but not of line numbers or file names.
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(version).encode('utf-8'))
+    def add(code):
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names).encode('utf-8'))
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                add(const)
+            else:
+                digest.update(repr(const).encode('utf-8'))
+    add(code)
+    return digest.digest()
+
+
+class _Unordered(tuple):
+    # Canonical form of a set, frozenset or dictionary in memo keys.  Being
+    # a class of its own, it cannot be mistaken for a tuple argument.
+    pass
+
+
+def _canonical(value):
+    # Returns 'value' with sets, frozensets and dictionaries replaced by
+    # _Unordered tuples of their (canonical) elements in a fixed order.
+    kind = type(value)
+    if kind in (list, tuple):
+        return kind(_canonical(item) for item in value)
+    elif kind in (set, frozenset):
+        items = [_canonical(item) for item in value]
+    elif kind is dict:
+        items = [(_canonical(k), _canonical(v)) for (k, v) in value.items()]
+    else:
+        return value
+    items.sort(key=lambda item: pickle.dumps(item, protocol=4))
+    return _Unordered((kind.__name__, tuple(items)))
+
+
+def _func_name(func):
+    return '{}.{}'.format(func.__module__, func.__qualname__).replace('<', '').replace('>', '')
+
+
+# Size budget and statistics.
+# .............................................................................
+# The budget applies to the cache files in all the cache directories used
+# (by any process) since set_cache_budget() was first called with the same
+# registry file: save_cached_value() and CacheStore record their cache
+# directories in the registry, and evict_caches() scans them.  Reading a cache
+# file updates its access time, which is what "least recently used" goes by.
+# Its modification time is left alone, since CacheStore uses it to tell
+# whether a shard it holds in memory has been replaced.  Statistics other
+# than sizes are counted per process.
+#
+# Scanning the cache directories costs time proportional to the number of
+# cache files, so writes do not each trigger evict_caches(): it runs once a
+# process has written _EVICT_FRACTION of the budget since the last run, or
+# _EVICT_INTERVAL seconds after it.  The budget can therefore be exceeded
+# by up to _EVICT_FRACTION per writing process between runs.
+
+_DEFAULT_REGISTRY = os.path.expanduser('~/.casics_caches')
+
+_budget = {'max_bytes': None, 'registry': _DEFAULT_REGISTRY}
+_stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0,
+          'evicted_bytes': 0}
+_stats_lock = threading.Lock()
+_registered = set()
+
+_EVICT_FRACTION = 0.05
+'''Fraction of the budget written by a process that triggers eviction.'''
+
+_EVICT_INTERVAL = 60
+'''Seconds after which a write triggers eviction regardless of its size.'''
+
+_evict_state = {'written': 0, 'last': None}
+_evict_lock = threading.Lock()
+
+
+def set_cache_budget(max_bytes, registry=_DEFAULT_REGISTRY):
+    '''Limits the total size of cache files to 'max_bytes' (None means no
+    limit).  Parameter 'registry' is the file listing the cache directories
+    the limit applies to.'''
+    _budget['max_bytes'] = max_bytes
+    _budget['registry'] = registry
+    _registered.clear()
+    with _evict_lock:
+        _evict_state.update(written=0, last=None)
+
+
+def evict_caches(max_bytes=None):
+    '''Deletes the least recently used cache files until their total size is
+    at most 'max_bytes' (default: the limit given to set_cache_budget()).
+    Returns the number of files deleted.'''
+    if max_bytes is None:
+        max_bytes = _budget['max_bytes']
+    if max_bytes is None:
+        return 0
+    files = _cache_files()
+    total = sum(size for (used, size, path) in files)
+    evicted = 0
+    for (used, size, path) in sorted(files):
+        if total <= max_bytes:
+            break
+        _remove_cache_file(path)
+        total -= size
+        evicted += 1
+        _count('evictions')
+        _count('evicted_bytes', size)
+    return evicted
+
+
+def cache_stats():
+    '''Returns a dictionary with the numbers of cache hits, misses, stale
+    values and evictions in this process, and the number and total size of
+    the cache files covered by the budget (see set_cache_budget()).'''
+    files = _cache_files()
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses'] + stats['stale']
+    stats['hit_rate']  = stats['hits']/lookups if lookups else 0.0
+    stats['files']     = len(files)
+    stats['bytes']     = sum(size for (used, size, path) in files)
+    stats['max_bytes'] = _budget['max_bytes']
+    return stats
+
+
+def _note_written(nbytes):
+    # Records that 'nbytes' of cache data were written, and runs
+    # evict_caches() if enough has been written or enough time has passed.
+    max_bytes = _budget['max_bytes']
+    if max_bytes is None:
+        return
+    now = time.monotonic()
+    with _evict_lock:
+        _evict_state['written'] += nbytes
+        last = _evict_state['last']
+        if (_evict_state['written'] < max_bytes*_EVICT_FRACTION
+                and last is not None and now - last < _EVICT_INTERVAL):
+            return
+        _evict_state.update(written=0, last=now)
+    evict_caches()
+
+
+def _remove_cache_file(path):
+    # Store shards are deleted while holding their lock (see CacheStore), so
+    # that eviction does not interleave with an update of the shard.
+    lock = os.path.splitext(path)[0] + '.lock'
+    try:
+        if os.path.exists(lock):
+            with file_lock(lock):
+                os.unlink(path)
+        else:
+            os.unlink(path)
+        if os.path.exists(_meta_file(path)):
+            os.unlink(_meta_file(path))
+    except FileNotFoundError:
+        pass
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _register_cache_dir(path):
+    path = os.path.abspath(path)
+    if _budget['max_bytes'] is None or path in _registered:
+        return
+    registry = _budget['registry']
+    with file_lock(registry + '.lock'):
+        if path not in _registry_dirs():
+            with open(registry, 'a') as f:
+                f.write(path + '\n')
+    _registered.add(path)
+
+
+def _registry_dirs():
+    try:
+        with open(_budget['registry']) as f:
+            return {line.rstrip('\n') for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def _cache_files():
+    # Returns (time of last use, size, path) for every cache file.
+    files = []
+    for directory in _registry_dirs():
+        for (name, stat) in _walk_files(directory, ''):
+            if name.endswith(('.pickle', _MEMO_SUFFIX)):
+                files.append((stat.st_atime, stat.st_size,
+                              os.path.join(directory, name)))
+    return files
+
+
+def _is_stale(orig_dir, cache):
+    try:
+        with open(_meta_file(cache)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        return True
+    current = dir_fingerprint(orig_dir, meta.get('method') == 'content')
+    return current != meta.get('fingerprint')
+
+
+def _meta_file(cache):
+    return os.path.splitext(cache)[0] + '.meta'
+
+
+def _walk_files(root, prefix):
+    # Yields (relative path, stat) for the files under 'root', recursively.
+    try:
+        entries = list(os.scandir(os.path.join(root, prefix) if prefix else root))
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    for entry in entries:
+        name = os.path.join(prefix, entry.name) if prefix else entry.name
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_files(root, name)
+            elif entry.is_file():
+                yield (name, entry.stat())
+        except FileNotFoundError:
+            continue
+
+
+def _touch(file):
+    # Sets the access time of open file descriptor 'file' to now, keeping
+    # its modification time.
+    try:
+        mtime_ns = os.fstat(file).st_mtime_ns
+        os.utime(file, ns=(time.time_ns(), mtime_ns))
+    except OSError:
+        pass
+
+
+def _identity(stat):
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
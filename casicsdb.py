@@ -15,13 +15,13 @@ Connecting to the database can be done using any MongoDB client API library.
 The database requires a user login and password.  Here is an example of
 connecting to the database server using the Python Pymongo library; in this
 code, the variables "user", "password", "host" and "port" are assumed to be
-set by some other means, and the connection parameters such as socketKeepAlive
+set by some other means, and the connection parameters such as tz_aware
 are not critical but recommended:
 
     db = MongoClient('mongodb://{}:{}@{}:{}/github?authSource=admin'
                      .format(user, password, host, port),
                      serverSelectionTimeoutMS=_CONN_TIMEOUT,
-                     tz_aware=True, connect=True, socketKeepAlive=True)
+                     tz_aware=True, connect=True)
     repos = db['github'].repos
 
 After this code is run, the value of variable `repos` is a MongoDB collection
@@ -81,8 +81,28 @@ __author__  = 'Michael Hucka <mhucka@caltech.edu>'
 __email__   = 'mhucka@caltech.edu'
 __license__ = 'GPLv3'
 
+import asyncio
+import collections
+import gc
+import multiprocessing
+import multiprocessing.util
 import os
+import random
 import sys
+import threading
+import time
+import tracemalloc
+from   pymongo import AsyncMongoClient, MongoClient, ReplaceOne, UpdateOne, monitoring
+from   pymongo.errors import AutoReconnect, BulkWriteError
+
+from   .credentials import get_credentials, save_credentials, obtain_credentials
+from   .messages import *
+from   .timestamps import canonicalize_timestamps, now_timestamp
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 # Global constants.
@@ -411,7 +431,1494 @@ def make_content_type(content, method='file names'):
 def make_topics(ontology, topics):
     return {ontology: topics}
 
+
+# Building entries from GitHub API data.
+# -----------------------------------------------------------------------------
+# repo_entries_from_api() turns a batch of repository records as returned by
+# the GitHub API (https://developer.github.com/v3/repos/), or as found in
+# dumps such as GHTorrent's, into repo_entry() dictionaries.  The timestamps
+# of the whole batch are converted together (see
+# timestamps.canonicalize_timestamps()), which is much faster than converting
+# them one at a time, and each entry is checked by validate_entry() to catch
+# values that break the conventions described in repo_entry().  Example:
+#
+#    rejected = []
+#    entries = repo_entries_from_api(payloads, rejected=rejected)
+#    db.bulk_writer().put_all(entries)
+
+_API_TIME_FIELDS = ('created_at', 'updated_at', 'pushed_at')
+
+_API_FIELDS = ('_id', 'owner', 'name', 'description', 'languages', 'licenses',
+               'fork', 'time', 'default_branch', 'homepage')
+'''Fields of entries that repo_entries_from_api() fills from the payloads,
+and that are therefore the ones that need checking.'''
+
+def repo_entries_from_api(payloads, data_refreshed=None, validate=True,
+                          rejected=None, columns=False):
+    '''Returns a list of repo_entry() dictionaries created from 'payloads',
+    a sequence of GitHub API repository records (dictionaries).  Parameter
+    'data_refreshed' is the value for 'time.data_refreshed' (default: now).
+    If 'validate' is True, entries that fail validate_entry() are left out;
+    if 'rejected' is a list, an (id, problems) tuple is appended to it for
+    each of them, otherwise they are reported as warnings.  If 'columns' is
+    True, the result is returned as a RepoColumns object instead.'''
+    payloads = list(payloads)
+    if data_refreshed is None:
+        data_refreshed = now_timestamp()
+    times = canonicalize_timestamps([payload.get(field)
+                                     for payload in payloads
+                                     for field in _API_TIME_FIELDS])
+    entries = []
+    for (index, payload) in enumerate(payloads):
+        (created, updated, pushed) = times[3*index:3*index + 3]
+        entry = _entry_from_api(payload, created, updated, pushed,
+                                data_refreshed)
+        if validate:
+            problems = validate_entry(entry, _API_FIELDS)
+            if problems:
+                if rejected is not None:
+                    rejected.append((entry['_id'], problems))
+                else:
+                    msg('Skipping entry {}: {}'.format(entry['_id'],
+                                                       '; '.join(problems)),
+                        'warning')
+                continue
+        entries.append(entry)
+    if columns:
+        return RepoColumns.from_entries(entries)
+    return entries
+
+
+def _entry_from_api(payload, created, updated, pushed, data_refreshed):
+    owner = payload.get('owner')
+    if isinstance(owner, dict):
+        owner = owner.get('login')
+    description = payload.get('description', None)
+    if 'description' in payload and description is None:
+        description = ''
+    if isinstance(payload.get('languages'), dict):
+        # From the /languages API endpoint: names mapped to numbers of bytes.
+        found = payload['languages']
+        languages = make_languages(sorted(found, key=found.get, reverse=True))
+        languages = languages or -1
+    elif payload.get('language'):
+        languages = make_languages(payload['language'])
+    else:
+        languages = -1 if 'language' in payload else []
+    license = payload.get('license')
+    if isinstance(license, dict) and license.get('name'):
+        licenses = [license['name']]
+    else:
+        licenses = -1 if 'license' in payload else []
+    parent = payload.get('parent') or {}
+    source = payload.get('source') or {}
+    is_fork = payload.get('fork')
+    private = payload.get('private')
+    return repo_entry(payload['id'],
+                      name=payload.get('name'),
+                      owner=owner,
+                      description=description,
+                      text_languages=[],
+                      languages=languages,
+                      licenses=licenses,
+                      files=[],
+                      content_type=[],
+                      kind=[],
+                      interfaces=[],
+                      functions=[],
+                      default_branch=payload.get('default_branch'),
+                      homepage=payload.get('homepage') or None,
+                      is_deleted=False,
+                      is_visible=None if private is None else not private,
+                      is_fork=is_fork,
+                      fork_of=parent.get('id'),
+                      fork_root=source.get('id'),
+                      created=created,
+                      last_updated=updated,
+                      last_pushed=pushed,
+                      data_refreshed=data_refreshed)
+
+
+def validate_entry(entry, fields=None):
+    '''Checks the values of 'entry' against the conventions described in
+    the documentation of repo_entry(), and returns a list of strings
+    describing the problems found (an empty list if there are none).  If
+    'fields' is given, only those fields are checked.'''
+    problems = []
+    for field in fields or _VALIDATORS:
+        value = entry.get(field)
+        if not _VALIDATORS[field](value):
+            problems.append('bad value for {}: {!r}'.format(field, value))
+    if entry.get('is_deleted') is True and entry.get('is_visible') is True:
+        problems.append('is_deleted is True but is_visible is also True')
+    return problems
+
+
+def _is_str_or_none(value):
+    return value is None or type(value) is str
+
+
+def _is_int_or_none(value):
+    return value is None or type(value) is int
+
+
+def _is_list_or_minus_one(value):
+    return value == -1 or _is_list_of(value, str)
+
+
+def _is_list_of(value, kind):
+    return isinstance(value, list) and all(isinstance(item, kind) for item in value)
+
+
+_VALIDATORS = {
+    '_id'              : lambda v: type(v) is int and v >= 0,
+    'owner'            : _is_str_or_none,
+    'name'             : _is_str_or_none,
+    'description'      : _is_str_or_none,
+    'readme'           : lambda v: v is None or v in (-1, -2) or type(v) is str,
+    'text_languages'   : _is_list_or_minus_one,
+    'languages'        : lambda v: v == -1 or (type(v) is list and all(
+                             type(lang) is dict and type(lang.get('name')) is str
+                             for lang in v)),
+    'licenses'         : _is_list_or_minus_one,
+    'files'            : _is_list_or_minus_one,
+    'content_type'     : lambda v: _is_list_of(v, dict),
+    'kind'             : lambda v: type(v) is list,
+    'interfaces'       : lambda v: type(v) is list,
+    'topics'           : lambda v: isinstance(v, dict) and all(
+                             isinstance(labels, list) for labels in v.values()),
+    'functions'        : lambda v: type(v) is list,
+    'num_commits'      : _is_int_or_none,
+    'num_releases'     : _is_int_or_none,
+    'num_branches'     : _is_int_or_none,
+    'num_contributors' : _is_int_or_none,
+    'is_visible'       : lambda v: v is None or type(v) is bool,
+    'is_deleted'       : lambda v: v is None or type(v) is bool,
+    'fork'             : lambda v: v is False or v == [] or (
+                             isinstance(v, dict) and v.keys() == {'parent', 'root'}
+                             and _is_int_or_none(v['parent'])
+                             and _is_int_or_none(v['root'])),
+    'time'             : lambda v: isinstance(v, dict) and v.keys() == set(_TIME_FIELDS)
+                             and all(t is None or type(t) is float
+                                     for t in v.values()),
+    'default_branch'   : _is_str_or_none,
+    'homepage'         : _is_str_or_none,
+}
+'''Functions checking the value of each field, used by validate_entry().'''
+
+
+# Compact in-memory representation of repo entries.
+# -----------------------------------------------------------------------------
+# A repo_entry() dictionary with its nested 'time', 'fork' and 'topics'
+# dictionaries takes up about 2 KB of memory before counting the field values
+# themselves.  That becomes the dominant cost when holding millions of entries
+# in memory.  RepoEntry stores the same information in a __slots__ object and
+# keeps the nested records as tuples.  Reading one of them returns a new
+# dictionary made from the tuple, which is not kept, so reading entries (e.g.,
+# with to_doc()) does not make them bigger; only if that dictionary (or one of
+# the lists in 'topics') is then changed does it replace the tuple, so that
+# the change is not lost.  RepoEntry objects support entry['field'] access
+# using the same field names as repo_entry() dictionaries, so the functions
+# e_path(), e_summary(), e_languages(), etc., work on either form.
+# benchmark_entries() measures the memory taken by both forms.
+
+_ENTRY_FIELDS = ('_id', 'owner', 'name', 'description', 'readme',
+                 'text_languages', 'languages', 'licenses', 'files',
+                 'content_type', 'kind', 'interfaces', 'topics', 'notes',
+                 'functions', 'num_commits', 'num_releases', 'num_branches',
+                 'num_contributors', 'is_visible', 'is_deleted', 'fork',
+                 'time', 'default_branch', 'homepage')
+'''Top-level field names of entries, in the order used by repo_entry().'''
+
+_TIME_FIELDS = ('repo_created', 'repo_updated', 'repo_pushed', 'data_refreshed')
+'''Names of the fields in the 'time' field of entries.'''
+
+class RepoEntry():
+    __slots__ = ('id', 'owner', 'name', 'description', 'readme',
+                 'text_languages', 'languages', 'licenses', 'files',
+                 'content_type', 'kind', 'interfaces', '_topics', 'notes',
+                 'functions', 'num_commits', 'num_releases', 'num_branches',
+                 'num_contributors', 'is_visible', 'is_deleted', '_fork',
+                 '_time', 'default_branch', 'homepage')
+
+    def __init__(self, *args, **kwargs):
+        '''Takes the same arguments as repo_entry().'''
+        self._set_doc(repo_entry(*args, **kwargs))
+
+
+    @classmethod
+    def from_doc(cls, doc):
+        '''Creates a RepoEntry from a dictionary in the format produced by
+        repo_entry(), such as an entry returned by a database query.  Fields
+        missing from 'doc' (e.g., because of a projection) are missing from
+        the RepoEntry too, as they would be from the dictionary.
+        '''
+        entry = cls.__new__(cls)
+        entry._set_doc(doc)
+        return entry
+
+
+    def to_doc(self):
+        '''Returns this entry as a dictionary in the format of repo_entry().'''
+        return {field: self[field] for field in self}
+
+
+    @property
+    def time(self):
+        if isinstance(self._time, tuple):
+            return _NestedDict(zip(_TIME_FIELDS, self._time), self, '_time')
+        return self._time
+
+
+    @time.setter
+    def time(self, value):
+        if isinstance(value, dict) and value.keys() == set(_TIME_FIELDS):
+            self._time = tuple(value[field] for field in _TIME_FIELDS)
+        else:
+            self._time = value
+
+
+    @property
+    def fork(self):
+        if isinstance(self._fork, tuple):
+            return _NestedDict(make_fork(*self._fork), self, '_fork')
+        return self._fork
+
+
+    @fork.setter
+    def fork(self, value):
+        if isinstance(value, dict) and value.keys() == {'parent', 'root'}:
+            self._fork = (value['parent'], value['root'])
+        else:
+            self._fork = value
+
+
+    @property
+    def topics(self):
+        if isinstance(self._topics, tuple):
+            topics = _NestedDict((), self, '_topics')
+            for (ontology, terms) in self._topics:
+                dict.__setitem__(topics, ontology, _NestedList(terms, topics))
+            return topics
+        return self._topics
+
+
+    @topics.setter
+    def topics(self, value):
+        if isinstance(value, dict) and all(isinstance(terms, list)
+                                           for terms in value.values()):
+            self._topics = tuple((ontology, tuple(terms))
+                                 for (ontology, terms) in value.items())
+        else:
+            self._topics = value
+
+
+    def __getitem__(self, field):
+        # Fields missing from the entry are slots that were never set.
+        try:
+            if field == '_id':
+                return self.id
+            elif field in _ENTRY_FIELDS:
+                return getattr(self, field)
+        except AttributeError:
+            pass
+        raise KeyError(field)
+
+
+    def __setitem__(self, field, value):
+        if field == '_id':
+            self.id = value
+        elif field in _ENTRY_FIELDS:
+            setattr(self, field, value)
+        else:
+            raise KeyError(field)
+
+
+    def __contains__(self, field):
+        return field in _ENTRY_FIELDS and hasattr(self, _slot(field))
+
+
+    def __iter__(self):
+        return (field for field in _ENTRY_FIELDS if hasattr(self, _slot(field)))
+
+
+    def __len__(self):
+        return sum(1 for field in self)
+
+
+    def __eq__(self, other):
+        if isinstance(other, (RepoEntry, dict)):
+            return self.to_doc() == (other.to_doc() if isinstance(other, RepoEntry)
+                                     else other)
+        return NotImplemented
+
+
+    def __repr__(self):
+        return 'RepoEntry({})'.format(self.to_doc())
+
+
+    def get(self, field, default=None):
+        return self[field] if field in self else default
+
+
+    def keys(self):
+        return list(self)
+
+
+    def _set_doc(self, doc):
+        for field in _ENTRY_FIELDS:
+            if field in doc:
+                self[field] = doc[field]
+
+
+class _NestedDict(dict):
+    # Dictionary made from the tuple in slot 'slot' of RepoEntry 'entry'.  The
+    # first change made to it stores it in that slot in place of the tuple,
+    # unless the slot has been given another value in the meantime.
+    __slots__ = ('_entry', '_slot', '_source')
+
+    def __init__(self, items, entry, slot):
+        super().__init__(items)
+        self._entry  = entry
+        self._slot   = slot
+        self._source = getattr(entry, slot)
+
+    def __reduce__(self):
+        # Copies and pickles are plain dictionaries, without the entry.
+        return (dict, (dict(self),))
+
+    def _changed(self):
+        if self._entry is not None:
+            if getattr(self._entry, self._slot, None) is self._source:
+                setattr(self._entry, self._slot, self)
+            self._entry  = None
+            self._source = None
+
+
+class _NestedList(list):
+    # List of terms in a _NestedDict made from the 'topics' of an entry.
+    __slots__ = ('_parent',)
+
+    def __init__(self, items, parent):
+        super().__init__(items)
+        self._parent = parent
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+    def _changed(self):
+        self._parent._changed()
+
+
+def _writing_back(method):
+    # Wraps 'method' of _NestedDict or _NestedList to record the change.
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._changed()
+        return result
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+for _name in ('__setitem__', '__delitem__', '__ior__', 'clear', 'pop',
+              'popitem', 'setdefault', 'update'):
+    setattr(_NestedDict, _name, _writing_back(getattr(dict, _name)))
+for _name in ('__setitem__', '__delitem__', '__iadd__', '__imul__', 'append',
+              'extend', 'insert', 'pop', 'remove', 'clear', 'sort', 'reverse'):
+    setattr(_NestedList, _name, _writing_back(getattr(list, _name)))
+del _name
+
+
+def _slot(field):
+    # Returns the name of the slot holding 'field' in a RepoEntry.
+    if field == '_id':
+        return 'id'
+    elif field in ('time', 'fork', 'topics'):
+        return '_' + field
+    return field
+
+
+
+def benchmark_entries(num_entries=100000):
+    '''Measures with tracemalloc the memory taken by 'num_entries' entries
+    made by repo_entry() with default values (as they would come from the
+    database, each with its own empty lists), held as dictionaries, as
+    RepoEntry objects, and as RepoEntry objects after one pass of to_doc()
+    over them.  Returns a list of tuples (form, GB per million entries).
+    '''
+    results = []
+    for form in ('dict', 'RepoEntry', 'RepoEntry after to_doc()'):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            if form == 'dict':
+                entries = [repo_entry(i) for i in range(num_entries)]
+            else:
+                entries = [RepoEntry(i) for i in range(num_entries)]
+            if form == 'RepoEntry after to_doc()':
+                for entry in entries:
+                    entry.to_doc()
+            gc.collect()
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        del entries
+        results.append((form, size/num_entries*1e6/1e9))
+    return results
+
+
+def _sample_entries(num):
+    # Returns a list of 'num' entries in which, as in the database, many
+    # fields still have their sentinel values, for the benchmarks of other
+    # modules.  The random generator is seeded so that every run uses the
+    # same entries.
+    rand = random.Random(0)
+    words = ['data', 'tool', 'web', 'python', 'parser', 'fast', 'simple',
+             'library', 'client', 'server', 'test', 'config', 'api', 'app']
+    languages = ['Python', 'Java', 'C', 'C++', 'JavaScript', 'Go', 'Ruby']
+    entries = []
+    for i in range(num):
+        created = 1200000000 + rand.randrange(300000000)
+        known = rand.random() < 0.5
+        description = ' '.join(rand.choice(words) for _ in range(8))
+        langs = rand.sample(languages, rand.randrange(1, 4))
+        is_fork = rand.random() < 0.3
+        entries.append(repo_entry(
+            1000 + i*7,
+            name='-'.join(rand.sample(words, 2)),
+            owner='user{}'.format(rand.randrange(num)),
+            description=description if known else '',
+            languages=langs if known else [],
+            num_commits=rand.randrange(5000) if known else None,
+            num_releases=rand.randrange(20) if known else -1,
+            num_branches=rand.randrange(1, 10) if known else None,
+            num_contributors=rand.randrange(1, 50) if known else None,
+            default_branch='master' if known else None,
+            is_deleted=False,
+            is_visible=True,
+            is_fork=is_fork,
+            fork_of=rand.randrange(10**8) if is_fork else None,
+            fork_root=rand.randrange(10**8) if is_fork else None,
+            created=created,
+            last_updated=created + rand.randrange(10**7),
+            last_pushed=created + rand.randrange(10**7) if known else None,
+            data_refreshed=1500000000.0))
+    return entries
+
+# Database client registry.
+# -----------------------------------------------------------------------------
+# Every MongoClient has its own connection pool, and every new connection
+# costs a TCP, TLS and authentication handshake.  Pipelines made of several
+# modules used to end up with one client per module.  mongo_client() instead
+# returns a client shared by all callers in the process that connect to the
+# same server with the same credentials and pool size.  Clients are reference
+# counted: each call to mongo_client() must be matched by a call to
+# release_client(), and the client is closed when the last user releases it.
+#
+# async_mongo_client() and release_async_client() do the same for pymongo's
+# AsyncMongoClient, used by casicsdb_async.  An AsyncMongoClient can only be
+# used in the event loop it was first used in, so async clients are shared
+# only by callers running in the same event loop.
+#
+# MongoClient objects are not fork-safe.  After an os.fork(), the child
+# process forgets the clients inherited from the parent (without closing
+# them, since their sockets still belong to the parent) and creates new ones
+# on demand.
+
+_MAX_POOL_SIZE = 25
+'''Default maximum number of connections in a client's connection pool.'''
+
+_clients = {}
+_clients_lock = threading.Lock()
+_clients_pid = os.getpid()
+
+class _PoolStats(monitoring.ConnectionPoolListener):
+    # Counts connection pool events for client_stats().
+
+    def __init__(self):
+        self.open            = 0
+        self.checked_out     = 0
+        self.max_checked_out = 0
+        self.checkouts       = 0
+        self.failures        = 0
+        self.clears          = 0
+
+    def connection_created(self, event):
+        self.open += 1
+
+    def connection_closed(self, event):
+        self.open -= 1
+
+    def connection_checked_out(self, event):
+        self.checkouts += 1
+        self.checked_out += 1
+        self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def connection_check_out_failed(self, event):
+        self.failures += 1
+
+    def pool_cleared(self, event):
+        self.clears += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+class _ClientRecord():
+    def __init__(self, client, stats, max_pool_size):
+        self.client        = client
+        self.stats         = stats
+        self.max_pool_size = max_pool_size
+        self.refs          = 0
+
+
+def mongo_client(user, password, host, port, max_pool_size=_MAX_POOL_SIZE,
+                 timeout=_CONN_TIMEOUT):
+    '''Returns a MongoClient connected to 'host' and 'port' with the given
+    credentials, reusing an existing client in this process if there is one
+    with the same parameters.  Callers must call release_client() when done.
+    Parameter 'timeout' is in milliseconds.
+    '''
+    return _shared_client(MongoClient, None, user, password, host, port,
+                          max_pool_size, timeout, connect=True)
+
+
+def async_mongo_client(user, password, host, port, max_pool_size=_MAX_POOL_SIZE,
+                       timeout=_CONN_TIMEOUT):
+    '''Like mongo_client(), but returns an AsyncMongoClient shared with other
+    callers in the running event loop.  Must be called from a coroutine (or
+    a function called by one).  Callers must call release_async_client()
+    when done.
+    '''
+    return _shared_client(AsyncMongoClient, asyncio.get_running_loop(), user,
+                          password, host, port, max_pool_size, timeout)
+
+
+def release_client(client):
+    '''Releases a client obtained from mongo_client(), closing it if nobody
+    else in this process is using it.'''
+    if _release(client):
+        client.close()
+
+
+async def release_async_client(client):
+    '''Releases a client obtained from async_mongo_client(), closing it if
+    nobody else in its event loop is using it.'''
+    if _release(client):
+        await client.close()
+
+
+def _shared_client(client_class, loop, user, password, host, port,
+                   max_pool_size, timeout, **options):
+    key = (user, password, host, int(port), max_pool_size, loop)
+    with _clients_lock:
+        _check_fork()
+        record = _clients.get(key)
+        if not record:
+            stats = _PoolStats()
+            client = client_class(
+                'mongodb://{}:{}@{}:{}'.format(user, password, host, port),
+                connectTimeoutMS=timeout, maxPoolSize=max_pool_size,
+                tz_aware=True, event_listeners=[stats], **options)
+            record = _clients[key] = _ClientRecord(client, stats, max_pool_size)
+        record.refs += 1
+        return record.client
+
+
+def _release(client):
+    # Returns True if 'client' is no longer used and should be closed.
+    with _clients_lock:
+        _check_fork()
+        for (key, record) in list(_clients.items()):
+            if record.client is client:
+                record.refs -= 1
+                if record.refs <= 0:
+                    del _clients[key]
+                    return True
+                return False
+    return False
+
+
+def client_stats():
+    '''Returns a list of dictionaries describing the clients currently open
+    in this process and the utilization of their connection pools.'''
+    with _clients_lock:
+        _check_fork()
+        return [{'host'            : host,
+                 'port'            : port,
+                 'user'            : user,
+                 'users'           : record.refs,
+                 'max_pool_size'   : record.max_pool_size,
+                 'open'            : record.stats.open,
+                 'checked_out'     : record.stats.checked_out,
+                 'max_checked_out' : record.stats.max_checked_out,
+                 'checkouts'       : record.stats.checkouts,
+                 'failures'        : record.stats.failures,
+                 'clears'          : record.stats.clears,
+                 'asynchronous'    : loop is not None}
+                for ((user, password, host, port, size, loop), record)
+                in _clients.items()]
+
+
+def _check_fork():
+    # Covers forks that bypass os.register_at_fork(), e.g., from C code.
+    # Must be called with _clients_lock held.
+    global _clients_pid
+    if os.getpid() != _clients_pid:
+        _clients.clear()
+        _clients_pid = os.getpid()
+
+
+def _forget_clients():
+    # The lock may have been held by another thread at the time of the fork,
+    # in which case it would never be released in the child.
+    global _clients_lock
+    _clients_lock = threading.Lock()
+    with _clients_lock:
+        _check_fork()
+
+os.register_at_fork(after_in_child=_forget_clients)
+
+
+# Iterating over repo entries.
+# -----------------------------------------------------------------------------
+# Most uses of the database only look at a few fields of each entry, but a
+# plain find() returns whole documents, including 'readme' values that can be
+# many kilobytes long.  iter_repos() asks the server for only the fields
+# requested.  Example of use:
+#
+#    for entry in iter_repos(db.repos, {'languages.name': 'Python'},
+#                            fields=[e_path, 'num_commits']):
+#        print(e_path(entry), entry['num_commits'])
+
+_ACCESSOR_FIELDS = {e_path      : ['owner', 'name'],
+                    e_summary   : ['owner', 'name'],
+                    e_languages : ['languages']}
+'''Fields read by the accessor functions above, for use in projections.'''
+
+_DEFAULT_BATCH_SIZE = 5000
+'''Number of entries fetched per round-trip by iter_repos().  The server's
+default first batch is only 101 documents, which is far too small for the
+kind of small projected records iter_repos() usually returns.'''
+
+def repo_projection(fields):
+    '''Returns a MongoDB projection dictionary for the list 'fields'.  The
+    elements of 'fields' can be field names (using dotted notation for
+    nested fields, e.g., 'time.repo_created') or any of the accessor
+    functions e_path, e_summary and e_languages, which stand for the fields
+    they need.  The '_id' field is always included.  If 'fields' is None,
+    returns None, which MongoDB interprets as "all fields".
+    '''
+    if fields is None:
+        return None
+    projection = {'_id': 1}
+    for field in fields:
+        for name in _ACCESSOR_FIELDS.get(field, [field]):
+            projection[name] = 1
+    return projection
+
+
+def iter_repos(collection, query=None, fields=None,
+               batch_size=_DEFAULT_BATCH_SIZE, by_id=False,
+               start_id=None, end_id=None):
+    '''Generator yielding the entries in 'collection' that match 'query',
+    with only the 'fields' requested (see repo_projection()).  Parameter
+    'batch_size' sets the number of entries fetched per round-trip.
+
+    If 'by_id' is True, the collection is walked in ascending '_id' order
+    using a series of range queries on the '_id' index, one per batch,
+    instead of a single long-lived cursor.  This is slower to start but
+    each query is short, so it does not suffer from cursor timeouts on
+    long scans and can be resumed from the last '_id' seen.  Parameters
+    'start_id' (inclusive) and 'end_id' (exclusive) limit the '_id' range
+    scanned; they apply in either mode.  Raises ValueError if 'batch_size'
+    is less than 1.
+    '''
+    if batch_size < 1:
+        raise ValueError('batch_size must be at least 1, not {}'.format(batch_size))
+    return _iter_repos(collection, query, fields, batch_size, by_id,
+                       start_id, end_id)
+
+
+def _iter_repos(collection, query, fields, batch_size, by_id, start_id, end_id):
+    query = dict(query) if query else {}
+    projection = repo_projection(fields)
+    id_range = {}
+    if start_id is not None:
+        id_range['$gte'] = start_id
+    if end_id is not None:
+        id_range['$lt'] = end_id
+    if not by_id:
+        if id_range:
+            query = {'$and': [query, {'_id': id_range}]}
+        cursor = collection.find(query, projection, batch_size=batch_size)
+        try:
+            for entry in cursor:
+                yield entry
+        finally:
+            cursor.close()
+        return
+
+    while True:
+        batch_query = {'$and': [query, {'_id': id_range}]} if id_range else query
+        found = 0
+        for entry in (collection.find(batch_query, projection)
+                      .sort('_id', 1).limit(batch_size).batch_size(batch_size)):
+            found += 1
+            last_id = entry['_id']
+            yield entry
+        if found < batch_size:
+            return
+        id_range['$gt'] = last_id
+        id_range.pop('$gte', None)
+
+
+# Cached lookups of repo entries.
+# -----------------------------------------------------------------------------
+# Code that follows fork relationships looks up the same parent and root
+# repos over and over, at the cost of one find_one() round-trip each time.
+# RepoCache keeps recently used entries in memory (evicting the least
+# recently used ones beyond 'max_size'), and gathers all the ids it does not
+# have into a single $in query.  If 'ttl' is given, an entry older than 'ttl'
+# seconds is revalidated by asking the server only for its
+# 'time.data_refreshed' value; the full entry is fetched again only if that
+# value has changed.  Ids that do not exist in the database are remembered
+# too, so they are not looked up again.  RepoCache is not thread-safe.
+# Example of use:
+#
+#    cache = RepoCache(db.repos, fields=['fork', e_path])
+#    roots = cache.fork_roots(ids)
+
+_IN_QUERY_SIZE = 1000
+'''Maximum number of ids put in a single $in query.'''
+
+_NOT_FOUND = object()
+'''Marker for cached lookups of ids that are not in the database.'''
+
+class RepoCache():
+    def __init__(self, collection, max_size=100000, ttl=None, fields=None):
+        '''Creates a cache in front of 'collection' holding up to 'max_size'
+        entries, each with only the given 'fields' (see repo_projection()).
+        Parameter 'ttl' is the number of seconds after which cached entries
+        are revalidated; None means never.'''
+        self.collection  = collection
+        self.max_size    = max_size
+        self.ttl         = ttl
+        self.projection  = repo_projection(fields)
+        if self.projection and ttl is not None:
+            self.projection['time.data_refreshed'] = 1
+        self._entries    = collections.OrderedDict()
+        self.hits        = 0
+        self.misses      = 0
+        self.revalidated = 0
+        self.queries     = 0
+        self.evictions   = 0
+
+
+    def __getitem__(self, id):
+        entry = self.get(id, _NOT_FOUND)
+        if entry is _NOT_FOUND:
+            raise KeyError(id)
+        return entry
+
+
+    def __contains__(self, id):
+        return id in self._entries and self._entries[id][1] is not _NOT_FOUND
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def get(self, id, default=None):
+        '''Returns the entry with the given '_id', or 'default' if there is
+        no such entry in the database.'''
+        return self.get_many([id]).get(id, default)
+
+
+    def get_many(self, ids):
+        '''Returns a dictionary mapping those of the given ids that exist in
+        the database to their entries, using at most one round-trip per
+        _IN_QUERY_SIZE ids that are not already cached.'''
+        found = {}
+        missing = []
+        stale = []
+        seen = set()
+        now = time.time()
+        for id in ids:
+            if id in seen:
+                continue
+            seen.add(id)
+            cached = self._entries.get(id)
+            if cached is None:
+                missing.append(id)
+            elif self.ttl is not None and now - cached[0] > self.ttl:
+                stale.append(id)
+            else:
+                self._entries.move_to_end(id)
+                self.hits += 1
+                if cached[1] is not _NOT_FOUND:
+                    found[id] = cached[1]
+        self.misses += len(missing)
+        if stale:
+            missing += self._revalidate(stale, found, now)
+        if missing:
+            fetched = {}
+            for entry in self._find(missing, self.projection):
+                fetched[entry['_id']] = entry
+            for id in missing:
+                self._store(id, fetched.get(id, _NOT_FOUND), now)
+            found.update(fetched)
+        return found
+
+
+    def prefetch(self, ids):
+        '''Loads the given ids into the cache, in as few queries as possible.'''
+        self.get_many(ids)
+
+
+    def invalidate(self, id=None):
+        '''Drops the entry with the given id from the cache, or all entries
+        if 'id' is None.'''
+        if id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(id, None)
+
+
+    def fork_parents(self, ids):
+        '''Returns a dictionary mapping each of the given ids to the id of
+        the repo it was forked from, for those that are known forks with a
+        known parent.'''
+        parents = {}
+        for (id, entry) in self.get_many(ids).items():
+            fork = entry.get('fork')
+            if isinstance(fork, dict) and fork.get('parent') is not None:
+                parents[id] = fork['parent']
+        return parents
+
+
+    def fork_roots(self, ids):
+        '''Returns a dictionary mapping each of the given ids to the id of the
+        original repo at the top of its chain of forks (which is the id itself
+        for repos that are not forks).  The 'fork.root' field is used when it
+        is known; otherwise the chain of parents is followed, one batched
+        query per level of forking for all the ids together.'''
+        roots = {}
+        pending = {}
+        for (id, entry) in self.get_many(ids).items():
+            fork = entry.get('fork')
+            if isinstance(fork, dict) and fork.get('root') is not None:
+                roots[id] = fork['root']
+            else:
+                pending[id] = id
+        seen = {id: {id} for id in pending}
+        while pending:
+            parents = self.fork_parents(set(pending.values()))
+            next_pending = {}
+            for (id, current) in pending.items():
+                parent = parents.get(current)
+                if parent is None or parent in seen[id]:
+                    roots[id] = current
+                else:
+                    seen[id].add(parent)
+                    next_pending[id] = parent
+            pending = next_pending
+        return roots
+
+
+    def stats(self):
+        '''Returns a dictionary of cache statistics.'''
+        lookups = self.hits + self.misses
+        return {'size'        : len(self._entries),
+                'hits'        : self.hits,
+                'misses'      : self.misses,
+                'hit_rate'    : self.hits/lookups if lookups else 0.0,
+                'revalidated' : self.revalidated,
+                'queries'     : self.queries,
+                'evictions'   : self.evictions}
+
+
+    def _revalidate(self, ids, found, now):
+        # Renew the cached entries whose data_refreshed time has not changed,
+        # and return the ids that have to be fetched again.
+        current = {entry['_id']: (entry.get('time') or {}).get('data_refreshed')
+                   for entry in self._find(ids, {'_id': 1,
+                                                 'time.data_refreshed': 1})}
+        refetch = []
+        for id in ids:
+            cached = self._entries[id][1]
+            if cached is _NOT_FOUND:
+                if id in current:
+                    refetch.append(id)
+                else:
+                    self._store(id, _NOT_FOUND, now)
+            elif (id in current and current[id] ==
+                  (cached.get('time') or {}).get('data_refreshed')):
+                self.revalidated += 1
+                self._store(id, cached, now)
+                found[id] = cached
+            else:
+                refetch.append(id)
+        return refetch
+
+
+    def _find(self, ids, projection):
+        for i in range(0, len(ids), _IN_QUERY_SIZE):
+            self.queries += 1
+            for entry in self.collection.find(
+                    {'_id': {'$in': ids[i:i + _IN_QUERY_SIZE]}}, projection):
+                yield entry
+
+
+    def _store(self, id, entry, now):
+        self._entries[id] = (now, entry)
+        self._entries.move_to_end(id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+# Parallel scans over repo entries.
+# -----------------------------------------------------------------------------
+# A pass over all 25M+ entries using a single cursor is limited to one CPU.
+# parallel_scan() splits the integer '_id' space into ranges and scans them
+# in a pool of worker processes.  Each worker gets its own MongoClient from
+# mongo_client(), because MongoClient objects must not be shared across a
+# fork.  Functions
+# passed to parallel_scan() must be defined at the top level of a module so
+# that they can be pickled and sent to the worker processes.  Example of use:
+#
+#    def count_python(entry):
+#        return 1 if 'Python' in (e_languages(entry) or []) else 0
+#
+#    total = parallel_scan(conn, 'github', count_python, operator.add,
+#                          fields=[e_languages])
+
+def id_ranges(low, high, num):
+    '''Splits the '_id' interval [low, high) into 'num' contiguous ranges of
+    (nearly) equal width, returned as a list of (start, end) tuples.
+    '''
+    num = max(1, min(num, high - low))
+    width, extra = divmod(high - low, num)
+    ranges = []
+    start = low
+    for i in range(num):
+        end = start + width + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+_worker_client = None
+'''Client used by the current parallel_scan() worker process.'''
+
+def _init_scan_worker(conn):
+    # Pool initializer: each worker process connects once and reuses the
+    # client for every range it is given.  The finalizer runs when the
+    # worker exits normally, which is why parallel_scan() closes and joins
+    # the pool instead of terminating it.
+    global _worker_client
+    _worker_client = mongo_client(*conn)
+    multiprocessing.util.Finalize(None, release_client, args=(_worker_client,),
+                                  exitpriority=10)
+
+
+def _scan_range(args):
+    (dbname, collection, query, fields, start, end, map_fn, reduce_fn) = args
+    # by_id keeps the values of each range in '_id' order, as promised.
+    entries = iter_repos(_worker_client[dbname][collection], query,
+                         fields=fields, by_id=True, start_id=start, end_id=end)
+    values = (map_fn(entry) for entry in entries)
+    values = (value for value in values if value is not None)
+    if reduce_fn:
+        return _reduce(reduce_fn, values)
+    return list(values)
+
+
+def parallel_scan(conn, dbname, map_fn, reduce_fn=None, query=None,
+                  fields=None, workers=None, ranges_per_worker=4,
+                  collection='repos', id_range=None):
+    '''Applies 'map_fn' to every entry matching 'query' in the collection,
+    using 'workers' processes (default: the number of CPUs).  Parameter
+    'conn' is a tuple (user, password, host, port) used by each worker to
+    connect to the server; 'fields' is passed to iter_repos().
+
+    Values of None returned by 'map_fn' are discarded.  If 'reduce_fn' is
+    None, returns a list of the remaining values in ascending '_id' order.
+    Otherwise, 'reduce_fn' must be a function of two arguments; each worker
+    reduces the values it computes, the per-range results are reduced again,
+    and the final value is returned (None if there were no values).
+
+    The '_id' space is cut into 'ranges_per_worker' ranges per worker so
+    that workers that finish early can pick up more work.  By default, the
+    space spanned is that of the lowest and highest '_id' values in the
+    collection; a different (start, end) tuple can be given as 'id_range'.
+    '''
+    workers = workers or os.cpu_count()
+    if id_range:
+        (low, high) = id_range
+    else:
+        client = mongo_client(*conn)
+        try:
+            repos = client[dbname][collection]
+            first = repos.find_one({}, {'_id': 1}, sort=[('_id', 1)])
+            last  = repos.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+        finally:
+            release_client(client)
+        if not first:
+            return [] if reduce_fn is None else None
+        (low, high) = (first['_id'], last['_id'] + 1)
+    tasks = [(dbname, collection, query, fields, start, end, map_fn, reduce_fn)
+             for (start, end) in id_ranges(low, high, workers*ranges_per_worker)]
+    pool = multiprocessing.Pool(workers, _init_scan_worker, (conn,))
+    try:
+        results = pool.imap(_scan_range, tasks)
+        if reduce_fn:
+            result = _reduce(reduce_fn, (r for r in results if r is not None))
+        else:
+            result = [value for values in results for value in values]
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return result
+
+
+def _reduce(reduce_fn, values):
+    # Like functools.reduce() without an initial value, but returning None
+    # instead of raising an exception when there are no values.
+    values = iter(values)
+    result = next(values, None)
+    for value in values:
+        result = reduce_fn(result, value)
+    return result
+
+
+# Columnar snapshots of repo entries.
+# -----------------------------------------------------------------------------
+# For analytics such as counts by language, fork ratios, or histograms of
+# creation times, iterating over entry dictionaries is slow and memory-hungry.
+# RepoColumns loads selected scalar fields into aligned NumPy arrays (row i
+# of every array describes the same entry) so that filtering and grouping
+# are vectorized operations.  The conventions for missing values are:
+#   * numeric and time fields are float64, with NaN where the entry has None
+#   * yes/no fields ('is_fork', 'is_visible', 'is_deleted') are int8, with
+#     1 for true, 0 for false and -1 for unknown
+#   * multi-valued fields ('languages', 'licenses') are CategoricalColumn
+#     objects (see below).
+# Example of use:
+#
+#    cols = repo_columns(db.repos)
+#    python = cols.languages.has('Python')
+#    print(cols.fork_ratio(python), cols.languages.counts(cols.is_fork == 1))
+#    counts, edges = cols.histogram('repo_created', bins=50, mask=python)
+
+_NUMERIC_COLUMNS = ('num_commits', 'num_releases', 'num_branches',
+                    'num_contributors')
+_FLAG_COLUMNS    = ('is_fork', 'is_visible', 'is_deleted')
+
+class CategoricalColumn():
+    '''A multi-valued string column, stored as integer category codes in
+    compressed sparse row layout: the codes for row i are
+    codes[offsets[i]:offsets[i+1]], and categories[code] is the string for
+    a code.  Array 'state' holds 1 for rows with known values, 0 for rows
+    where the field was [] (unknown), and -1 where it was -1 (we tried, but
+    there is no value).
+    '''
+
+    def __init__(self, categories, codes, offsets, state):
+        self.categories = categories
+        self.codes      = codes
+        self.offsets    = offsets
+        self.state      = state
+        self._index     = {name: code for (code, name) in enumerate(categories)}
+
+
+    @classmethod
+    def from_lists(cls, values):
+        '''Builds a column from an iterable of values, each of which is a
+        list of strings, [] or -1.'''
+        index = {}
+        codes, offsets, state = [], [0], []
+        for value in values:
+            if value == -1:
+                state.append(-1)
+            else:
+                state.append(1 if value else 0)
+                for name in value or []:
+                    codes.append(index.setdefault(name, len(index)))
+            offsets.append(len(codes))
+        return cls(list(index), np.array(codes, dtype=np.int32),
+                   np.array(offsets, dtype=np.int64),
+                   np.array(state, dtype=np.int8))
+
+
+    def row_numbers(self):
+        '''Returns an array parallel to 'codes' giving the row of each code.'''
+        return np.repeat(np.arange(len(self.state)), np.diff(self.offsets))
+
+
+    def has(self, *names):
+        '''Returns a boolean row mask that is True for rows having any of the
+        given category names.'''
+        wanted = [self._index[name] for name in names if name in self._index]
+        mask = np.zeros(len(self.state), dtype=bool)
+        if wanted:
+            mask[self.row_numbers()[np.isin(self.codes, wanted)]] = True
+        return mask
+
+
+    def counts(self, mask=None):
+        '''Returns a dictionary mapping category names to the number of rows
+        having that category, optionally only counting rows where 'mask' is
+        True.  The result is sorted from most to least common.'''
+        codes = self.codes
+        if mask is not None:
+            codes = codes[mask[self.row_numbers()]]
+        totals = np.bincount(codes, minlength=len(self.categories))
+        order = np.argsort(-totals, kind='stable')
+        return {self.categories[i]: int(totals[i]) for i in order if totals[i]}
+
+
+    def select(self, mask):
+        '''Returns a new column containing only the rows where 'mask' is True.'''
+        lengths = np.diff(self.offsets)[mask]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        codes = self.codes[mask[self.row_numbers()]]
+        return CategoricalColumn(self.categories, codes, offsets,
+                                 self.state[mask])
+
+
+class RepoColumns():
+    '''Column-oriented snapshot of scalar fields of repo entries.  Attributes
+    'ids', the names in _NUMERIC_COLUMNS, _FLAG_COLUMNS and _TIME_FIELDS are
+    NumPy arrays; 'languages' and 'licenses' are CategoricalColumn objects.
+    '''
+
+    def __init__(self, columns):
+        if np is None:
+            raise ImportError('RepoColumns requires the NumPy package')
+        self.columns = columns
+        for (name, column) in columns.items():
+            setattr(self, name, column)
+
+
+    @classmethod
+    def from_entries(cls, entries):
+        '''Builds a snapshot from an iterable of entries (dictionaries in the
+        format of repo_entry(), possibly with only the fields listed by
+        columns_projection(), or RepoEntry objects).'''
+        if np is None:
+            raise ImportError('RepoColumns requires the NumPy package')
+        values = {name: [] for name in ('ids',) + _NUMERIC_COLUMNS
+                  + _FLAG_COLUMNS + _TIME_FIELDS + ('languages', 'licenses')}
+        for entry in entries:
+            values['ids'].append(entry['_id'])
+            for name in _NUMERIC_COLUMNS:
+                value = entry.get(name)
+                values[name].append(value if value is not None else np.nan)
+            fork = entry.get('fork')
+            values['is_fork'].append(-1 if fork == [] or fork is None
+                                     else int(bool(fork)))
+            for name in ('is_visible', 'is_deleted'):
+                value = entry.get(name)
+                values[name].append(-1 if value is None else int(value))
+            times = entry.get('time') or {}
+            for name in _TIME_FIELDS:
+                value = times.get(name)
+                values[name].append(value if value is not None else np.nan)
+            values['languages'].append(e_languages(entry)
+                                       if 'languages' in entry else [])
+            values['licenses'].append(entry.get('licenses') or [])
+        columns = {'ids': np.array(values['ids'], dtype=np.int64)}
+        for name in _NUMERIC_COLUMNS + _TIME_FIELDS:
+            columns[name] = np.array(values[name], dtype=np.float64)
+        for name in _FLAG_COLUMNS:
+            columns[name] = np.array(values[name], dtype=np.int8)
+        for name in ('languages', 'licenses'):
+            columns[name] = CategoricalColumn.from_lists(values[name])
+        return cls(columns)
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def select(self, mask):
+        '''Returns a new snapshot containing only the rows where the boolean
+        array 'mask' is True.'''
+        return RepoColumns({name: column.select(mask)
+                            if isinstance(column, CategoricalColumn)
+                            else column[mask]
+                            for (name, column) in self.columns.items()})
+
+
+    def count_by(self, name, mask=None):
+        '''Returns a dictionary mapping each distinct value of column 'name'
+        to the number of rows having it.  For 'languages' and 'licenses', this
+        is the same as calling counts() on the column.'''
+        column = self.columns[name]
+        if isinstance(column, CategoricalColumn):
+            return column.counts(mask)
+        if mask is not None:
+            column = column[mask]
+        (values, totals) = np.unique(column, return_counts=True)
+        return dict(zip(values.tolist(), totals.tolist()))
+
+
+    def fork_ratio(self, mask=None):
+        '''Returns the fraction of rows known to be forks among the rows for
+        which we know whether they are forks.'''
+        forks = self.is_fork if mask is None else self.is_fork[mask]
+        known = np.count_nonzero(forks >= 0)
+        return np.count_nonzero(forks == 1)/known if known else 0.0
+
+
+    def histogram(self, name, bins=10, mask=None):
+        '''Returns the result of numpy.histogram() over time or numeric column
+        'name', skipping rows with no value.'''
+        column = self.columns[name]
+        if mask is not None:
+            column = column[mask]
+        return np.histogram(column[~np.isnan(column)], bins=bins)
+
+
+def columns_projection():
+    '''Returns the list of fields used by RepoColumns, for iter_repos().'''
+    return (['num_commits', 'num_releases', 'num_branches', 'num_contributors',
+             'fork', 'is_visible', 'is_deleted', 'languages', 'licenses']
+            + ['time.' + name for name in _TIME_FIELDS])
+
+
+def repo_columns(collection, query=None, batch_size=_DEFAULT_BATCH_SIZE):
+    '''Reads the entries in 'collection' that match 'query' and returns a
+    RepoColumns snapshot of them.'''
+    return RepoColumns.from_entries(
+        iter_repos(collection, query, fields=columns_projection(),
+                   batch_size=batch_size))
+
+
+# Bulk writing of repo entries.
+# -----------------------------------------------------------------------------
+# Writing entries one at a time using insert_one()/update_one() costs a
+# network round-trip per entry, which adds up to hours when refreshing 25M+
+# repos.  BulkRepoWriter buffers operations and sends them to the server as
+# unordered bulk_write() batches.  A batch is sent when it reaches 'batch_size'
+# operations or when the oldest buffered operation is older than 'max_delay'
+# seconds (checked whenever a new operation is added), whichever comes first.
+# Example of use:
+#
+#    with BulkRepoWriter(db.repos) as writer:
+#        for entry in entries:
+#            writer.put(entry)
+#        writer.update(16335, {'num_commits': 10})
+
+_PERMANENT_WRITE_ERRORS = {11000, 11001, 121}
+'''MongoDB error codes (duplicate key, document validation) that no amount of
+retrying will fix.  Failed operations with other codes are retried.'''
+
+class BulkRepoWriter():
+    def __init__(self, collection, batch_size=1000, max_delay=5, retries=3,
+                 quiet=True):
+        '''Creates a buffered writer for the MongoDB 'collection'.  Parameter
+        'batch_size' is the maximum number of operations sent in one call to
+        bulk_write(); 'max_delay' is the maximum number of seconds an operation
+        is held in the buffer before the buffer is flushed; 'retries' is the
+        number of times failed operations in a batch are resent before being
+        given up on.  If 'quiet' is False, a throughput report is printed
+        after each batch.
+        '''
+        self.collection = collection
+        self.batch_size = batch_size
+        self.max_delay  = max_delay
+        self.retries    = retries
+        self.quiet      = quiet
+        self._ops       = []
+        self._oldest    = None
+        self._start     = None
+        self.written    = 0
+        self.failed     = 0
+        self.batches    = 0
+        self.errors     = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+
+    def put(self, entry):
+        '''Buffers a complete entry (as produced by repo_entry()).  The entry
+        replaces any existing entry with the same '_id', or is inserted if no
+        such entry exists.
+        '''
+        self._add(_put_op(entry))
+
+
+    def update(self, id, fields, upsert=False):
+        '''Buffers a partial update that sets the values in dictionary
+        'fields' on the entry whose '_id' is 'id'.  Field names can use dotted
+        notation, as in {'time.data_refreshed': now_timestamp()}.
+        '''
+        self._add(_update_op(id, fields, upsert))
+
+
+    def put_all(self, entries):
+        '''Buffers every entry in the iterable 'entries' and flushes.'''
+        for entry in entries:
+            self.put(entry)
+        self.flush()
+
+
+    def flush(self):
+        '''Sends all buffered operations to the server.'''
+        if not self._ops:
+            return
+        (ops, self._ops, self._oldest) = (self._ops, [], None)
+        self._write(ops)
+        self._report_batch()
+
+
+    def rate(self):
+        '''Returns the number of entries written per second so far.'''
+        if not self._start:
+            return 0.0
+        elapsed = time.time() - self._start
+        return self.written/elapsed if elapsed > 0 else 0.0
+
+
+    def stats(self):
+        '''Returns a dictionary summarizing what has been written so far.'''
+        return {'written' : self.written,
+                'failed'  : self.failed,
+                'batches' : self.batches,
+                'pending' : len(self._ops),
+                'rate'    : self.rate()}
+
+
+    def _add(self, op):
+        if self._buffer(op):
+            self.flush()
+
+
+    def _buffer(self, op):
+        # Add 'op' to the buffer and return True if it's time to flush.
+        now = time.time()
+        if not self._start:
+            self._start = now
+        if not self._oldest:
+            self._oldest = now
+        self._ops.append(op)
+        return (len(self._ops) >= self.batch_size
+                or now - self._oldest >= self.max_delay)
+
+
+    def _report_batch(self):
+        self.batches += 1
+        if not self.quiet:
+            msg('Wrote {} entries in {} batches ({:.0f}/sec); {} failed.'
+                .format(self.written, self.batches, self.rate(), self.failed))
+
+
+    def _write(self, ops):
+        # Unordered writes let the server continue past individual failures,
+        # so after an error we only resend the operations that failed.
+        attempt = 0
+        while ops:
+            try:
+                self.collection.bulk_write(ops, ordered=False)
+                self.written += len(ops)
+                return
+            except BulkWriteError as err:
+                ops = self._failed_ops(ops, err)
+                if not ops:
+                    # Every failure was permanent; there is nothing to retry.
+                    return
+            except AutoReconnect:
+                # Nothing is known about what was written; resend everything.
+                # The operations are all keyed upserts/updates, so this is safe.
+                pass
+            attempt += 1
+            if attempt > self.retries:
+                self._give_up(ops)
+                return
+            time.sleep(_retry_delay(attempt))
+
+
+    def _failed_ops(self, ops, err):
+        # Account for a partially failed batch and return the operations
+        # that are worth sending again.
+        errors = err.details.get('writeErrors', [])
+        retry = []
+        for error in errors:
+            if error.get('code') in _PERMANENT_WRITE_ERRORS:
+                self.failed += 1
+                self.errors.append(error)
+            else:
+                retry.append(ops[error['index']])
+        self.written += len(ops) - len(errors)
+        return retry
+
+
+    def _give_up(self, ops):
+        self.failed += len(ops)
+        if not self.quiet:
+            msg('Giving up on {} operations after {} retries.'
+                .format(len(ops), self.retries), 'warning')
+
+
+def _put_op(entry):
+    return ReplaceOne({'_id': entry['_id']}, entry, upsert=True)
+
+
+def _update_op(id, fields, upsert):
+    return UpdateOne({'_id': id}, {'$set': fields}, upsert=upsert)
+
+
+def _retry_delay(attempt):
+    return min(2 ** attempt, 30)
+
 
+# Credentials for the database
+# -----------------------------------------------------------------------------
+
+def db_credentials(user=None, password=None, host=None, port=None, save=True):
+    '''Returns (user, password, host, port) for the CASICS database, taking
+    the values from the arguments if they are all given, and otherwise from
+    the user's keyring or by asking the user.  If 'save' is True, values that
+    differ from those in the keyring are saved to the keyring.
+    '''
+    if not (user and password and host and port):
+        (user, password, host, port) = obtain_credentials(
+            _CASICS_KEYRING, "CASICS", user, password, host, port)
+        if save:
+            (u, p, h, o) = get_credentials(_CASICS_KEYRING)
+            if u != user or p != password or h != host or o != port:
+                save_credentials(_CASICS_KEYRING, user, password, host, port)
+    return (user, password, host, port)
+
+
 # (Deprecated) CasicsDB interface class
 # -----------------------------------------------------------------------------
 # This class encapsulates interactions with MongoDB.  Callers should create a
@@ -422,29 +1929,26 @@ class CasicsDB():
     connect_timeout = _CONN_TIMEOUT  # in milliseconds
 
     def __init__(self, user=None, password=None, host=None, port=None,
-                 save=True, quiet=False):
+                 save=True, quiet=False, pool_size=_MAX_POOL_SIZE):
         '''Obtains host info and user credentials from the user's keyring or
         from the given arguments.  The given argument values (if any)
         override the values in the keyring.  Parameter "save" indicates
         whether the values should be saved in the keyring.  Parameter "quiet"
         controls whether methods on the CasicsDB class print messages about
         what they're doing; a value of True meanss to be more quiet.
+        Parameter "pool_size" is the maximum number of connections in the
+        connection pool of the (shared) client; see mongo_client().
         '''
 
-        if not (user and password and host and port):
-            (user, password, host, port) = obtain_credentials(
-                _CASICS_KEYRING, "CASICS", user, password, host, port)
-            if save:
-                (u, p, h, o) = get_keyring_credentials(_CASICS_KEYRING)
-                if u != user or p != password or h != host or o != port:
-                    save_keyring_credentials(_CASICS_KEYRING, user, password,
-                                             host, port)
+        (user, password, host, port) = db_credentials(user, password, host,
+                                                      port, save)
         self.dbuser     = user
         self.dbpassword = password
         self.dbserver   = host
         self.dbport     = int(port)
         self.dbconn     = None
         self.quiet      = quiet
+        self.pool_size  = pool_size
 
 
     def open(self, dbname):
@@ -456,25 +1960,50 @@ class CasicsDB():
 
         if not self.dbconn:
             if not self.quiet: msg('Connecting to {}.'.format(self.dbserver))
-            self.dbconn = MongoClient(
-                'mongodb://{}:{}@{}:{}'.format(self.dbuser, self.dbpassword,
-                                               self.dbserver, self.dbport),
-                connectTimeoutMS=CasicsDB.connect_timeout, maxPoolSize=25,
-                tz_aware=True, connect=True, socketKeepAlive=True)
+            self.dbconn = mongo_client(self.dbuser, self.dbpassword,
+                                       self.dbserver, self.dbport,
+                                       self.pool_size, CasicsDB.connect_timeout)
 
         # The following requires that the user has the role dbAdminAnyDatabase
-        if dbname not in self.dbconn.database_names():
+        if dbname not in self.dbconn.list_database_names():
             if not self.quiet: msg('Creating new database "{}".'.format(dbname))
-            self.db = self.dbconn[dbname]
-            self.dbconn.fsync()
         else:
             if not self.quiet: msg('Accessing existing database "{}"'.format(dbname))
-            self.db = self.dbconn[dbname]
-
+        self.db = self.dbconn[dbname]
         return self.db
 
 
+    def iter_repos(self, query=None, fields=None,
+                   batch_size=_DEFAULT_BATCH_SIZE, by_id=False,
+                   start_id=None, end_id=None, collection='repos'):
+        '''Generator over the entries of the named collection of the database
+        most recently opened with open().  See the function iter_repos() for
+        an explanation of the arguments.
+        '''
+        return iter_repos(self.db[collection], query, fields=fields,
+                          batch_size=batch_size, by_id=by_id,
+                          start_id=start_id, end_id=end_id)
+
+
+    def parallel_scan(self, dbname, map_fn, reduce_fn=None, **kwargs):
+        '''Runs parallel_scan() on database 'dbname' using this object's
+        credentials.  Keyword arguments are passed to parallel_scan().
+        '''
+        conn = (self.dbuser, self.dbpassword, self.dbserver, self.dbport)
+        return parallel_scan(conn, dbname, map_fn, reduce_fn, **kwargs)
+
+
+    def bulk_writer(self, collection='repos', **kwargs):
+        '''Returns a BulkRepoWriter for the named collection of the database
+        most recently opened with open().  Keyword arguments are passed to
+        BulkRepoWriter().
+        '''
+        kwargs.setdefault('quiet', self.quiet)
+        return BulkRepoWriter(self.db[collection], **kwargs)
+
+
     def close(self):
         '''Closes the connection to the database.'''
-        self.dbconn.close()
+        release_client(self.dbconn)
+        self.dbconn = None
         if not self.quiet: msg('Closed connection to "{}".'.format(self.dbserver))
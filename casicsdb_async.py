@@ -0,0 +1,243 @@
+# -*- python-indent-offset: 4 -*-
+'''
+casicsdb_async: asyncio interface to the CASICS database.
+
+AsyncCasicsDB is the asyncio counterpart of casicsdb.CasicsDB.  It gets
+credentials the same way (from the arguments, the user's keyring, or by
+asking the user), but uses pymongo's AsyncMongoClient, so database
+round-trips can be overlapped with other work, such as network requests to
+GitHub, in a single event loop.  Clients come from the same registry as
+those of CasicsDB (see casicsdb.async_mongo_client()), so objects opened in
+the same event loop with the same parameters share one connection pool.
+Example of use:
+
+    async def main():
+        casicsdb = AsyncCasicsDB()
+        db = await casicsdb.open('github')
+        async for entry in casicsdb.iter_repos({'is_fork': False},
+                                               fields=[e_path]):
+            ...
+        entries = await casicsdb.find_ids([16335, 7182480])
+        async with casicsdb.bulk_writer() as writer:
+            await writer.update(16335, {'num_commits': 10})
+        await casicsdb.close()
+'''
+__version__ = '1.0.0'
+__author__  = 'Michael Hucka <mhucka@caltech.edu>'
+__email__   = 'mhucka@caltech.edu'
+__license__ = 'GPLv3'
+
+import asyncio
+import time
+from   pymongo.errors import AutoReconnect, BulkWriteError
+
+from   .casicsdb import async_mongo_client, db_credentials, \
+    release_async_client, repo_projection, _CONN_TIMEOUT, _DEFAULT_BATCH_SIZE, \
+    _MAX_POOL_SIZE, _PERMANENT_WRITE_ERRORS, _put_op, _retry_delay, _update_op
+from   .messages import *
+
+
+# Main class.
+# .............................................................................
+
+class AsyncCasicsDB():
+    connect_timeout = _CONN_TIMEOUT  # in milliseconds
+
+    def __init__(self, user=None, password=None, host=None, port=None,
+                 save=True, quiet=False, pool_size=_MAX_POOL_SIZE):
+        '''Takes the same arguments as casicsdb.CasicsDB().'''
+        (user, password, host, port) = db_credentials(user, password, host,
+                                                      port, save)
+        self.dbuser     = user
+        self.dbpassword = password
+        self.dbserver   = host
+        self.dbport     = int(port)
+        self.dbconn     = None
+        self.db         = None
+        self.quiet      = quiet
+        self.pool_size  = pool_size
+
+
+    async def open(self, dbname):
+        '''Connects to the database server and returns the (asynchronous)
+        database named 'dbname', creating it if necessary.'''
+        if not self.dbconn:
+            if not self.quiet: msg('Connecting to {}.'.format(self.dbserver))
+            self.dbconn = async_mongo_client(self.dbuser, self.dbpassword,
+                                             self.dbserver, self.dbport,
+                                             self.pool_size,
+                                             AsyncCasicsDB.connect_timeout)
+        if dbname not in await self.dbconn.list_database_names():
+            if not self.quiet: msg('Creating new database "{}".'.format(dbname))
+        else:
+            if not self.quiet: msg('Accessing existing database "{}"'.format(dbname))
+        self.db = self.dbconn[dbname]
+        return self.db
+
+
+    async def close(self):
+        '''Releases the connection to the database.  The shared client is
+        closed when no other object in the event loop is using it.'''
+        await release_async_client(self.dbconn)
+        self.dbconn = None
+        if not self.quiet: msg('Closed connection to "{}".'.format(self.dbserver))
+
+
+    async def iter_repos(self, query=None, fields=None,
+                         batch_size=_DEFAULT_BATCH_SIZE, collection='repos'):
+        '''Asynchronous generator over the entries matching 'query', with only
+        the given 'fields' (see casicsdb.repo_projection()).'''
+        cursor = self.db[collection].find(query or {}, repo_projection(fields),
+                                          batch_size=batch_size)
+        async for entry in cursor:
+            yield entry
+
+
+    async def find_ids(self, ids, fields=None, chunk_size=_DEFAULT_BATCH_SIZE,
+                       collection='repos'):
+        '''Returns a dictionary mapping each of the given '_id' values to its
+        entry, fetching them with one $in query per 'chunk_size' ids.  The
+        chunks are requested concurrently.  Ids not found are left out.'''
+        ids = list(ids)
+        chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+        projection = repo_projection(fields)
+        async def fetch(chunk):
+            cursor = self.db[collection].find({'_id': {'$in': chunk}}, projection)
+            return await cursor.to_list(length=None)
+        found = {}
+        for entries in await asyncio.gather(*(fetch(c) for c in chunks)):
+            for entry in entries:
+                found[entry['_id']] = entry
+        return found
+
+
+    def bulk_writer(self, collection='repos', **kwargs):
+        '''Returns an AsyncBulkRepoWriter for the named collection.  Keyword
+        arguments are passed to AsyncBulkRepoWriter().'''
+        kwargs.setdefault('quiet', self.quiet)
+        return AsyncBulkRepoWriter(self.db[collection], **kwargs)
+
+
+# Bulk writing.
+# .............................................................................
+
+class AsyncBulkRepoWriter():
+    def __init__(self, collection, batch_size=1000, max_delay=5, retries=3,
+                 quiet=True):
+        '''Asynchronous counterpart of casicsdb.BulkRepoWriter, for
+        collections of an AsyncMongoClient, taking the same arguments.  The
+        methods put(), update(), put_all() and flush() are coroutines, and
+        the writer is used with "async with".
+        '''
+        self.collection = collection
+        self.batch_size = batch_size
+        self.max_delay  = max_delay
+        self.retries    = retries
+        self.quiet      = quiet
+        self._ops       = []
+        self._oldest    = None
+        self._start     = None
+        self.written    = 0
+        self.failed     = 0
+        self.batches    = 0
+        self.errors     = []
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.flush()
+
+
+    async def put(self, entry):
+        '''Buffers a complete entry; see BulkRepoWriter.put().'''
+        await self._add(_put_op(entry))
+
+
+    async def update(self, id, fields, upsert=False):
+        '''Buffers a partial update; see BulkRepoWriter.update().'''
+        await self._add(_update_op(id, fields, upsert))
+
+
+    async def put_all(self, entries):
+        '''Buffers every entry in the iterable 'entries' and flushes.'''
+        for entry in entries:
+            await self.put(entry)
+        await self.flush()
+
+
+    async def flush(self):
+        '''Sends all buffered operations to the server.'''
+        if not self._ops:
+            return
+        (ops, self._ops, self._oldest) = (self._ops, [], None)
+        await self._write(ops)
+        self.batches += 1
+        if not self.quiet:
+            msg('Wrote {} entries in {} batches ({:.0f}/sec); {} failed.'
+                .format(self.written, self.batches, self.rate(), self.failed))
+
+
+    def rate(self):
+        '''Returns the number of entries written per second so far.'''
+        if not self._start:
+            return 0.0
+        elapsed = time.time() - self._start
+        return self.written/elapsed if elapsed > 0 else 0.0
+
+
+    def stats(self):
+        '''Returns a dictionary summarizing what has been written so far.'''
+        return {'written' : self.written,
+                'failed'  : self.failed,
+                'batches' : self.batches,
+                'pending' : len(self._ops),
+                'rate'    : self.rate()}
+
+
+    async def _add(self, op):
+        now = time.time()
+        if not self._start:
+            self._start = now
+        if not self._oldest:
+            self._oldest = now
+        self._ops.append(op)
+        if (len(self._ops) >= self.batch_size
+                or now - self._oldest >= self.max_delay):
+            await self.flush()
+
+
+    async def _write(self, ops):
+        # As in BulkRepoWriter, only the operations that failed for reasons
+        # other than permanent errors are resent.
+        attempt = 0
+        while ops:
+            try:
+                await self.collection.bulk_write(ops, ordered=False)
+                self.written += len(ops)
+                return
+            except BulkWriteError as err:
+                errors = err.details.get('writeErrors', [])
+                retry = []
+                for error in errors:
+                    if error.get('code') in _PERMANENT_WRITE_ERRORS:
+                        self.failed += 1
+                        self.errors.append(error)
+                    else:
+                        retry.append(ops[error['index']])
+                self.written += len(ops) - len(errors)
+                ops = retry
+                if not ops:
+                    return
+            except AutoReconnect:
+                pass
+            attempt += 1
+            if attempt > self.retries:
+                self.failed += len(ops)
+                if not self.quiet:
+                    msg('Giving up on {} operations after {} retries.'
+                        .format(len(ops), self.retries), 'warning')
+                return
+            await asyncio.sleep(_retry_delay(attempt))
@@ -1,56 +1,900 @@
 # -*- python-indent-offset: 4 -*-
 '''
 dataset_pickle.py: Compressed pickle handling code.
+
+Data sets are written as pickles (protocol 5) compressed with one of the
+codecs in _CODECS: 'zstd' (the default, if the zstandard package is
+installed), 'lz4' (if the lz4 package is installed), 'gzip' or 'none'.
+The pickle is cut into chunks that are compressed independently, so that
+several threads can compress (and decompress) chunks at the same time; the
+compression libraries release the GIL while they work.  Large binary
+objects that support pickle protocol 5, such as NumPy arrays, are written
+as separate "out-of-band" sections instead of being copied into the pickle.
+Optionally, large out-of-band buffers can instead be written uncompressed
+to a sidecar file, which is memory-mapped when the data set is loaded: the
+data set then opens without reading the buffers, and the pages of the file
+are shared by all the processes that load it.  NumPy arrays loaded this way
+are read-only.
+
+File layout (integers are little-endian):
+
+    header     _MAGIC, format version (1 byte), codec id (1 byte), 6 zeros
+    sections   the pickle, then each out-of-band buffer, each section being
+               a series of chunks (raw length as uint32, compressed length as
+               uint32, compressed bytes), ending with a chunk of length 0
+    trailer    for each section, its offset and raw length (2 x uint64),
+               then the number of sections (uint64) and _MAGIC
+
+Files with a sidecar have format version 2, and their trailer has, for each
+section, its offset, raw length and whether it is in the sidecar (3 x
+uint64), then a random token (16 bytes), the number of sections (uint64)
+and _MAGIC.  The sidecar starts with _SIDECAR_MAGIC and the same token, and
+its buffers are aligned on _SIDECAR_ALIGN bytes.
+
+dataset_from_pickle() recognizes the format of the file from its first
+bytes, so it also reads the gzip-compressed pickles written by earlier
+versions of this module, as well as pickles compressed by the zstd and lz4
+command-line programs and uncompressed pickles.
+
+For data sets too large to hold in memory, RecordWriter and RecordReader
+write and read "record streams": sequences of separately pickled records in
+independently compressed chunks, with an index for random access to chunks.
+
+benchmark() measures the time taken to save and load a data set, and the
+size of the file, with each of the available codecs and with the format
+written by earlier versions of this module.
 '''
 __version__ = '1.0.0'
 __author__  = 'Michael Hucka <mhucka@caltech.edu>'
 __email__   = 'mhucka@caltech.edu'
 __license__ = 'GPLv3'
 
-import os
-import sys
+import bisect
+from   concurrent.futures import ThreadPoolExecutor
 import gzip
+import mmap as mmap_module
+import os
 import pickle
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from   .casicsdb import _sample_entries
+from   .logger import *
+from   .path import full_path
+
+
+# Global constants.
+# .............................................................................
+
+_MAGIC = b'CASICSPK'
+_FORMAT_VERSION = 1
+_SIDECAR_FORMAT_VERSION = 2
+'''Format version of files with an out-of-band sidecar (see below).'''
+
+_HEADER  = struct.Struct('<8sBB6x')
+_CHUNK   = struct.Struct('<II')
+_SECTION = struct.Struct('<QQ')
+_TRAILER = struct.Struct('<Q8s')
+
+_SIDECAR_MAGIC   = b'CASICSMB'
+_SIDECAR_HEADER  = struct.Struct('<8s16s40x')
+_SIDECAR_SECTION = struct.Struct('<QQQ')
+_SIDECAR_TRAILER = struct.Struct('<16sQ8s')
+_SIDECAR_ALIGN   = 64
+
+_CHUNK_SIZE = 4*1024*1024
+'''Number of uncompressed bytes in each chunk.'''
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_LZ4_MAGIC  = b'\x04\x22\x4d\x18'
+
 
-if '__file__' in globals():
-    thisdir = os.path.dirname(os.path.abspath(__file__))
-    sys.path.append(os.path.join(thisdir, '../common'))
-else:
-    sys.path.append('../common')
+# Codecs.
+# .............................................................................
 
-from logger import *
-from utils import full_path
+class _Codec():
+    def __init__(self, name, id, default_level, compress, decompress,
+                 available=True):
+        self.name          = name
+        self.id            = id
+        self.default_level = default_level
+        self.compress      = compress
+        self.decompress    = decompress
+        self.available     = available
 
 
-def dataset_from_pickle(file):
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data, size):
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+
+
+_CODECS = {
+    'none' : _Codec('none', 0, 0, lambda data, level: bytes(data),
+                    lambda data, size: data),
+    'gzip' : _Codec('gzip', 1, 6, zlib.compress,
+                    lambda data, size: zlib.decompress(data, bufsize=size)),
+    'zstd' : _Codec('zstd', 2, 3, _zstd_compress, _zstd_decompress,
+                    zstandard is not None),
+    'lz4'  : _Codec('lz4', 3, 0,
+                    lambda data, level: lz4.frame.compress(data, compression_level=level),
+                    lambda data, size: lz4.frame.decompress(data),
+                    lz4 is not None),
+}
+
+_CODEC_IDS = {codec.id: codec for codec in _CODECS.values()}
+
+
+def available_codecs():
+    '''Returns the names of the codecs that can be used in this installation.'''
+    return [name for (name, codec) in _CODECS.items() if codec.available]
+
+
+def _codec(name):
+    if name is None:
+        name = 'zstd' if zstandard is not None else 'gzip'
+    codec = _CODECS.get(name)
+    if codec is None:
+        raise ValueError('unknown codec "{}"'.format(name))
+    if not codec.available:
+        raise ImportError('codec "{}" requires a package that is not installed'
+                          .format(name))
+    return codec
+
+
+# Main functions.
+# .............................................................................
+
+def dataset_from_pickle(file, threads=None, mmap=True):
     '''Return the contents of the compressed pickle file in 'file'.  The
-    pickle is assumed to contain only one data structure.
+    pickle is assumed to contain only one data structure.  The format is
+    determined from the contents of the file.  Parameter 'threads' is the
+    number of threads used for decompression (default: number of CPUs).
+    If the file has a sidecar (see dataset_to_pickle()), the buffers in it
+    are memory-mapped read-only, or, if 'mmap' is False, read into memory.
     '''
     log = Logger().get_log()
     file = full_path(file)
     try:
         log.debug('reading data set from pickle file {}'.format(file))
-        with gzip.open(file, 'rb') as pickle_file:
-            return pickle.load(pickle_file)
+        with open(file, 'rb') as f:
+            start = f.read(len(_MAGIC))
+            f.seek(0)
+            if start == _MAGIC:
+                return _load(f, threads, mmap)
+            elif start.startswith(_GZIP_MAGIC):
+                with gzip.open(f, 'rb') as pickle_file:
+                    return pickle.load(pickle_file)
+            elif start.startswith(_ZSTD_MAGIC):
+                _codec('zstd')
+                with zstandard.ZstdDecompressor().stream_reader(f) as pickle_file:
+                    return pickle.load(pickle_file)
+            elif start.startswith(_LZ4_MAGIC):
+                _codec('lz4')
+                with lz4.frame.open(f, 'rb') as pickle_file:
+                    return pickle.load(pickle_file)
+            else:
+                return pickle.load(f)
     except pickle.PickleError as err:
         log.error('unpickle failed for {}'.format(file))
         log.error(err)
         return ({}, None)
 
 
-def dataset_to_pickle(file, data_set):
+def dataset_to_pickle(file, data_set, codec=None, level=None, threads=None,
+                      mmap_threshold=None):
     '''Save the contents of 'data_set' to the compressed pickle file 'file'.
-    The pickle is assumed to contain only one data structure.
+    The pickle is assumed to contain only one data structure.  Parameter
+    'codec' is one of the names in available_codecs() (default: 'zstd' if
+    available, else 'gzip'), 'level' is the compression level (default:
+    the codec's own default), and 'threads' is the number of threads used
+    for compression (default: number of CPUs).  If 'mmap_threshold' is
+    given, out-of-band buffers of at least that many bytes are written
+    uncompressed to a sidecar file (named like 'file' plus ".oob"), so that
+    dataset_from_pickle() can map them into memory instead of reading them.
     '''
     log = Logger().get_log()
     file = full_path(file)
+    codec = _codec(codec)
+    if level is None:
+        level = codec.default_level
     try:
-        log.debug('saving data set to pickle file {}'.format(file))
-        with gzip.open(file, 'wb') as pickle_file:
-            pickle.dump(data_set, pickle_file)
+        log.debug('saving data set to pickle file {} using {}'.format(file, codec.name))
+        with open(file, 'wb') as pickle_file:
+            _dump(pickle_file, data_set, codec, level, threads, mmap_threshold)
     except IOError as err:
         log.error('encountered error trying to dump pickle {}'.format(file))
         log.error(err)
     except pickle.PickleError as err:
         log.error('pickling error for {}'.format(file))
         log.error(err)
+
+
+# Writing.
+# .............................................................................
+
+def _dump(file, data_set, codec, level, threads, mmap_threshold=None):
+    file.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION, codec.id))
+    sections = []
+    buffers = []
+    sidecar = None
+    try:
+        with _ChunkWriter(file, codec, level, threads) as writer:
+            pickle.Pickler(writer, protocol=5,
+                           buffer_callback=buffers.append).dump(data_set)
+            sections.append(writer.end_section() + (False,))
+            for buffer in buffers:
+                with buffer.raw() as data:
+                    if mmap_threshold is not None and len(data) >= mmap_threshold:
+                        if sidecar is None:
+                            sidecar = _SidecarWriter(file.name)
+                        sections.append((sidecar.write(data), len(data), True))
+                    else:
+                        writer.write(data)
+                        sections.append(writer.end_section() + (False,))
+        if sidecar is None:
+            for (offset, size, external) in sections:
+                file.write(_SECTION.pack(offset, size))
+            file.write(_TRAILER.pack(len(sections), _MAGIC))
+            _remove_sidecar(file.name)
+        else:
+            for (offset, size, external) in sections:
+                file.write(_SIDECAR_SECTION.pack(offset, size, external))
+            file.write(_SIDECAR_TRAILER.pack(sidecar.token, len(sections), _MAGIC))
+            file.seek(0)
+            file.write(_HEADER.pack(_MAGIC, _SIDECAR_FORMAT_VERSION, codec.id))
+            sidecar.close()
+    except BaseException:
+        if sidecar is not None:
+            sidecar.abort()
+        raise
+
+
+class _SidecarWriter():
+    # Writes buffers uncompressed to a temporary file, renamed to the
+    # sidecar file name by close().  The header holds a random token, also
+    # recorded in the main file, to detect mismatched pairs of files.
+
+    def __init__(self, path):
+        self.path  = _sidecar_path(path)
+        self.token = os.urandom(16)
+        self.file  = open(self.path + '.tmp', 'wb')
+        self.file.write(_SIDECAR_HEADER.pack(_SIDECAR_MAGIC, self.token))
+
+
+    def write(self, data):
+        position = self.file.tell()
+        padding = -position % _SIDECAR_ALIGN
+        self.file.write(bytes(padding))
+        self.file.write(data)
+        return position + padding
+
+
+    def close(self):
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+
+    def abort(self):
+        # Removes the temporary file, if it is still there.
+        self.file.close()
+        try:
+            os.unlink(self.path + '.tmp')
+        except FileNotFoundError:
+            pass
+
+
+def _sidecar_path(path):
+    return path + '.oob'
+
+
+def _remove_sidecar(path):
+    # A sidecar left from an earlier version of the file would be stale.
+    try:
+        os.unlink(_sidecar_path(path))
+    except FileNotFoundError:
+        pass
+
+
+class _ChunkWriter():
+    # File-like object that cuts what is written to it into chunks and
+    # compresses them, in parallel if there is more than one thread.  At
+    # most 2 chunks per thread are waiting to be written at any time.
+
+    def __init__(self, file, codec, level, threads):
+        self.file      = file
+        self.codec     = codec
+        self.level     = level
+        self.threads   = threads or os.cpu_count() or 1
+        self.executor  = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        self.pending   = []
+        self.buffer    = bytearray()
+        self.start     = file.tell()
+        self.size      = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.executor:
+            self.executor.shutdown(wait=True)
+
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self.size += len(data)
+        if self.buffer:
+            room = _CHUNK_SIZE - len(self.buffer)
+            self.buffer += data[:room]
+            data = data[room:]
+            if len(self.buffer) < _CHUNK_SIZE:
+                return
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while len(data) >= _CHUNK_SIZE:
+            self._submit(data[:_CHUNK_SIZE])
+            data = data[_CHUNK_SIZE:]
+        self.buffer += data
+
+
+    def end_section(self):
+        '''Writes out everything and returns the (offset, raw size) of the
+        section just ended.'''
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        self._drain(0)
+        self.file.write(_CHUNK.pack(0, 0))
+        section = (self.start, self.size)
+        self.start = self.file.tell()
+        self.size = 0
+        return section
+
+
+    def _submit(self, chunk):
+        if self.executor:
+            self.pending.append((len(chunk), self.executor.submit(
+                self.codec.compress, chunk, self.level)))
+            self._drain(2*self.threads)
+        else:
+            self._write_chunk(len(chunk), self.codec.compress(chunk, self.level))
+
+
+    def _drain(self, limit):
+        while len(self.pending) > limit:
+            (size, future) = self.pending.pop(0)
+            self._write_chunk(size, future.result())
+
+
+    def _write_chunk(self, size, data):
+        self.file.write(_CHUNK.pack(size, len(data)))
+        self.file.write(data)
+
+
+# Reading.
+# .............................................................................
+
+def _load(file, threads, mmap=True):
+    (magic, version, codec_id) = _HEADER.unpack(file.read(_HEADER.size))
+    if version > _SIDECAR_FORMAT_VERSION:
+        raise pickle.UnpicklingError('unsupported file format version {}'
+                                     .format(version))
+    codec = _CODEC_IDS.get(codec_id)
+    if codec is None:
+        raise pickle.UnpicklingError('unknown codec id {}'.format(codec_id))
+    _codec(codec.name)
+    if version == _SIDECAR_FORMAT_VERSION:
+        (sections, sidecar) = _read_sidecar_trailer(file, mmap)
+    else:
+        sections = [section + (False,) for section in _read_trailer(file)]
+        sidecar = None
+    threads = threads or os.cpu_count() or 1
+    with ThreadPoolExecutor(threads) as executor:
+        buffers = (pickle.PickleBuffer(sidecar[offset:offset + size]) if external
+                   else _read_buffer(file, offset, size, codec, executor, threads)
+                   for (offset, size, external) in sections[1:])
+        file.seek(sections[0][0])
+        reader = _ChunkReader(_chunks(file, codec, executor, threads))
+        return pickle.Unpickler(reader, buffers=buffers).load()
+
+
+def _read_trailer(file):
+    file.seek(-_TRAILER.size, os.SEEK_END)
+    (count, magic) = _TRAILER.unpack(file.read(_TRAILER.size))
+    if magic != _MAGIC:
+        raise pickle.UnpicklingError('file is truncated or corrupted')
+    file.seek(-_TRAILER.size - count*_SECTION.size, os.SEEK_END)
+    data = file.read(count*_SECTION.size)
+    return [_SECTION.unpack_from(data, i*_SECTION.size) for i in range(count)]
+
+
+def _read_sidecar_trailer(file, mmap):
+    # Returns the (offset, size, external) sections of a file with a
+    # sidecar, and a memoryview of the whole sidecar.
+    file.seek(-_SIDECAR_TRAILER.size, os.SEEK_END)
+    (token, count, magic) = _SIDECAR_TRAILER.unpack(file.read(_SIDECAR_TRAILER.size))
+    if magic != _MAGIC:
+        raise pickle.UnpicklingError('file is truncated or corrupted')
+    file.seek(-_SIDECAR_TRAILER.size - count*_SIDECAR_SECTION.size, os.SEEK_END)
+    data = file.read(count*_SIDECAR_SECTION.size)
+    sections = [_SIDECAR_SECTION.unpack_from(data, i*_SIDECAR_SECTION.size)
+                for i in range(count)]
+    path = _sidecar_path(file.name)
+    with open(path, 'rb') as f:
+        if mmap:
+            sidecar = memoryview(mmap_module.mmap(f.fileno(), 0,
+                                                  access=mmap_module.ACCESS_READ))
+        else:
+            sidecar = memoryview(bytearray(f.read()))
+    (magic, sidecar_token) = _SIDECAR_HEADER.unpack_from(sidecar)
+    if magic != _SIDECAR_MAGIC or sidecar_token != token:
+        raise pickle.UnpicklingError('{} does not belong to {}'.format(path, file.name))
+    return (sections, sidecar)
+
+
+def _read_buffer(file, offset, size, codec, executor, threads):
+    # Reads an out-of-band buffer through a separate file object, since the
+    # unpickler is in the middle of reading the pickle from 'file'.
+    buffer = bytearray(size)
+    position = 0
+    with open(file.name, 'rb') as f:
+        f.seek(offset)
+        for chunk in _chunks(f, codec, executor, threads):
+            buffer[position:position + len(chunk)] = chunk
+            position += len(chunk)
+    return pickle.PickleBuffer(buffer)
+
+
+def _chunks(file, codec, executor, threads):
+    # Generator over the decompressed chunks of the section starting at the
+    # current position of 'file', decompressing up to 2 chunks per thread
+    # ahead of the consumer.
+    pending = []
+    while True:
+        (size, compressed_size) = _CHUNK.unpack(file.read(_CHUNK.size))
+        if size == 0:
+            break
+        data = file.read(compressed_size)
+        pending.append(executor.submit(codec.decompress, data, size))
+        if len(pending) > 2*threads:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+class _ChunkReader():
+    # File-like object for pickle.Unpickler over a series of chunks.
+
+    def __init__(self, chunks):
+        self.chunks   = chunks
+        self.data     = b''
+        self.position = 0
+
+
+    def read(self, size=-1):
+        if size < 0:
+            parts = [self.data[self.position:]] + list(self.chunks)
+            self.data = b''
+            self.position = 0
+            return b''.join(parts)
+        if self.position + size <= len(self.data):
+            self.position += size
+            return self.data[self.position - size:self.position]
+        parts = [self.data[self.position:]]
+        needed = size - len(parts[0])
+        while needed > 0:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            if len(chunk) > needed:
+                parts.append(chunk[:needed])
+                self.data = chunk
+                self.position = needed
+                return b''.join(parts)
+            parts.append(chunk)
+            needed -= len(chunk)
+        self.data = b''
+        self.position = 0
+        return b''.join(parts)
+
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+    def readline(self):
+        parts = []
+        while True:
+            end = self.data.find(b'\n', self.position)
+            if end >= 0:
+                parts.append(self.data[self.position:end + 1])
+                self.position = end + 1
+                return b''.join(parts)
+            parts.append(self.data[self.position:])
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.data = b''
+                self.position = 0
+                return b''.join(parts)
+            self.data = chunk
+            self.position = 0
+
+
+# Record streams.
+# .............................................................................
+# dataset_to_pickle() and dataset_from_pickle() handle one data structure,
+# which must fit in memory.  Record streams hold a sequence of records
+# (e.g., repo entries) instead, written and read one at a time, so their
+# size is not limited by memory.  Records are pickled one by one (or encoded
+# by another serializer, such as repo_codec) and grouped into chunks of
+# about _CHUNK_SIZE bytes, each compressed independently.  File layout:
+#
+#    header    _STREAM_MAGIC, format version (1 byte), codec id (1 byte),
+#              6 zeros
+#    chunks    raw length, compressed length and number of records (3 x
+#              uint32), then the compressed bytes, which are the records,
+#              each preceded by its length (uint32)
+#
+# A sidecar file, with the name of the stream plus ".idx", records the
+# offset of each chunk and the number of the first record in it, so that
+# RecordReader can go directly to any chunk.  If the index is missing or
+# out of date, it is rebuilt by skipping from chunk header to chunk header,
+# which does not involve decompressing anything.  Streams can be appended
+# to; if the last chunk of a stream was left incomplete (e.g., because the
+# writer was killed), it is removed when the stream is opened for appending.
+# Example of use:
+#
+#    with RecordWriter('entries.rs') as writer:
+#        for entry in iter_repos(db.repos):
+#            writer.write(entry)
+#    ...
+#    for entry in RecordReader('entries.rs'):
+#        ...
+
+_STREAM_MAGIC = b'CASICSRS'
+_INDEX_MAGIC  = b'CASICSRI'
+
+_RECORD_CHUNK = struct.Struct('<III')
+_RECORD_SIZE  = struct.Struct('<I')
+_INDEX_ENTRY  = struct.Struct('<QQ')
+_INDEX_HEADER = struct.Struct('<8sQQ')
+
+
+class RecordWriter():
+    def __init__(self, file, codec=None, level=None, append=False,
+                 serializer=pickle, index=True, threads=None):
+        '''Opens the record stream 'file' for writing, replacing it, or, if
+        'append' is True and the file exists, adding to it (in which case
+        the codec of the file is used).  Parameters 'codec', 'level' and
+        'threads' are as for dataset_to_pickle().  'serializer' is a module
+        or object with dumps() and loads() functions, such as pickle.  If
+        'index' is True, the index sidecar file is written by close().'''
+        self.path       = full_path(file)
+        self.serializer = serializer
+        self.level      = level
+        self.index      = index
+        self.chunks     = []           # (offset, first record) of each chunk
+        self.count      = 0            # records, including earlier ones
+        self.written    = 0            # records in the chunks in the file
+        self.buffer     = bytearray()
+        self.buffered   = 0            # records in self.buffer
+        self.pending    = []
+        if append and os.path.exists(self.path):
+            (codec_id, self.chunks, self.count, end) = _scan_stream(self.path)
+            self.written = self.count
+            self.codec = _codec(_CODEC_IDS[codec_id].name)
+            self.file = open(self.path, 'r+b')
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.codec = _codec(codec)
+            self.file = open(self.path, 'wb')
+            self.file.write(_HEADER.pack(_STREAM_MAGIC, _FORMAT_VERSION,
+                                         self.codec.id))
+        if self.level is None:
+            self.level = self.codec.default_level
+        self.threads  = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def __len__(self):
+        return self.count
+
+
+    def write(self, record):
+        '''Adds 'record' to the stream.'''
+        data = self.serializer.dumps(record)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer += _RECORD_SIZE.pack(len(data))
+        self.buffer += data
+        self.buffered += 1
+        self.count += 1
+        if len(self.buffer) >= _CHUNK_SIZE:
+            self._end_chunk()
+
+
+    def write_all(self, records):
+        '''Adds each of 'records' to the stream.'''
+        for record in records:
+            self.write(record)
+
+
+    def flush(self):
+        '''Writes out the records written so far, ending the current chunk.'''
+        if self.buffered:
+            self._end_chunk()
+        self._drain(0)
+        self.file.flush()
+
+
+    def close(self):
+        '''Writes out everything, closes the stream and writes its index.'''
+        if self.file.closed:
+            return
+        self.flush()
+        if self.executor:
+            self.executor.shutdown(wait=True)
+        size = self.file.tell()
+        self.file.close()
+        if self.index:
+            _write_index(self.path, size, self.chunks, self.written)
+
+
+    def _end_chunk(self):
+        (data, count) = (bytes(self.buffer), self.buffered)
+        self.buffer = bytearray()
+        self.buffered = 0
+        if self.executor:
+            future = self.executor.submit(self.codec.compress, data, self.level)
+            self.pending.append((len(data), count, future))
+            self._drain(2*self.threads)
+        else:
+            self._write_chunk(len(data), count, self.codec.compress(data, self.level))
+
+
+    def _drain(self, limit):
+        while len(self.pending) > limit:
+            (size, count, future) = self.pending.pop(0)
+            self._write_chunk(size, count, future.result())
+
+
+    def _write_chunk(self, size, count, data):
+        self.chunks.append((self.file.tell(), self.written))
+        self.file.write(_RECORD_CHUNK.pack(size, len(data), count))
+        self.file.write(data)
+        self.written += count
+
+
+class RecordReader():
+    def __init__(self, file, serializer=pickle, threads=None):
+        '''Opens the record stream 'file' for reading.  Parameter 'serializer'
+        must be the one used to write the stream, and 'threads' is the
+        number of threads used for decompression.'''
+        self.path       = full_path(file)
+        self.serializer = serializer
+        self.threads    = threads or os.cpu_count() or 1
+        index = _read_index(self.path)
+        if index:
+            (codec_id, self.chunks, self.count) = index
+        else:
+            (codec_id, self.chunks, self.count, end) = _scan_stream(self.path)
+        self.codec = _codec(_CODEC_IDS[codec_id].name)
+
+
+    def __len__(self):
+        '''Returns the number of records in the stream.'''
+        return self.count
+
+
+    def __iter__(self):
+        return self.records()
+
+
+    @property
+    def num_chunks(self):
+        return len(self.chunks)
+
+
+    def chunk(self, number):
+        '''Returns the list of records in chunk 'number' (counting from 0).'''
+        with open(self.path, 'rb') as f:
+            f.seek(self.chunks[number][0])
+            return self._decode(self._read_chunk(f)())
+
+
+    def record(self, number):
+        '''Returns record 'number' (counting from 0), reading only the chunk
+        that contains it.'''
+        if not 0 <= number < self.count:
+            raise IndexError('record number {} out of range'.format(number))
+        starts = [first for (offset, first) in self.chunks]
+        chunk = bisect.bisect_right(starts, number) - 1
+        return self.chunk(chunk)[number - starts[chunk]]
+
+
+    def records(self, start_chunk=0):
+        '''Generator over the records, starting with chunk 'start_chunk'.
+        Chunks are decompressed ahead of use by a pool of threads.'''
+        if start_chunk >= len(self.chunks):
+            return
+        with open(self.path, 'rb') as f, ThreadPoolExecutor(self.threads) as executor:
+            f.seek(self.chunks[start_chunk][0])
+            pending = []
+            for _ in range(start_chunk, len(self.chunks)):
+                pending.append(executor.submit(self._read_chunk(f)))
+                if len(pending) > 2*self.threads:
+                    yield from self._decode(pending.pop(0).result())
+            for future in pending:
+                yield from self._decode(future.result())
+
+
+    def _read_chunk(self, file):
+        # Reads the next chunk from 'file' and returns a function that
+        # decompresses it, to be called here or in another thread.
+        (size, compressed_size, count) = _RECORD_CHUNK.unpack(
+            file.read(_RECORD_CHUNK.size))
+        data = file.read(compressed_size)
+        return lambda: self.codec.decompress(data, size)
+
+
+    def _decode(self, data):
+        records = []
+        position = 0
+        while position < len(data):
+            (size,) = _RECORD_SIZE.unpack_from(data, position)
+            position += _RECORD_SIZE.size
+            records.append(self.serializer.loads(data[position:position + size]))
+            position += size
+        return records
+
+
+def write_records(file, records, **kwargs):
+    '''Writes 'records' to the record stream 'file'.  Keyword arguments are
+    passed to RecordWriter().'''
+    with RecordWriter(file, **kwargs) as writer:
+        writer.write_all(records)
+
+
+def read_records(file, **kwargs):
+    '''Generator over the records in the record stream 'file'.  Keyword
+    arguments are passed to RecordReader().'''
+    return iter(RecordReader(file, **kwargs))
+
+
+def _scan_stream(path):
+    # Returns the codec id, the list of (offset, first record) of the
+    # complete chunks in the stream, the number of records and the offset
+    # of the end of the last complete chunk.
+    chunks = []
+    count = 0
+    with open(path, 'rb') as f:
+        (magic, version, codec_id) = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != _STREAM_MAGIC:
+            raise ValueError('{} is not a record stream'.format(path))
+        size = os.fstat(f.fileno()).st_size
+        offset = f.tell()
+        while offset + _RECORD_CHUNK.size <= size:
+            (raw, compressed_size, records) = _RECORD_CHUNK.unpack(
+                f.read(_RECORD_CHUNK.size))
+            end = offset + _RECORD_CHUNK.size + compressed_size
+            if end > size:
+                break
+            chunks.append((offset, count))
+            count += records
+            offset = end
+            f.seek(offset)
+    return (codec_id, chunks, count, offset)
+
+
+def _index_path(path):
+    return path + '.idx'
+
+
+def _write_index(path, size, chunks, count):
+    tmp_path = _index_path(path) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, size, count))
+        for (offset, first) in chunks:
+            f.write(_INDEX_ENTRY.pack(offset, first))
+    os.replace(tmp_path, _index_path(path))
+
+
+def _read_index(path):
+    # Returns (codec id, chunks, count) from the index, or None if there is
+    # no index or it does not describe the current contents of the stream.
+    try:
+        with open(_index_path(path), 'rb') as f:
+            data = f.read()
+        with open(path, 'rb') as f:
+            (magic, version, codec_id) = _HEADER.unpack(f.read(_HEADER.size))
+            size = os.fstat(f.fileno()).st_size
+    except FileNotFoundError:
+        return None
+    if len(data) < _INDEX_HEADER.size:
+        return None
+    (magic, indexed_size, count) = _INDEX_HEADER.unpack_from(data)
+    if magic != _INDEX_MAGIC or indexed_size != size:
+        return None
+    chunks = [_INDEX_ENTRY.unpack_from(data, position) for position
+              in range(_INDEX_HEADER.size, len(data), _INDEX_ENTRY.size)]
+    return (codec_id, chunks, count)
+
+
+# Benchmarking.
+# .............................................................................
+
+def benchmark(data_set=None, codecs=None, threads=None, mmap_threshold=None,
+              directory=None, num_entries=100000):
+    '''Saves and loads 'data_set' with each codec in 'codecs' (default: all
+    available codecs) and with the gzip pickles written by earlier versions
+    of this module ("old gzip"), and measures the times taken and the file
+    sizes.  If 'data_set' is None, a list of 'num_entries' entries made by
+    casicsdb.repo_entry(), with a mix of sentinel and actual values, is
+    used.  Parameters 'threads' and 'mmap_threshold' are passed to
+    dataset_to_pickle().  The files are written in 'directory' (default: a
+    temporary directory) and deleted afterward.  Returns a list of tuples
+    (format, save time in seconds, load time in seconds, file size in
+    bytes).
+    '''
+    if data_set is None:
+        data_set = _sample_entries(num_entries)
+    if codecs is None:
+        codecs = available_codecs()
+    tmp_dir = tempfile.mkdtemp(dir=directory)
+    results = []
+    try:
+        file = os.path.join(tmp_dir, 'old.pickle')
+        start = time.perf_counter()
+        with gzip.open(file, 'wb') as pickle_file:
+            pickle.dump(data_set, pickle_file)
+        results.append(('old gzip',) + _time_load(file, start, threads))
+        for name in codecs:
+            file = os.path.join(tmp_dir, name + '.pickle')
+            start = time.perf_counter()
+            dataset_to_pickle(file, data_set, codec=name, threads=threads,
+                              mmap_threshold=mmap_threshold)
+            results.append((name,) + _time_load(file, start, threads))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+
+def _time_load(file, start, threads):
+    # Returns (save time, load time, size) for a file whose saving began at
+    # time 'start' and has just finished.
+    save_time = time.perf_counter() - start
+    size = os.path.getsize(file)
+    if os.path.exists(_sidecar_path(file)):
+        size += os.path.getsize(_sidecar_path(file))
+    start = time.perf_counter()
+    dataset_from_pickle(file, threads=threads)
+    return (save_time, time.perf_counter() - start, size)
@@ -0,0 +1,338 @@
+# -*- python-indent-offset: 4 -*-
+'''
+facet_index: local inverted index of categorical fields of repo entries.
+
+Exploratory analyses tend to ask many faceted questions of the database,
+such as "how many repos use Python or Java, have an MIT license, and are
+not libraries?", followed by the same question broken down by language.
+Each such question is a round-trip to the server and a scan of an index or
+of the collection.  FacetIndex answers them locally: it holds, for every
+value of the fields listed in _FACETS (a "term", such as ('languages',
+'Python')), the set of ids of the repos having that value.  The sets are
+Postings objects, which support the operators & (and), | (or) and - (and
+not), and are stored in the compressed layout of "roaring bitmaps"
+(https://roaringbitmap.org): ids are grouped by their upper bits into
+containers of 65536 ids each, and a container is kept either as a sorted
+array of 16-bit numbers (when it has few ids) or as a 65536-bit bitmap
+(when it has many).  Operations on bitmap containers are done by Python's
+arbitrary-precision integer arithmetic, 64 bits at a time, in C.
+Example of use:
+
+    index = facet_index_from_db(db.repos)
+    index.save('facets.idx')
+    ...
+    index = FacetIndex.load('facets.idx')
+    hits = ((index.term('languages', 'Python') | index.term('languages', 'Java'))
+            & index.term('licenses', 'MIT')) - index.term('kind', 'library')
+    print(len(hits), index.counts('languages', within=hits))
+
+The sentinel value -1 (meaning "we looked, and there is none") is indexed
+like any other value, so index.term('languages', -1) is the set of repos
+known to have no language information.
+'''
+__version__ = '1.0.0'
+__author__  = 'Michael Hucka <mhucka@caltech.edu>'
+__email__   = 'mhucka@caltech.edu'
+__license__ = 'GPLv3'
+
+from   array import array
+from   bisect import bisect_left
+import gzip
+import pickle
+
+from   .casicsdb import iter_repos, e_languages
+
+
+# Global constants.
+# .............................................................................
+
+_FACETS = ['languages', 'licenses', 'kind', 'interfaces', 'topics']
+'''Fields indexed by default.  Topics are indexed by ontology, so the terms
+for them look like ('topics.lcsh', 'sh85133180').'''
+
+_CONTAINER_BITS = 16
+_CONTAINER_SIZE = 1 << _CONTAINER_BITS
+_LOW_MASK       = _CONTAINER_SIZE - 1
+_ALL_BITS       = (1 << _CONTAINER_SIZE) - 1
+
+_MAX_ARRAY = 4096
+'''Containers with more ids than this are stored as bitmaps.  At 4096 ids,
+an array of 16-bit numbers and a bitmap take the same space (8 KB).'''
+
+
+# Sets of ids.
+# .............................................................................
+
+class Postings():
+    '''A set of non-negative integer ids in roaring bitmap layout.'''
+
+    def __init__(self, containers=None):
+        self.containers = containers or {}
+
+
+    @classmethod
+    def from_ids(cls, ids):
+        '''Creates a Postings object from an iterable of ids.'''
+        groups = {}
+        for id in ids:
+            groups.setdefault(id >> _CONTAINER_BITS, set()).add(id & _LOW_MASK)
+        return cls({high: _container(lows) for (high, lows) in groups.items()})
+
+
+    def __len__(self):
+        return sum(len(c) if isinstance(c, array) else c.bit_count()
+                   for c in self.containers.values())
+
+
+    def __bool__(self):
+        return bool(self.containers)
+
+
+    def __contains__(self, id):
+        container = self.containers.get(id >> _CONTAINER_BITS)
+        if container is None:
+            return False
+        low = id & _LOW_MASK
+        if isinstance(container, array):
+            # Array containers are sorted.
+            position = bisect_left(container, low)
+            return position < len(container) and container[position] == low
+        return bool((container >> low) & 1)
+
+
+    def __iter__(self):
+        '''Iterates over the ids in ascending order.'''
+        for high in sorted(self.containers):
+            base = high << _CONTAINER_BITS
+            for low in _lows(self.containers[high]):
+                yield base + low
+
+
+    def __and__(self, other):
+        result = {}
+        for high in self.containers.keys() & other.containers.keys():
+            (a, b) = (self.containers[high], other.containers[high])
+            if isinstance(a, array) and isinstance(b, array):
+                container = _container(set(a).intersection(b))
+            else:
+                container = _normalized(_bits(a) & _bits(b))
+            if container is not None:
+                result[high] = container
+        return Postings(result)
+
+
+    def __or__(self, other):
+        result = dict(self.containers)
+        for (high, b) in other.containers.items():
+            a = result.get(high)
+            if a is None:
+                result[high] = b
+            elif isinstance(a, array) and isinstance(b, array):
+                result[high] = _container(set(a).union(b))
+            else:
+                result[high] = _normalized(_bits(a) | _bits(b))
+        return Postings(result)
+
+
+    def __sub__(self, other):
+        result = {}
+        for (high, a) in self.containers.items():
+            b = other.containers.get(high)
+            if b is None:
+                result[high] = a
+                continue
+            if isinstance(a, array) and isinstance(b, array):
+                container = _container(set(a).difference(b))
+            else:
+                container = _normalized(_bits(a) & (_bits(b) ^ _ALL_BITS))
+            if container is not None:
+                result[high] = container
+        return Postings(result)
+
+
+    def __eq__(self, other):
+        return (isinstance(other, Postings)
+                and self.containers.keys() == other.containers.keys()
+                and all(_bits(c) == _bits(other.containers[high])
+                        for (high, c) in self.containers.items()))
+
+
+    def __repr__(self):
+        return 'Postings({} ids)'.format(len(self))
+
+
+    def nbytes(self):
+        '''Returns the approximate number of bytes used by the containers.'''
+        return sum(len(c)*2 if isinstance(c, array) else _CONTAINER_SIZE//8
+                   for c in self.containers.values())
+
+
+# Facet index.
+# .............................................................................
+
+class FacetIndex():
+    def __init__(self, postings, universe):
+        '''Creates an index from a dictionary mapping terms, i.e., (field,
+        value) tuples, to Postings objects, and a Postings object of all the
+        ids indexed.  Use build_facet_index(), facet_index_from_db() or
+        FacetIndex.load() rather than calling this directly.'''
+        self.postings = postings
+        self.universe = universe
+
+
+    def __len__(self):
+        return len(self.universe)
+
+
+    def term(self, field, value):
+        '''Returns the Postings for repos whose 'field' has the given value.'''
+        return self.postings.get((field, value), Postings())
+
+
+    def values(self, field):
+        '''Returns the list of values of 'field' that occur in the index.'''
+        return [value for (name, value) in self.postings if name == field]
+
+
+    def all_of(self, *terms):
+        '''Returns the repos having every one of the given (field, value)
+        terms.  Starts with the smallest set, so the work done is bounded by
+        its size.'''
+        sets = sorted((self.term(*t) for t in terms), key=len)
+        if not sets:
+            return self.universe
+        result = sets[0]
+        for other in sets[1:]:
+            if not result:
+                break
+            result = result & other
+        return result
+
+
+    def any_of(self, *terms):
+        '''Returns the repos having at least one of the given terms.'''
+        result = Postings()
+        for t in terms:
+            result = result | self.term(*t)
+        return result
+
+
+    def none_of(self, *terms):
+        '''Returns the repos having none of the given terms.'''
+        return self.universe - self.any_of(*terms)
+
+
+    def counts(self, field, within=None):
+        '''Returns a dictionary mapping each value of 'field' to the number of
+        repos having it (among the repos in 'within', if given), sorted from
+        most to least common.'''
+        totals = {}
+        for ((name, value), postings) in self.postings.items():
+            if name == field:
+                count = len(postings & within if within is not None else postings)
+                if count:
+                    totals[value] = count
+        return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+
+    def save(self, path):
+        '''Writes the index to a compressed file at 'path'.'''
+        with gzip.open(path, 'wb', compresslevel=1) as f:
+            pickle.dump((self.postings, self.universe), f,
+                        pickle.HIGHEST_PROTOCOL)
+
+
+    @classmethod
+    def load(cls, path):
+        '''Reads an index written by save().'''
+        with gzip.open(path, 'rb') as f:
+            (postings, universe) = pickle.load(f)
+        return cls(postings, universe)
+
+
+# Building indexes.
+# .............................................................................
+
+def entry_terms(entry, facets=_FACETS):
+    '''Returns the list of (field, value) terms for 'entry'.'''
+    terms = []
+    for field in facets:
+        value = entry.get(field)
+        if field == 'languages':
+            value = e_languages(entry) if field in entry else []
+        if field == 'topics' and isinstance(value, dict):
+            for (ontology, labels) in value.items():
+                terms += [('topics.' + ontology, label) for label in labels or []]
+        elif value == -1:
+            terms.append((field, -1))
+        elif isinstance(value, list):
+            terms += [(field, item) for item in value if isinstance(item, str)]
+    return terms
+
+
+def build_facet_index(entries, facets=_FACETS):
+    '''Builds a FacetIndex from an iterable of entries, which need only
+    have the '_id' field and the fields in 'facets'.'''
+    ids = {}
+    everything = []
+    for entry in entries:
+        id = entry['_id']
+        everything.append(id)
+        for term in entry_terms(entry, facets):
+            ids.setdefault(term, []).append(id)
+    return FacetIndex({term: Postings.from_ids(values)
+                       for (term, values) in ids.items()},
+                      Postings.from_ids(everything))
+
+
+def facet_index_from_db(collection, query=None, facets=_FACETS):
+    '''Builds a FacetIndex from the entries in 'collection' matching 'query'.'''
+    return build_facet_index(iter_repos(collection, query, fields=facets),
+                             facets)
+
+
+# Helpers.
+# .............................................................................
+
+def _container(lows):
+    # Returns the best container for a set of 16-bit numbers, or None.
+    if not lows:
+        return None
+    if len(lows) <= _MAX_ARRAY:
+        return array('H', sorted(lows))
+    bitmap = bytearray(_CONTAINER_SIZE//8)
+    for low in lows:
+        bitmap[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(bitmap, 'little')
+
+
+def _bits(container):
+    # Returns a container as a bitmap (an int).
+    if not isinstance(container, array):
+        return container
+    bitmap = bytearray(_CONTAINER_SIZE//8)
+    for low in container:
+        bitmap[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(bitmap, 'little')
+
+
+def _normalized(bits):
+    # Returns a bitmap as the best container for its contents, or None.
+    if not bits:
+        return None
+    if bits.bit_count() <= _MAX_ARRAY:
+        return array('H', _lows(bits))
+    return bits
+
+
+def _lows(container):
+    # Returns the 16-bit numbers in a container, in ascending order.
+    if isinstance(container, array):
+        return container
+    lows = []
+    data = container.to_bytes(_CONTAINER_SIZE//8, 'little')
+    for (i, byte) in enumerate(data):
+        if byte:
+            base = i << 3
+            lows += [base + bit for bit in range(8) if byte >> bit & 1]
+    return lows
@@ -0,0 +1,353 @@
+# -*- python-indent-offset: 4 -*-
+'''
+file_store: content-addressed store for mirrored repository files.
+
+Mirrored repos are kept in directories named by generate_path() (see the
+module path), but many repos, forks especially, contain the same files, and
+storing each copy separately wastes disk space and I/O.  FileStore keeps the
+contents of every file once, as a "blob" named by the SHA-256 hash of its
+contents, in the directory '.objects' under the root of the mirror.  For each
+repo, the directory generate_path(root, id) holds a manifest (the file
+named by _MANIFEST) listing the relative path, hash, size and executable
+flag of every file of the repo.  In 'link' mode (the default), the directory
+also holds the files themselves, as hard links to the blobs, so that tools
+that read the mirror directly keep working; in 'manifest' mode, it holds
+only the manifest, and files are read with open() or written out with
+checkout().  Example of use:
+
+    store = FileStore('/data/mirror')
+    with tarfile.open(tarball) as tar:
+        store.ingest(7182480, ((m.name, tar.extractfile(m), m.mode & 0o100)
+                               for m in tar if m.isfile()))
+    ...
+    with store.open(7182480, 'README.md') as f:
+        text = f.read()
+
+Files are streamed into the store, so they need not fit in memory.  Blobs
+are read-only, and because the files of repos in 'link' mode are links to
+them, those files must not be modified in place.  Executable files are the
+exception: they are written as copies with mode 0755 (in 'link' mode and
+by checkout()), since links share the permissions of the blob; other
+permissions are not preserved.  Blobs no longer listed by any manifest
+(after remove() or after ingesting a new version of a repo) are deleted by
+gc(), which also removes what interrupted ingests left behind.  Ingesting
+holds a shared lock and gc() an exclusive one, so gc() never deletes a blob
+that an ingest in another process is about to reference.
+'''
+__version__ = '1.0.0'
+__author__  = 'Michael Hucka <mhucka@caltech.edu>'
+__email__   = 'mhucka@caltech.edu'
+__license__ = 'GPLv3'
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+from   .cache import atomic_write, file_lock
+from   .path import generate_path, iter_repo_ids
+
+
+# Global constants.
+# .............................................................................
+
+_OBJECTS_DIR = '.objects'
+'''Directory under the root of the store holding the blobs.'''
+
+_MANIFEST = '.casics_manifest.json'
+'''Name of the manifest file in each repo directory.'''
+
+_LOCK_FILE = '.lock'
+
+_READ_SIZE = 1024*1024
+'''Size of the pieces in which files are read while being stored.'''
+
+_MODES = ['link', 'manifest']
+
+
+# Main class.
+# .............................................................................
+
+class FileStore():
+    def __init__(self, root, mode='link'):
+        '''Opens (creating it if needed) the store whose repo directories are
+        at generate_path(root, id).  'mode' is 'link' or 'manifest' (see the
+        module documentation); it applies to repos ingested from now on.'''
+        if mode not in _MODES:
+            raise ValueError('unknown mode "{}"'.format(mode))
+        self.root     = root
+        self.mode     = mode
+        self.objects  = os.path.join(root, _OBJECTS_DIR)
+        self.lock     = os.path.join(self.objects, _LOCK_FILE)
+        os.makedirs(self.objects, exist_ok=True)
+
+
+    def __contains__(self, repo_id):
+        return os.path.exists(self._manifest_path(repo_id))
+
+
+    def repo_ids(self):
+        '''Yields the ids of the repos in the store, in ascending order.'''
+        for repo_id in iter_repo_ids(self.root):
+            if repo_id in self:
+                yield repo_id
+
+
+    def put(self, source):
+        '''Stores the contents of 'source' (bytes, or a binary file object,
+        read to the end) as a blob and returns its hash and size.'''
+        with file_lock(self.lock, shared=True):
+            return self._put(source)
+
+
+    def ingest(self, repo_id, files):
+        '''Stores the files of repo 'repo_id', replacing any previous version
+        of the repo.  'files' is an iterable of (relative path, contents)
+        pairs, where the contents are bytes or a binary file object, or of
+        (relative path, contents, executable) triples.  Returns the manifest,
+        a dictionary mapping relative paths to (hash, size, executable)
+        tuples.'''
+        manifest = {}
+        with file_lock(self.lock, shared=True):
+            for item in files:
+                (path, source) = (_clean_path(item[0]), item[1])
+                executable = bool(item[2]) if len(item) > 2 else False
+                (digest, size) = self._put(source)
+                manifest[path] = (digest, size, executable)
+            self._install(repo_id, manifest)
+        return manifest
+
+
+    def ingest_dir(self, repo_id, source_dir):
+        '''Like ingest(), for the regular files under the directory
+        'source_dir'.  Symbolic links and special files are skipped.'''
+        return self.ingest(repo_id, _dir_files(source_dir))
+
+
+    def files(self, repo_id):
+        '''Returns the manifest of repo 'repo_id' (see ingest()), or None if
+        the repo is not in the store.'''
+        try:
+            with open(self._manifest_path(repo_id), 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except FileNotFoundError:
+            return None
+        return {path: tuple(value) for (path, value) in data['files'].items()}
+
+
+    def open(self, repo_id, path):
+        '''Returns a binary file object for reading the file 'path' of repo
+        'repo_id'.  Raises KeyError if the repo has no such file.'''
+        manifest = self.files(repo_id) or {}
+        entry = manifest.get(_clean_path(path))
+        if entry is None:
+            raise KeyError((repo_id, path))
+        return open(self.blob_path(entry[0]), 'rb')
+
+
+    def checkout(self, repo_id, dest_dir):
+        '''Writes the files of repo 'repo_id' under 'dest_dir', as hard links
+        to the blobs where possible (executable files are copied, so that
+        they can have mode 0755).  Returns the number of files.'''
+        manifest = self.files(repo_id)
+        if manifest is None:
+            raise KeyError(repo_id)
+        for (path, (digest, size, executable)) in manifest.items():
+            _write_file(self.blob_path(digest), os.path.join(dest_dir, path),
+                        executable)
+        return len(manifest)
+
+
+    def remove(self, repo_id):
+        '''Removes repo 'repo_id' from the store.  Its blobs are deleted by the
+        next gc() if no other repo uses them.'''
+        repo_dir = generate_path(self.root, repo_id)
+        if os.path.exists(self._manifest_path(repo_id)):
+            shutil.rmtree(repo_dir)
+
+
+    def blob_path(self, digest):
+        '''Returns the path of the blob with the given hash.'''
+        return os.path.join(self.objects, digest[:2], digest)
+
+
+    def gc(self):
+        '''Deletes the blobs not listed in any manifest, and returns the number
+        of blobs deleted and the number of bytes freed.  Temporary files and
+        directories left by interrupted ingests are deleted too.'''
+        count = 0
+        freed = 0
+        with file_lock(self.lock):
+            with os.scandir(self.objects) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.tmp-'):
+                        os.unlink(entry.path)
+            for path in self._leftover_dirs():
+                shutil.rmtree(path, ignore_errors=True)
+            used = set()
+            for repo_id in self.repo_ids():
+                used.update(digest for (digest, _, _) in self.files(repo_id).values())
+            for (digest, path, size) in self._blobs():
+                if digest not in used:
+                    os.unlink(path)
+                    count += 1
+                    freed += size
+        return (count, freed)
+
+
+    def usage(self):
+        '''Returns a dictionary with the number of blobs, the bytes they take,
+        and the bytes the files of all the repos would take without
+        deduplication.'''
+        blobs = 0
+        stored = 0
+        for (digest, path, size) in self._blobs():
+            blobs += 1
+            stored += size
+        logical = sum(size for repo_id in self.repo_ids()
+                      for (_, size, _) in self.files(repo_id).values())
+        return {'blobs': blobs, 'stored_bytes': stored, 'logical_bytes': logical}
+
+
+    def _put(self, source):
+        # Streams 'source' into a temporary file while hashing it, then moves
+        # the file into place unless the blob already exists.
+        sha = hashlib.sha256()
+        size = 0
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.objects, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if isinstance(source, (bytes, bytearray, memoryview)):
+                    sha.update(source)
+                    size = f.write(source)
+                else:
+                    while True:
+                        data = source.read(_READ_SIZE)
+                        if not data:
+                            break
+                        sha.update(data)
+                        size += f.write(data)
+            digest = sha.hexdigest()
+            path = self.blob_path(digest)
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return (digest, size)
+
+
+    def _install(self, repo_id, manifest):
+        # Builds the new repo directory next to the old one, then swaps them.
+        repo_dir = generate_path(self.root, repo_id)
+        parent = os.path.dirname(repo_dir)
+        os.makedirs(parent, exist_ok=True)
+        new_dir = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+        try:
+            if self.mode == 'link':
+                for (path, (digest, size, executable)) in manifest.items():
+                    _write_file(self.blob_path(digest),
+                                os.path.join(new_dir, path), executable)
+            data = {'files': manifest}
+            atomic_write(os.path.join(new_dir, _MANIFEST),
+                         json.dumps(data, sort_keys=True).encode('utf-8'))
+            os.chmod(new_dir, 0o755)
+            old_dir = None
+            if os.path.exists(repo_dir):
+                old_dir = tempfile.mkdtemp(dir=parent, prefix='.old-')
+                os.rename(repo_dir, os.path.join(old_dir, 'repo'))
+            os.rename(new_dir, repo_dir)
+            if old_dir:
+                shutil.rmtree(old_dir)
+        except BaseException:
+            shutil.rmtree(new_dir, ignore_errors=True)
+            raise
+
+
+    def _leftover_dirs(self):
+        # Yields the temporary directories made by _install() next to repo
+        # directories (i.e., three levels down), which only remain if an
+        # ingest was interrupted.
+        def subdirs(path):
+            with os.scandir(path) as entries:
+                return [e.path for e in entries
+                        if len(e.name) == 2 and e.name.isdigit() and e.is_dir()]
+
+        for a in subdirs(self.root):
+            for b in subdirs(a):
+                for c in subdirs(b):
+                    with os.scandir(c) as entries:
+                        for entry in entries:
+                            if entry.name.startswith(('.tmp-', '.old-')) \
+                               and entry.is_dir(follow_symlinks=False):
+                                yield entry.path
+
+
+    def _blobs(self):
+        # Yields (hash, path, size) for every blob.
+        with os.scandir(self.objects) as prefixes:
+            for prefix in prefixes:
+                if len(prefix.name) != 2 or not prefix.is_dir():
+                    continue
+                with os.scandir(prefix.path) as entries:
+                    for entry in entries:
+                        if not entry.name.startswith('.'):
+                            yield (entry.name, entry.path, entry.stat().st_size)
+
+
+    def _manifest_path(self, repo_id):
+        return os.path.join(generate_path(self.root, repo_id), _MANIFEST)
+
+
+# Helpers.
+# .............................................................................
+
+def _clean_path(path):
+    # Returns 'path' normalized, refusing paths that lead out of the repo.
+    clean = os.path.normpath(path.replace('\\', '/')).lstrip('/')
+    if clean in ('', '.', _MANIFEST) or clean == '..' or clean.startswith('../'):
+        raise ValueError('invalid file path "{}"'.format(path))
+    return clean
+
+
+def _dir_files(source_dir):
+    for (dirpath, dirnames, filenames) in os.walk(source_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                executable = bool(os.fstat(f.fileno()).st_mode & stat.S_IXUSR)
+                yield (os.path.relpath(path, source_dir), f, executable)
+
+
+def _write_file(blob, dest, executable):
+    # Puts the contents of 'blob' at 'dest': as a copy with mode 0755 for
+    # executable files, otherwise as a link where possible.
+    if executable:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(blob, dest)
+        os.chmod(dest, 0o755)
+    else:
+        _link_or_copy(blob, dest)
+
+
+def _link_or_copy(blob, dest):
+    # Hard links 'dest' to 'blob', copying it instead if the blob has
+    # reached the file system's maximum number of links.
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        os.link(blob, dest)
+    except OSError as err:
+        if err.errno not in (errno.EMLINK, errno.EXDEV, errno.EPERM):
+            raise
+        shutil.copyfile(blob, dest)
@@ -13,7 +13,6 @@
 from   configparser import ConfigParser
 import os
 import sys
-from   pymongo import MongoClient
 from   datetime import datetime
 
 from messages import *
@@ -6,8 +6,15 @@ __author__  = 'Michael Hucka <mhucka@caltech.edu>'
 __email__   = 'mhucka@caltech.edu'
 __license__ = 'GPLv3'
 
+from   concurrent.futures import ThreadPoolExecutor
 import contextlib
 import os
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 def full_path(filename, subdir=None):
     '''Return a full path based on the current file or current working dir.
@@ -52,6 +59,128 @@ def generate_path(root, repo_id):
     return os.path.join(root, s[0:2], s[2:4], s[4:6], s[6:8])
 
 
+_PAIRS = ['{:02}'.format(n) for n in range(100)]
+
+_MAX_PATH_ID = 100000000
+'''Ids below this value have paths of exactly four two-digit components.'''
+
+
+def generate_paths(root, repo_ids):
+    '''Returns the list of paths that generate_path() returns for each of the
+    ids in 'repo_ids', but computed much faster.  This is meant for batches
+    of thousands or millions of ids.  If NumPy is installed, the paths are
+    built with array operations over all the ids at once; otherwise, they
+    are built by a loop that looks up the two-digit components in a table.
+    '''
+    if np is not None:
+        if not isinstance(repo_ids, (list, tuple, np.ndarray)):
+            repo_ids = list(repo_ids)
+        try:
+            ids = np.asarray(repo_ids, dtype=np.int64)
+        except OverflowError:
+            ids = None
+        if ids is not None and ids.ndim == 1:
+            return _array_paths(root, ids)
+    prefix = os.path.join(root, '')
+    sep = os.sep
+    pairs = _PAIRS
+    paths = []
+    for repo_id in repo_ids:
+        n = int(repo_id)
+        if 0 <= n < _MAX_PATH_ID:
+            paths.append(prefix + pairs[n // 1000000] + sep + pairs[n // 10000 % 100]
+                         + sep + pairs[n // 100 % 100] + sep + pairs[n % 100])
+        else:
+            paths.append(generate_path(root, n))
+    return paths
+
+
+def _array_paths(root, ids):
+    # generate_paths() for a NumPy array of ids.
+    pairs = np.array(_PAIRS)
+    paths = np.str_(os.path.join(root, ''))
+    for divisor in (1000000, 10000, 100):
+        paths = np.char.add(np.char.add(paths, pairs[ids // divisor % 100]), os.sep)
+    paths = np.char.add(paths, pairs[ids % 100]).tolist()
+    for i in np.flatnonzero((ids < 0) | (ids >= _MAX_PATH_ID)):
+        paths[i] = generate_path(root, int(ids[i]))
+    return paths
+
+
+def make_paths(root, repo_ids, threads=None):
+    '''Creates the directories generate_path() returns for each of the ids in
+    'repo_ids', if they do not already exist, and returns the list of paths.
+    The directories are created one level of the tree at a time, so that
+    each directory is created only once and without checking its parents,
+    using 'threads' threads (default: 4 per CPU).
+    '''
+    paths = generate_paths(root, repo_ids)
+    levels = [set(), set(), set(), set(paths)]
+    for path in levels[3]:
+        for level in (2, 1, 0):
+            path = os.path.dirname(path)
+            if path in levels[level]:
+                break
+            levels[level].add(path)
+    os.makedirs(root, exist_ok=True)
+    threads = threads or 4*(os.cpu_count() or 1)
+    if threads == 1:
+        for level in levels:
+            _make_dirs(level)
+        return paths
+    with ThreadPoolExecutor(threads) as executor:
+        for level in levels:
+            level = list(level)
+            batches = [level[i::threads] for i in range(threads)]
+            for _ in executor.map(_make_dirs, batches):
+                pass
+    return paths
+
+
+def _make_dirs(paths):
+    for path in paths:
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            pass
+
+
+def id_from_path(path):
+    '''Returns the repository id for a path created by generate_path(), i.e.,
+    the inverse of generate_path().  Only the last four components of 'path'
+    are used.  Raises ValueError if they are not all two-digit numbers.
+    '''
+    parts = os.path.normpath(path).split(os.sep)[-4:]
+    if len(parts) != 4 or not all(len(p) == 2 and p.isdigit() for p in parts):
+        raise ValueError('not a repository path: {}'.format(path))
+    return int(''.join(parts))
+
+
+def iter_repo_ids(root):
+    '''Yields, in ascending order, the ids of the repositories that have a
+    directory (see generate_path()) under 'root'.  The tree is read with
+    os.scandir() to its known depth of four levels, without looking at the
+    contents of the repository directories; entries whose names are not
+    two-digit numbers are ignored.
+    '''
+    def subdirs(path):
+        try:
+            with os.scandir(path) as entries:
+                return sorted(e.name for e in entries
+                              if len(e.name) == 2 and e.name.isdigit() and e.is_dir())
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+
+    for a in subdirs(root):
+        path_a = os.path.join(root, a)
+        for b in subdirs(path_a):
+            path_b = os.path.join(path_a, b)
+            for c in subdirs(path_b):
+                base = int(a + b + c)*100
+                for d in subdirs(os.path.join(path_b, c)):
+                    yield base + int(d)
+
+
 @contextlib.contextmanager
 def cwd_preserved():
     # Code based on http://stackoverflow.com/a/169112/743730
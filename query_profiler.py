@@ -0,0 +1,432 @@
+# -*- python-indent-offset: 4 -*-
+'''
+query_profiler: find out which database queries are slow, and why.
+
+ProfiledCollection wraps a MongoDB collection object (such as db.repos after
+db = CasicsDB().open('github')) and records every query made through it.
+Queries are grouped by "shape": the structure of the query with the actual
+values replaced by their types, so that {'owner': 'mhucka'} and
+{'owner': 'someone'} count as the same kind of query.  For each shape, the
+profiler accumulates the number of calls, the time spent and the number of
+documents returned.  For a sample of the calls (the first one, and then one
+in every 'explain_every'), it also asks the server to explain the query, and
+records how many index keys and documents the server examined and whether
+it had to scan the whole collection.  Finally, suggest_indexes() proposes
+compound indexes for the shapes that examined many more documents than they
+returned.  Example of use:
+
+    repos = ProfiledCollection(db.repos)
+    ... run code that uses repos.find(), repos.find_one(), etc. ...
+    repos.print_report()
+    for index in repos.suggest_indexes():
+        print(index)
+
+Suggested indexes follow the usual equality-sort-range rule: fields tested
+for equality come first, then fields used for sorting, then fields tested
+with range operators.
+'''
+__version__ = '1.0.0'
+__author__  = 'Michael Hucka <mhucka@caltech.edu>'
+__email__   = 'mhucka@caltech.edu'
+__license__ = 'GPLv3'
+
+import time
+
+from   .casicsdb import _ENTRY_FIELDS, _TIME_FIELDS
+from   .messages import *
+
+
+# Global constants.
+# .............................................................................
+
+_EXPLAIN_EVERY = 100
+'''By default, one call in this many of each query shape is explained.'''
+
+_RATIO_THRESHOLD = 10
+'''Shapes that examine more than this many documents per document returned
+are candidates for new indexes.'''
+
+_RANGE_OPERATORS = {'$gt', '$gte', '$lt', '$lte', '$ne', '$nin', '$exists',
+                    '$regex', '$not', '$size', '$type', '$mod', '$all',
+                    '$elemMatch'}
+
+_TEXT_FIELDS = ('description', 'readme')
+'''Fields covered by the text index of the repos collection.'''
+
+_KNOWN_FIELDS = (set(_ENTRY_FIELDS)
+                 | {'time.' + name for name in _TIME_FIELDS}
+                 | {'fork.parent', 'fork.root', 'languages.name',
+                    'content_type.content', 'content_type.basis'})
+'''Field names of the schema defined by casicsdb.repo_entry().  Any name
+starting with 'topics.' is also accepted, since its keys are ontology names.'''
+
+
+# Query shapes.
+# .............................................................................
+
+def query_shape(query):
+    '''Returns a hashable representation of the structure of 'query', with
+    values replaced by the names of their types.'''
+    if isinstance(query, dict):
+        return tuple(sorted((key, query_shape(value))
+                            for (key, value) in query.items()))
+    elif isinstance(query, list):
+        if query and all(isinstance(item, dict) for item in query):
+            # Clauses of $and, $or, etc.
+            return ('list', tuple(sorted(set(query_shape(item)
+                                             for item in query))))
+        return 'list'
+    else:
+        return type(query).__name__
+
+
+def shape_str(shape):
+    '''Returns a readable string for a query shape.'''
+    if isinstance(shape, tuple) and shape and shape[0] == 'list':
+        return '[' + ', '.join(shape_str(item) for item in shape[1]) + ']'
+    elif isinstance(shape, tuple):
+        return '{' + ', '.join('{}: {}'.format(key, shape_str(value))
+                               for (key, value) in shape) + '}'
+    else:
+        return '<{}>'.format(shape)
+
+
+def query_fields(query):
+    '''Returns (equality, ranges, text) for 'query', where 'equality' and
+    'ranges' are lists of field names tested for equality or with range
+    operators, and 'text' is True if the query uses $text.  Clauses inside
+    $and are included; $or and $nor clauses are not (see or_clauses()).'''
+    equality, ranges, text = [], [], False
+    for (key, value) in query.items():
+        if key == '$and':
+            for clause in value:
+                (e, r, t) = query_fields(clause)
+                equality += [f for f in e if f not in equality]
+                ranges += [f for f in r if f not in ranges]
+                text = text or t
+        elif key == '$text':
+            text = True
+        elif key.startswith('$'):
+            continue
+        elif (isinstance(value, dict) and value
+              and any(op in _RANGE_OPERATORS for op in value)):
+            if key not in ranges:
+                ranges.append(key)
+        elif key not in equality:
+            # Plain values and $eq/$in are equality tests for index purposes.
+            equality.append(key)
+    return (equality, ranges, text)
+
+
+def or_clauses(query):
+    '''Returns the list of clauses of a top-level $or in 'query', if any.'''
+    return query.get('$or', [])
+
+
+def unknown_fields(query):
+    '''Returns the field names used in 'query' that are not part of the repo
+    entry schema.  These are usually typos, and they can never use an index.'''
+    names = set()
+    def collect(part):
+        if isinstance(part, dict):
+            for (key, value) in part.items():
+                if key.startswith('$'):
+                    collect(value)
+                else:
+                    names.add(key)
+        elif isinstance(part, list):
+            for item in part:
+                collect(item)
+    collect(query)
+    return sorted(name for name in names if name not in _KNOWN_FIELDS
+                  and not name.startswith('topics.'))
+
+
+# Profiling.
+# .............................................................................
+
+class ShapeStats():
+    '''Accumulated statistics for one query shape.'''
+
+    def __init__(self, shape, example, sort):
+        self.shape         = shape
+        self.example       = example
+        self.sort          = sort
+        self.calls         = 0
+        self.seconds       = 0.0
+        self.max_seconds   = 0.0
+        self.returned      = 0
+        self.explained     = 0
+        self.keys_examined = 0
+        self.docs_examined = 0
+        self.docs_explained_returned = 0
+        self.stages        = set()
+
+
+    def ratio(self):
+        '''Documents examined per document returned, over explained calls.'''
+        if not self.explained:
+            return None
+        return self.docs_examined/max(1, self.docs_explained_returned)
+
+
+    def as_dict(self):
+        return {'shape'         : shape_str(self.shape),
+                'calls'         : self.calls,
+                'seconds'       : self.seconds,
+                'mean_seconds'  : self.seconds/self.calls if self.calls else 0,
+                'max_seconds'   : self.max_seconds,
+                'returned'      : self.returned,
+                'explained'     : self.explained,
+                'keys_examined' : self.keys_examined,
+                'docs_examined' : self.docs_examined,
+                'ratio'         : self.ratio(),
+                'collscan'      : 'COLLSCAN' in self.stages,
+                'unknown_fields': unknown_fields(self.example)}
+
+
+class ProfiledCollection():
+    '''Wraps a pymongo collection and records statistics about the queries
+    made through find(), find_one(), count_documents() and distinct().  Other
+    attributes and methods are passed through to the collection unchanged.'''
+
+    def __init__(self, collection, explain_every=_EXPLAIN_EVERY):
+        self.collection    = collection
+        self.explain_every = explain_every
+        self.stats         = {}
+
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+    def find(self, filter=None, *args, **kwargs):
+        return _ProfiledCursor(self, filter or {},
+                               self.collection.find(filter, *args, **kwargs),
+                               kwargs.get('sort'))
+
+
+    def find_one(self, filter=None, *args, **kwargs):
+        start = time.time()
+        result = self.collection.find_one(filter, *args, **kwargs)
+        self._record(filter or {}, kwargs.get('sort'), time.time() - start,
+                     0 if result is None else 1)
+        return result
+
+
+    def count_documents(self, filter, **kwargs):
+        start = time.time()
+        result = self.collection.count_documents(filter, **kwargs)
+        self._record(filter, None, time.time() - start, 1)
+        return result
+
+
+    def distinct(self, key, filter=None, **kwargs):
+        start = time.time()
+        result = self.collection.distinct(key, filter, **kwargs)
+        self._record(filter or {}, None, time.time() - start, len(result))
+        return result
+
+
+    def report(self):
+        '''Returns a list of dictionaries of statistics, one per query shape,
+        ordered by total time spent, highest first.'''
+        return [stats.as_dict() for stats in
+                sorted(self.stats.values(), key=lambda s: -s.seconds)]
+
+
+    def print_report(self):
+        for item in self.report():
+            msg('{}: {} calls, {:.3f} s total, {:.4f} s mean, {} returned'
+                .format(item['shape'], item['calls'], item['seconds'],
+                        item['mean_seconds'], item['returned']))
+            if item['explained']:
+                msg('    examined {} keys and {} documents in {} explained '
+                    'calls ({:.1f} per document returned){}'
+                    .format(item['keys_examined'], item['docs_examined'],
+                            item['explained'], item['ratio'],
+                            '; COLLECTION SCAN' if item['collscan'] else ''),
+                    'warning' if item['collscan'] else None)
+            if item['unknown_fields']:
+                msg('    fields not in the repo schema: {}'
+                    .format(', '.join(item['unknown_fields'])), 'warning')
+
+
+    def suggest_indexes(self, existing=True):
+        '''Returns a list of suggested indexes, each a list of (field,
+        direction) pairs in the form accepted by create_index(), for query
+        shapes that scanned the collection or examined more than
+        _RATIO_THRESHOLD documents per document returned.  If 'existing' is
+        True, indexes already present on the collection (or having a
+        suggestion as a prefix) are left out.'''
+        suggestions = []
+        for stats in sorted(self.stats.values(), key=lambda s: -s.seconds):
+            if not stats.explained:
+                continue
+            if 'COLLSCAN' not in stats.stages and stats.ratio() <= _RATIO_THRESHOLD:
+                continue
+            unknown = unknown_fields(stats.example)
+            for index in _indexes_for(stats.example, stats.sort):
+                index = [(field, kind) for (field, kind) in index
+                         if field not in unknown]
+                if index and index not in suggestions:
+                    suggestions.append(index)
+        if existing:
+            current = [list(info['key']) for info in
+                       self.collection.index_information().values()]
+            suggestions = [index for index in suggestions
+                           if not any(_is_prefix(index, have) for have in current)]
+        return suggestions
+
+
+    def _record(self, query, sort, seconds, returned):
+        shape = query_shape(query)
+        key = (shape, _sort_shape(sort))
+        stats = self.stats.get(key)
+        if not stats:
+            stats = self.stats[key] = ShapeStats(shape, query, sort)
+        stats.calls += 1
+        stats.seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+        stats.returned += returned
+        if (stats.calls - 1) % self.explain_every == 0:
+            self._explain(stats, query, sort)
+
+
+    def _explain(self, stats, query, sort):
+        cursor = self.collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            explanation = cursor.explain()
+        except Exception as err:
+            msg('Unable to explain query {}: {}'.format(query, err), 'warning')
+            return
+        execution = explanation.get('executionStats', {})
+        stats.explained += 1
+        stats.keys_examined += execution.get('totalKeysExamined', 0)
+        stats.docs_examined += execution.get('totalDocsExamined', 0)
+        stats.docs_explained_returned += execution.get('nReturned', 0)
+        stats.stages |= _plan_stages(explanation.get('queryPlanner', {})
+                                     .get('winningPlan', {}))
+
+
+class _ProfiledCursor():
+    # Cursors are lazy, so the time for a find() is the time spent iterating
+    # over the results.  It is recorded when the cursor is exhausted or closed.
+
+    def __init__(self, profiled, query, cursor, sort):
+        self._profiled = profiled
+        self._query    = query
+        self._cursor   = cursor
+        self._sort     = sort
+        self._seconds  = 0.0
+        self._returned = 0
+        self._done     = False
+
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        start = time.time()
+        try:
+            result = next(self._cursor)
+        except StopIteration:
+            self._seconds += time.time() - start
+            self._finish()
+            raise
+        self._seconds += time.time() - start
+        self._returned += 1
+        return result
+
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = (key_or_list if direction is None
+                      else [(key_or_list, direction)])
+        self._cursor = self._cursor.sort(key_or_list, direction) \
+            if direction is not None else self._cursor.sort(key_or_list)
+        return self
+
+
+    def limit(self, limit):
+        self._cursor = self._cursor.limit(limit)
+        return self
+
+
+    def skip(self, skip):
+        self._cursor = self._cursor.skip(skip)
+        return self
+
+
+    def batch_size(self, batch_size):
+        self._cursor = self._cursor.batch_size(batch_size)
+        return self
+
+
+    def close(self):
+        self._finish()
+        self._cursor.close()
+
+
+    def _finish(self):
+        if not self._done:
+            self._done = True
+            self._profiled._record(self._query, self._sort, self._seconds,
+                                   self._returned)
+
+
+# Helpers.
+# .............................................................................
+
+def _sort_shape(sort):
+    if not sort:
+        return None
+    if isinstance(sort, str):
+        return ((sort, 1),)
+    return tuple((key, direction) for (key, direction) in sort)
+
+
+def _plan_stages(plan):
+    stages = set()
+    while plan:
+        stages.add(plan.get('stage'))
+        for child in plan.get('inputStages', []):
+            stages |= _plan_stages(child)
+        plan = plan.get('inputStage')
+    return stages
+
+
+def _indexes_for(query, sort):
+    (equality, ranges, text) = query_fields(query)
+    if text:
+        # MongoDB allows only one text index per collection.
+        return [[(field, 'text') for field in _TEXT_FIELDS]]
+    clauses = or_clauses(query)
+    if clauses:
+        # Each clause of an $or can use its own index.
+        return [index for clause in clauses
+                for index in _indexes_for(dict(clause, **{k: v for (k, v)
+                                                          in query.items()
+                                                          if k != '$or'}),
+                                          sort)]
+    sort_fields = list(_sort_shape(sort) or [])
+    index = [(field, 1) for field in equality]
+    index += [(field, direction) for (field, direction) in sort_fields
+              if field not in equality]
+    index += [(field, 1) for field in ranges
+              if field not in equality and field not in dict(sort_fields)]
+    if index == [('_id', 1)]:
+        return []
+    return [index]
+
+
+def _is_prefix(index, existing):
+    if index and index[0][1] == 'text':
+        return any(field == '_fts' for (field, direction) in existing)
+    return existing[:len(index)] == index
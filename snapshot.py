@@ -0,0 +1,749 @@
+# -*- python-indent-offset: 4 -*-
+'''
+snapshot: memory-mapped on-disk snapshots of repo entries.
+
+Reloading a working set of entries from the database or from a pickle takes
+minutes.  A snapshot file holds the same information in a column-oriented
+binary layout that can be opened with mmap, so opening a snapshot costs
+almost nothing, pages are read from disk only when they are touched, and
+several processes opening the same file share the same pages of memory.
+
+Layout of a snapshot file:
+
+    magic        8 bytes, b'CASICSNP'
+    header size  4 bytes, unsigned little-endian integer
+    header       JSON text describing the columns (see below)
+    sections     the column data, each section starting on an 8-byte boundary
+
+Entries are stored in ascending '_id' order.  Each column has a "kind":
+
+    'int'      one little-endian int64 per entry; None is stored as _NULL_INT
+    'float'    one little-endian float64 per entry; None is stored as NaN
+    'flag'     one int8 per entry: 1 = True, 0 = False, -1 = None
+    'str'      variable-length strings (see below)
+    'strlist'  variable-length lists of strings, stored NUL-separated
+    'json'     variable-length values of any other type, stored as JSON
+
+Variable-length columns have three sections: 'tags' (one int8 per entry),
+'offsets' (n + 1 int64 values) and 'data'.  The bytes for entry i are
+data[offsets[i]:offsets[i+1]].  The tag says how to interpret them, which
+is how the None/[]/-1/-2 conventions of repo_entry() are preserved:
+_TAG_VALUE means the bytes hold the value, _TAG_NONE means None,
+_TAG_EMPTY means [], and negative tags are negative integer values such as
+-1 and -2 (values below -128 do not fit in a tag, and are stored as JSON).
+
+Example of use:
+
+    snapshot_from_db(db.repos, 'repos.snap')
+    ...
+    with RepoSnapshot('repos.snap') as snap:
+        entry = snap.get(16335)
+        names = snap.column('name')
+'''
+__version__ = '1.0.0'
+__author__  = 'Michael Hucka <mhucka@caltech.edu>'
+__email__   = 'mhucka@caltech.edu'
+__license__ = 'GPLv3'
+
+from   bisect import bisect_left
+import heapq
+import json
+import math
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import sys
+import tempfile
+
+from   .casicsdb import iter_repos, make_fork, make_languages, e_languages, \
+    _TIME_FIELDS
+
+
+# Global constants.
+# .............................................................................
+
+_MAGIC = b'CASICSNP'
+
+_NULL_INT = -2**63
+'''Value stored in 'int' columns for entries whose value is None.'''
+
+_TAG_VALUE = 1
+_TAG_NONE  = 0
+_TAG_EMPTY = 2
+_TAG_JSON  = 3
+'''Tag for values in 'str' or 'strlist' columns that do not fit the kind.'''
+
+_MIN_TAG = -128
+'''Lowest negative integer stored as a tag (tags are int8); lower values are
+stored as JSON.'''
+
+_COLUMNS = [('_id',              'int'),
+            ('owner',            'str'),
+            ('name',             'str'),
+            ('description',      'str'),
+            ('readme',           'str'),
+            ('text_languages',   'strlist'),
+            ('languages',        'strlist'),
+            ('licenses',         'strlist'),
+            ('files',            'strlist'),
+            ('content_type',     'json'),
+            ('kind',             'strlist'),
+            ('interfaces',       'strlist'),
+            ('topics',           'json'),
+            ('notes',            'str'),
+            ('functions',        'json'),
+            ('num_commits',      'int'),
+            ('num_releases',     'int'),
+            ('num_branches',     'int'),
+            ('num_contributors', 'int'),
+            ('is_visible',       'flag'),
+            ('is_deleted',       'flag'),
+            ('is_fork',          'flag'),
+            ('fork_parent',      'int'),
+            ('fork_root',        'int'),
+            ('repo_created',     'float'),
+            ('repo_updated',     'float'),
+            ('repo_pushed',      'float'),
+            ('data_refreshed',   'float'),
+            ('default_branch',   'str'),
+            ('homepage',         'str')]
+'''Columns that can be stored in a snapshot, in file order.  The 'fork' and
+'time' fields of entries are split into several columns.'''
+
+_DEFAULT_SKIP = ['readme']
+'''Columns left out of snapshots unless requested, because of their size.'''
+
+_FIXED_FORMATS = {'int': 'q', 'float': 'd', 'flag': 'b'}
+
+if sys.byteorder != 'little':
+    raise ImportError('snapshot files are only supported on little-endian hosts')
+
+
+# Writing snapshots.
+# .............................................................................
+
+class SnapshotWriter():
+    '''Writes entries to a snapshot file.  Entries must be added in ascending
+    '_id' order.  Column data is spooled to temporary files in the same
+    directory as 'path', so memory use does not grow with the number of
+    entries.  The snapshot file appears (atomically) when close() is called.
+    Parameter 'skip' lists columns to leave out; by default, 'readme'.
+    '''
+
+    def __init__(self, path, skip=_DEFAULT_SKIP):
+        self.path    = path
+        self.columns = [(name, kind) for (name, kind) in _COLUMNS
+                        if name not in skip]
+        self.count   = 0
+        self._last   = None
+        self._tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+        self._files  = {}
+        self._sizes  = {}
+        for (name, kind) in self.columns:
+            for section in _sections(kind):
+                self._files[(name, section)] = open(
+                    os.path.join(self._tmpdir, name + '.' + section), 'wb')
+            if kind not in _FIXED_FORMATS:
+                self._sizes[name] = 0
+                self._files[(name, 'offsets')].write(struct.pack('<q', 0))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+
+    def add(self, entry):
+        '''Adds one entry (a dictionary in the format of repo_entry() or a
+        RepoEntry object) to the snapshot.'''
+        id = entry['_id']
+        if self._last is not None and id <= self._last:
+            raise ValueError('entries must be added in ascending _id order '
+                             '(got {} after {})'.format(id, self._last))
+        self._last = id
+        values = _flatten(entry)
+        for (name, kind) in self.columns:
+            value = values.get(name)
+            if kind in _FIXED_FORMATS:
+                self._files[(name, 'values')].write(_pack_fixed(kind, value))
+            else:
+                (tag, data) = _encode_variable(kind, value)
+                self._files[(name, 'tags')].write(struct.pack('<b', tag))
+                self._files[(name, 'data')].write(data)
+                self._sizes[name] += len(data)
+                self._files[(name, 'offsets')].write(
+                    struct.pack('<q', self._sizes[name]))
+        self.count += 1
+
+
+    def close(self):
+        '''Assembles the snapshot file from the spooled column data.'''
+        for file in self._files.values():
+            file.close()
+        try:
+            header = {'count': self.count, 'columns': []}
+            # Compute section positions relative to the end of the header,
+            # then shift them once the header size is known.
+            position = 0
+            layout = []
+            for (name, kind) in self.columns:
+                sections = {}
+                for section in _sections(kind):
+                    size = os.path.getsize(self._files[(name, section)].name)
+                    sections[section] = [position, size]
+                    layout.append((self._files[(name, section)].name, size))
+                    position = _aligned(position + size)
+                header['columns'].append({'name': name, 'kind': kind,
+                                          'sections': sections})
+            # Shifting the positions can lengthen the header, so repeat until
+            # the start of the sections no longer moves.
+            start = 0
+            while True:
+                header_bytes = _header_bytes(_shifted(header, start))
+                needed = _aligned(len(_MAGIC) + 4 + len(header_bytes))
+                if needed <= start:
+                    break
+                start = needed
+            tmp_path = os.path.join(self._tmpdir, 'snapshot')
+            with open(tmp_path, 'wb') as out:
+                out.write(_MAGIC)
+                out.write(struct.pack('<I', len(header_bytes)))
+                out.write(header_bytes)
+                out.write(b'\0' * (start - out.tell()))
+                for (file_name, size) in layout:
+                    with open(file_name, 'rb') as f:
+                        shutil.copyfileobj(f, out, 1024*1024)
+                    out.write(b'\0' * (_aligned(size) - size))
+            os.replace(tmp_path, self.path)
+        finally:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
+    def abort(self):
+        '''Discards everything written so far.'''
+        for file in self._files.values():
+            file.close()
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
+def write_snapshot(path, entries, skip=_DEFAULT_SKIP):
+    '''Writes the iterable 'entries' (in ascending '_id' order) to a snapshot
+    file at 'path'.  Returns the number of entries written.'''
+    with SnapshotWriter(path, skip) as writer:
+        for entry in entries:
+            writer.add(entry)
+    return writer.count
+
+
+def snapshot_from_db(collection, path, query=None, skip=_DEFAULT_SKIP):
+    '''Writes the entries in 'collection' that match 'query' to a snapshot
+    file at 'path'.  Returns the number of entries written.'''
+    fields = [name for (name, kind) in _COLUMNS if name not in skip
+              and name not in _TIME_FIELDS
+              and name not in ('is_fork', 'fork_parent', 'fork_root')]
+    fields += ['fork', 'time']
+    return write_snapshot(path, iter_repos(collection, query, fields=fields,
+                                           by_id=True), skip)
+
+
+# Reading snapshots.
+# .............................................................................
+
+class RepoSnapshot():
+    '''Read-only access to a snapshot file.  The file is memory-mapped, and
+    the column data is accessed in place through memoryview objects.
+
+    A snapshot can be brought up to date without rewriting it: patch() saves
+    new versions of entries to a small sidecar file ("<path>.delta"), and
+    get(), entries(), iteration, etc., consult the sidecar before the
+    snapshot itself.  (Methods that work on rows and columns, such as row(),
+    column() and value(), only see the snapshot file.)  compact_snapshot()
+    folds the sidecar back into the snapshot file.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(_MAGIC)] != _MAGIC:
+            self._mmap.close()
+            raise ValueError('{} is not a snapshot file'.format(path))
+        (size,) = struct.unpack_from('<I', self._mmap, len(_MAGIC))
+        start = len(_MAGIC) + 4
+        header = json.loads(self._mmap[start:start + size].decode('utf-8'))
+        self.count    = header['count']
+        self.kinds    = {}
+        self._views   = {}
+        buffer = memoryview(self._mmap)
+        for column in header['columns']:
+            name = column['name']
+            kind = column['kind']
+            self.kinds[name] = kind
+            for (section, (offset, length)) in column['sections'].items():
+                view = buffer[offset:offset + length]
+                if section in ('values', 'offsets', 'tags'):
+                    format = _FIXED_FORMATS[kind] if section == 'values' \
+                        else ('q' if section == 'offsets' else 'b')
+                    view = view.cast(format)
+                self._views[(name, section)] = view
+        buffer.release()
+        self.ids = self._views[('_id', 'values')]
+        self.delta = _load_delta(path)
+        self._added = None
+        self._dirty = False
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def __len__(self):
+        return self.count + len(self._added_ids())
+
+
+    def __contains__(self, id):
+        return id in self.delta or self.row(id) is not None
+
+
+    def __iter__(self):
+        return heapq.merge(self.ids, self._added_ids())
+
+
+    def close(self):
+        self.flush()
+        for view in self._views.values():
+            view.release()
+        self._views = {}
+        self._mmap.close()
+
+
+    def row(self, id):
+        '''Returns the row number of the entry with the given '_id', or None
+        if the snapshot does not contain it.'''
+        row = bisect_left(self.ids, id)
+        if row < self.count and self.ids[row] == id:
+            return row
+        return None
+
+
+    def column(self, name):
+        '''Returns the values of a fixed-width column as a memoryview over the
+        snapshot file, with NumPy-compatible layout.  (For example,
+        numpy.asarray(snap.column('repo_created')) creates no copy.)'''
+        if self.kinds[name] not in _FIXED_FORMATS:
+            raise ValueError('column "{}" is not fixed-width'.format(name))
+        return self._views[(name, 'values')]
+
+
+    def raw(self, row, name):
+        '''Returns (tag, memoryview) for the bytes of variable-length column
+        'name' in the given row, without copying or decoding them.'''
+        offsets = self._views[(name, 'offsets')]
+        data = self._views[(name, 'data')]
+        return (self._views[(name, 'tags')][row],
+                data[offsets[row]:offsets[row + 1]])
+
+
+    def value(self, row, name):
+        '''Returns the value of column 'name' in the given row.'''
+        kind = self.kinds[name]
+        if kind in _FIXED_FORMATS:
+            return _unpack_fixed(kind, self._views[(name, 'values')][row])
+        (tag, data) = self.raw(row, name)
+        return _decode_variable(kind, tag, data)
+
+
+    def get(self, id, default=None):
+        '''Returns the entry with the given '_id' as a dictionary in the
+        format of repo_entry(), or 'default' if there is no such entry.
+        Fields for columns that are not in the snapshot are left out.'''
+        if id in self.delta:
+            return self.delta[id]
+        row = self.row(id)
+        return self.entry(row) if row is not None else default
+
+
+    def entry(self, row):
+        '''Returns the entry in the given row as a dictionary.'''
+        return _assemble({name: self.value(row, name) for name in self.kinds})
+
+
+    def entries(self):
+        '''Generator over all entries in the snapshot, in '_id' order.'''
+        for id in self:
+            yield self.get(id)
+
+
+    def patch(self, entries):
+        '''Records new versions of the given entries in the sidecar file.
+        Entries that are not in the snapshot are added to it.  Fields missing
+        from an entry (e.g., because of a projection) keep their current
+        values.  Returns the number of entries patched.'''
+        count = 0
+        for entry in entries:
+            self._patch_entry(entry)
+            count += 1
+        self.flush()
+        return count
+
+
+    def __setitem__(self, id, entry):
+        '''Like patch() for one entry, except that the sidecar file is only
+        written by flush() or close().'''
+        self._patch_entry(dict(entry, _id=id))
+
+
+    def flush(self):
+        '''Writes the changes made with snap[id] = entry to the sidecar file.'''
+        if self._dirty:
+            _save_delta(self.path, self.delta)
+            self._dirty = False
+
+
+    def _patch_entry(self, entry):
+        id = entry['_id']
+        self.delta[id] = _flatten_entry(entry, self.kinds, self.get(id))
+        self._added = None
+        self._dirty = True
+
+
+    def _added_ids(self):
+        if self._added is None:
+            self._added = sorted(id for id in self.delta if self.row(id) is None)
+        return self._added
+
+
+def compact_snapshot(path):
+    '''Rewrites the snapshot file at 'path' to include the changes recorded
+    in its sidecar file by RepoSnapshot.patch(), then removes the sidecar.
+    Processes that have the snapshot open keep seeing the old version until
+    they reopen it.'''
+    with RepoSnapshot(path) as snap:
+        if not snap.delta:
+            return
+        skip = [name for (name, kind) in _COLUMNS if name not in snap.kinds]
+        write_snapshot(path, snap.entries(), skip)
+    os.remove(_delta_path(path))
+
+
+# Incremental updates.
+# .............................................................................
+# Every entry records in 'time.data_refreshed' when it was last updated in our
+# database.  DeltaSync remembers the highest such value it has seen (the
+# "high-water mark") in a small state file and on the next run asks the
+# database only for entries refreshed since then, so the cost of bringing a
+# local copy up to date depends on the number of changed entries rather
+# than the size of the collection.  Example of use:
+#
+#    with RepoSnapshot('repos.snap') as snap:
+#        DeltaSync(db.repos, 'repos.sync').sync(snap)
+#
+# The target can be anything that supports target[id] = entry, such as a
+# RepoSnapshot (which records the changes with patch()) or a dictionary.
+# The new high-water marks are saved only once the target has all the
+# changes, so if anything fails along the way, the next sync fetches the
+# same changes again.
+
+_SYNC_OVERLAP = 300
+'''Seconds by which each query reaches back before the high-water mark.
+Entries written while a sync is running can carry timestamps earlier than
+the highest one seen, and clocks on different hosts can disagree; fetching
+a few entries twice is harmless because applying an entry is idempotent.'''
+
+class DeltaSync():
+    def __init__(self, collection, state_file, time_fields=['data_refreshed'],
+                 fields=None, overlap=_SYNC_OVERLAP):
+        '''Parameter 'state_file' is where the high-water marks are kept.
+        Parameter 'time_fields' lists the fields of 'time' whose changes are
+        tracked ('data_refreshed', 'repo_updated', etc.); an entry is fetched
+        if any of them changed.  Parameter 'fields' is the list of fields to
+        fetch for changed entries (see casicsdb.repo_projection()); the
+        default is all fields.'''
+        self.collection  = collection
+        self.state_file  = state_file
+        self.time_fields = time_fields
+        self.fields      = fields
+        self.overlap     = overlap
+        self.marks       = {}
+        self._new_marks  = None
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                self.marks = json.load(f)
+
+
+    def query(self):
+        '''Returns the database query for entries changed since the last
+        sync, or {} (everything) if there has been no sync yet.'''
+        terms = [{'time.' + name: {'$gte': self.marks[name] - self.overlap}}
+                 for name in self.time_fields if name in self.marks]
+        if len(terms) < len(self.time_fields):
+            return {}
+        return terms[0] if len(terms) == 1 else {'$or': terms}
+
+
+    def mark_from(self, snapshot):
+        '''Sets the high-water marks to the newest times recorded in the
+        RepoSnapshot 'snapshot', so that a first sync against a freshly
+        written snapshot does not fetch everything again.'''
+        for name in self.time_fields:
+            newest = max((value for value in snapshot.column(name)
+                          if not math.isnan(value)), default=None)
+            if newest is not None:
+                self.marks[name] = newest
+        self._save()
+
+
+    def changes(self):
+        '''Generator over the entries changed since the last sync.  Once the
+        generator is exhausted and the changes have been stored, call
+        commit() to save the new high-water marks; until then, the next sync
+        fetches the same changes again.'''
+        self._new_marks = None
+        marks = dict(self.marks)
+        fields = self.fields
+        if fields is not None:
+            # MongoDB rejects projections of both a field and a subfield of it.
+            fields = list(fields)
+            fields += [path for path in ('time.' + name for name in self.time_fields)
+                       if not _covered(path, fields)]
+        for entry in iter_repos(self.collection, self.query(), fields=fields):
+            times = entry.get('time') or {}
+            for name in self.time_fields:
+                value = times.get(name)
+                if value is not None and value > marks.get(name, -math.inf):
+                    marks[name] = value
+            yield entry
+        self._new_marks = marks
+
+
+    def commit(self):
+        '''Saves the high-water marks reached by the last complete pass over
+        changes().  Does nothing if there has been no complete pass.'''
+        if self._new_marks is not None:
+            self.marks = self._new_marks
+            self._new_marks = None
+            self._save()
+
+
+    def sync(self, target):
+        '''Stores every changed entry in 'target' (as target[id] = entry)
+        and returns the number of entries stored.  If 'target' has a patch()
+        method, it is given all the changes in one call instead.  The new
+        high-water marks are saved after that.'''
+        if hasattr(target, 'patch'):
+            count = target.patch(self.changes())
+        else:
+            count = 0
+            for entry in self.changes():
+                target[entry['_id']] = entry
+                count += 1
+        self.commit()
+        return count
+
+
+    def _save(self):
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.marks, f)
+        os.replace(tmp_file, self.state_file)
+
+
+# Helpers.
+# .............................................................................
+
+def _delta_path(path):
+    return path + '.delta'
+
+
+def _load_delta(path):
+    if not os.path.exists(_delta_path(path)):
+        return {}
+    with open(_delta_path(path), 'rb') as f:
+        return pickle.load(f)
+
+
+def _save_delta(path, delta):
+    tmp_path = _delta_path(path) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(delta, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, _delta_path(path))
+
+
+def _covered(path, fields):
+    # Returns True if the dotted 'path' is one of 'fields' or lies within one
+    # of them.  Elements of 'fields' that are accessor functions are skipped.
+    return any(isinstance(field, str)
+               and (path == field or path.startswith(field + '.'))
+               for field in fields)
+
+
+def _flatten_entry(entry, kinds, base=None):
+    # Reduce an entry to what the snapshot would store for it, so that
+    # patched entries look the same as entries read from the snapshot file.
+    # Columns for fields missing from 'entry' take their values from 'base',
+    # the current version of the entry, if there is one.
+    values = _flatten(entry)
+    present = _present_columns(entry)
+    old = _flatten(base) if base is not None else {}
+    row = {}
+    for (name, kind) in kinds.items():
+        value = values.get(name) if name in present else old.get(name)
+        if kind not in _FIXED_FORMATS:
+            value = _decode_variable(kind, *_encode_variable(kind, value))
+        row[name] = value
+    return _assemble(row)
+
+
+def _present_columns(entry):
+    # Returns the set of columns whose fields are in 'entry'.
+    present = {name for (name, kind) in _COLUMNS if name in entry}
+    if 'fork' in entry:
+        present.update(('is_fork', 'fork_parent', 'fork_root'))
+    times = entry.get('time')
+    if isinstance(times, dict):
+        present.update(name for name in _TIME_FIELDS if name in times)
+    return present
+
+
+def _sections(kind):
+    return ['values'] if kind in _FIXED_FORMATS else ['tags', 'offsets', 'data']
+
+
+def _aligned(position):
+    return (position + 7) & ~7
+
+
+def _shifted(header, start):
+    columns = []
+    for column in header['columns']:
+        sections = {section: [offset + start, size] for (section, (offset, size))
+                    in column['sections'].items()}
+        columns.append(dict(column, sections=sections))
+    return dict(header, columns=columns)
+
+
+def _header_bytes(header):
+    return json.dumps(header, separators=(',', ':')).encode('utf-8')
+
+
+def _flatten(entry):
+    # Turn an entry into a flat dictionary keyed by column name.
+    values = {name: entry.get(name) for (name, kind) in _COLUMNS
+              if name in entry}
+    values['languages'] = e_languages(entry) if 'languages' in entry else None
+    times = entry.get('time') or {}
+    for name in _TIME_FIELDS:
+        values[name] = times.get(name)
+    fork = entry.get('fork')
+    if fork is False:
+        values['is_fork'] = False
+    elif isinstance(fork, dict):
+        values['is_fork'] = True
+        values['fork_parent'] = fork.get('parent')
+        values['fork_root'] = fork.get('root')
+    return values
+
+
+def _assemble(values):
+    # Turn a flat dictionary keyed by column name back into an entry.
+    entry = {}
+    for (name, kind) in _COLUMNS:
+        if name in _TIME_FIELDS:
+            if name in values:
+                entry.setdefault('time', {})[name] = values[name]
+        elif name == 'is_fork':
+            if name in values:
+                entry['fork'] = _fork_value(values['is_fork'],
+                                            values.get('fork_parent'),
+                                            values.get('fork_root'))
+        elif name == 'languages':
+            if name in values:
+                langs = values[name]
+                entry[name] = make_languages(langs) \
+                    if isinstance(langs, list) and langs else langs
+        elif name not in ('fork_parent', 'fork_root') and name in values:
+            entry[name] = values[name]
+    return entry
+
+
+def _fork_value(is_fork, parent, root):
+    if is_fork is None:
+        return []
+    elif not is_fork:
+        return False
+    return make_fork(parent, root)
+
+
+def _pack_fixed(kind, value):
+    if kind == 'int':
+        return struct.pack('<q', _NULL_INT if value is None else _int_value(value))
+    elif kind == 'float':
+        return struct.pack('<d', math.nan if value is None else value)
+    else:
+        return struct.pack('<b', -1 if value is None else int(bool(value)))
+
+
+def _unpack_fixed(kind, value):
+    if kind == 'int':
+        return None if value == _NULL_INT else value
+    elif kind == 'float':
+        return None if math.isnan(value) else value
+    else:
+        return None if value == -1 else bool(value)
+
+
+def _encode_variable(kind, value):
+    if value is None:
+        return (_TAG_NONE, b'')
+    elif value == []:
+        return (_TAG_EMPTY, b'')
+    elif isinstance(value, int) and not isinstance(value, bool) \
+         and _MIN_TAG <= value < 0:
+        return (value, b'')
+    elif kind == 'str' and isinstance(value, str):
+        return (_TAG_VALUE, value.encode('utf-8'))
+    elif kind == 'strlist' and isinstance(value, list) \
+         and all(isinstance(item, str) and '\0' not in item for item in value):
+        return (_TAG_VALUE, '\0'.join(value).encode('utf-8'))
+    else:
+        # Anything that does not fit the column's kind is kept as JSON, so
+        # that unusual values in the database survive a round trip.
+        return (_TAG_JSON, json.dumps(value).encode('utf-8'))
+
+def _int_value(value):
+    # Returns the value to store in an 'int' column.  The database can hold
+    # integers as doubles (e.g., 12.0); those are converted, other values
+    # are rejected.
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) \
+       or not _NULL_INT < value < 2**63:
+        raise ValueError('value {!r} cannot be stored in an int column'.format(value))
+    return value
+
+
+def _decode_variable(kind, tag, data):
+    if tag == _TAG_NONE:
+        return None
+    elif tag == _TAG_EMPTY:
+        return []
+    elif tag < 0:
+        return tag
+    elif tag == _TAG_JSON or kind == 'json':
+        return json.loads(bytes(data).decode('utf-8'))
+    elif kind == 'str':
+        return bytes(data).decode('utf-8')
+    else:
+        return bytes(data).decode('utf-8').split('\0')
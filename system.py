@@ -9,11 +9,15 @@ __email__   = 'mhucka@caltech.edu'
 __license__ = 'GPLv3'
 
 import contextlib
+import heapq
 import magic
 import os
+import selectors
+import signal
 from   subprocess import PIPE, DEVNULL, Popen
 import sys
 from   threading import Timer
+import time
 
 
 # Utility functions.
@@ -29,15 +33,8 @@ def shell_cmd(args, max_time=5, env=None):
         timeout['value'] = True
         proc.kill()
 
-    if env:
-        new_env = os.environ.copy()
-        for key, value in env.items():
-            new_env[key] = value
-        proc = Popen(args, stdout=PIPE, stderr=PIPE, stdin=PIPE,
-                     preexec_fn=os.setsid, env=new_env)
-    else:
-        proc = Popen(args, stdout=PIPE, stderr=PIPE, stdin=PIPE,
-                     preexec_fn=os.setsid)
+    proc = Popen(args, stdout=PIPE, stderr=PIPE, stdin=PIPE,
+                 preexec_fn=os.setsid, env=_command_env(env))
     timeout = {'value': False}
     timer = Timer(max_time, kill_proc, [proc, timeout])
     timer.start()
@@ -46,6 +43,185 @@ def shell_cmd(args, max_time=5, env=None):
     return proc.returncode, stdout.decode("utf-8"), stderr.decode("utf-8")
 
 
+def _command_env(env):
+    # Returns the environment for a command given extra variables, or None
+    # for the current environment.
+    if not env:
+        return None
+    new_env = os.environ.copy()
+    for key, value in env.items():
+        new_env[key] = value
+    return new_env
+
+
+# Running many commands.
+# .............................................................................
+# shell_cmds() runs a batch of commands, such as one command per file, with
+# at most 'max_workers' of them running at the same time.  It yields their
+# results as they finish, so a caller can start using them while the rest
+# are running.  All the running commands are supervised by one loop in the
+# calling thread, which reads their output (with selectors) and enforces
+# their time limits (with a heap of deadlines), so no thread or timer is
+# created per command.  Example of use:
+#
+#    commands = (['cloc', '--json', path] for path in paths)
+#    for result in shell_cmds(commands, max_workers=8, max_time=60):
+#        print(paths[result.index], result.returncode, result.wall_time)
+
+_READ_SIZE = 65536
+
+_DEFAULT_MAX_OUTPUT = 1024*1024
+'''Default number of bytes of stdout and stderr (each) kept per command.'''
+
+_REAP_INTERVAL = 0.05
+'''Seconds between checks for commands that closed their output but have
+not exited yet.'''
+
+class ShellResult():
+    '''The result of one command run by shell_cmds().  It does not report the
+    memory used by the command: the peak RSS that the system records for a
+    child process includes the memory of the Python process it was started
+    from, before it executed the command, so it would be wrong by as much
+    as the caller's own size.'''
+
+    def __init__(self, index, args):
+        self.index      = index    # position of the command in the batch
+        self.args       = args
+        self.returncode = None     # negative signal number if killed
+        self.stdout     = ''
+        self.stderr     = ''
+        self.timed_out  = False
+        self.truncated  = False    # True if output exceeded 'max_output'
+        self.wall_time  = 0.0      # seconds
+
+
+    def __repr__(self):
+        return 'ShellResult({}, {!r}, returncode={})'.format(
+            self.index, self.args, self.returncode)
+
+
+class _Running():
+    def __init__(self, result, proc, deadline):
+        self.result   = result
+        self.proc     = proc
+        self.deadline = deadline
+        self.start    = time.monotonic()
+        self.output   = {proc.stdout.fileno(): bytearray(),
+                         proc.stderr.fileno(): bytearray()}
+        self.open     = 2
+
+
+def shell_cmds(commands, max_workers=None, max_time=5, env=None,
+               max_output=_DEFAULT_MAX_OUTPUT):
+    '''Runs each of the commands in the iterable 'commands' (lists of
+    arguments, as for shell_cmd()) and yields a ShellResult for each one as
+    it finishes, in order of completion.  At most 'max_workers' commands
+    (default: number of CPUs) run at once, and commands are taken from
+    'commands' only as they are needed.  Commands running longer than
+    'max_time' seconds are killed, along with the processes they started.
+    Only the first 'max_output' bytes of the stdout and of the stderr of a
+    command are kept; the rest is read and discarded.  'env' is as for
+    shell_cmd().  If the caller stops iterating, the commands still running
+    are killed.  Errors starting a command (e.g., OSError if the program
+    does not exist) are raised.
+    '''
+    max_workers = max_workers or os.cpu_count() or 1
+    new_env = _command_env(env)
+    commands = enumerate(commands)
+    selector = selectors.DefaultSelector()
+    running = {}                        # pid -> _Running
+    deadlines = []                      # heap of (deadline, index, _Running)
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(running) < max_workers:
+                item = next(commands, None)
+                if item is None:
+                    exhausted = True
+                    break
+                (index, args) = item
+                proc = Popen(args, stdout=PIPE, stderr=PIPE, stdin=DEVNULL,
+                             start_new_session=True, env=new_env)
+                job = _Running(ShellResult(index, args), proc,
+                               time.monotonic() + max_time)
+                running[proc.pid] = job
+                heapq.heappush(deadlines, (job.deadline, index, job))
+                for pipe in (proc.stdout, proc.stderr):
+                    os.set_blocking(pipe.fileno(), False)
+                    selector.register(pipe, selectors.EVENT_READ, job)
+            if not running:
+                return
+
+            # Entries for jobs that have finished are dropped on the way.  A
+            # job is identified by its object rather than its pid, since pids
+            # of finished jobs can be reused by new ones.
+            now = time.monotonic()
+            while deadlines:
+                (deadline, index, job) = deadlines[0]
+                current = running.get(job.proc.pid) is job
+                if current and deadline > now:
+                    break
+                heapq.heappop(deadlines)
+                if current:
+                    job.result.timed_out = True
+                    _kill_group(job.proc.pid)
+            wait = max(0, deadlines[0][0] - now) if deadlines else None
+            if any(job.open == 0 for job in running.values()):
+                wait = _REAP_INTERVAL if wait is None else min(wait, _REAP_INTERVAL)
+
+            for (key, events) in selector.select(wait):
+                job = key.data
+                data = os.read(key.fd, _READ_SIZE)
+                if data:
+                    output = job.output[key.fd]
+                    room = max_output - len(output)
+                    if len(data) > room:
+                        job.result.truncated = True
+                    output += data[:room]
+                else:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    job.open -= 1
+
+            for job in [job for job in running.values() if job.open == 0]:
+                result = _reap(job, os.WNOHANG)
+                if result:
+                    del running[job.proc.pid]
+                    yield result
+    finally:
+        for job in running.values():
+            _kill_group(job.proc.pid)
+            for pipe in (job.proc.stdout, job.proc.stderr):
+                if not pipe.closed:
+                    selector.unregister(pipe)
+                    pipe.close()
+            _reap(job, 0)
+        selector.close()
+
+
+def _reap(job, options):
+    # Collects the exit status of a finished command, or returns None if it
+    # has not exited and 'options' is os.WNOHANG.
+    (pid, status) = os.waitpid(job.proc.pid, options)
+    if pid == 0:
+        return None
+    result = job.result
+    result.wall_time  = time.monotonic() - job.start
+    result.returncode = job.proc.returncode = os.waitstatus_to_exitcode(status)
+    (stdout, stderr)  = job.output.values()
+    result.stdout     = stdout.decode('utf-8', 'replace')
+    result.stderr     = stderr.decode('utf-8', 'replace')
+    return result
+
+
+def _kill_group(pid):
+    # Commands run in their own session, so this also kills their children.
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
 def run(cmd, file):
     '''Run a command on the given file, using a temporary file to catch the
     output. Reads the converted file and returns the text.  Throws an
@@ -0,0 +1,313 @@
+# -*- python-indent-offset: 4 -*-
+'''
+text_index: local full-text index of the description and readme fields.
+
+The MongoDB text index on 'description' and 'readme' (see the documentation
+of casicsdb) is slow for phrase queries, and every query loads the server.
+TextIndex is a positional inverted index of the same fields, held in memory
+and searched locally.  Queries are strings in the usual search-engine syntax:
+
+    sbml java              both words (implicit "and")
+    sbml OR cellml java    "sbml" or "cellml", and "java"
+    "systems biology"      the exact phrase
+    sbml -matlab           "sbml" but not "matlab"; -"a phrase" works too
+
+Results are ranked with the Okapi BM25 formula, with the description and
+readme treated as one text (the description first).  Words are lowercased;
+there is no stemming and there are no stop words, so that any phrase can be
+found.  Chinese, Japanese and Korean text has no spaces between words, so
+runs of characters of those scripts are indexed as overlapping pairs of
+characters ("bigrams"), which is the usual approach for those languages;
+query words in those scripts are turned into phrases of bigrams, so they
+match anywhere in a word.  The 'text_languages' of each entry are also kept,
+so that searches can be restricted to texts in certain languages.
+
+Readme values that are not text (None, -1 and -2; see casicsdb.repo_entry())
+are skipped, and so are descriptions that are None.  The index can be
+updated incrementally with update() and remove(), for example from the
+entries returned by snapshot.DeltaSync.changes().  Example of use:
+
+    index = text_index_from_db(db.repos)
+    index.save('text.idx')
+    ...
+    index = TextIndex.load('text.idx')
+    for (id, score) in index.search('"systems biology" sbml', limit=20):
+        print(id, score)
+'''
+__version__ = '1.0.0'
+__author__  = 'Michael Hucka <mhucka@caltech.edu>'
+__email__   = 'mhucka@caltech.edu'
+__license__ = 'GPLv3'
+
+from   array import array
+import gzip
+import heapq
+import math
+import pickle
+import re
+
+from   .casicsdb import iter_repos
+
+
+# Global constants.
+# .............................................................................
+
+_TEXT_FIELDS = ['description', 'readme', 'text_languages']
+'''Fields fetched from the database to build an index.'''
+
+_FIELD_GAP = 100
+'''Gap left between the positions of the words of the description and those
+of the readme, so that phrases do not match across the two.'''
+
+_BM25_K1 = 1.2
+_BM25_B  = 0.75
+
+_CJK_CHARS = ('\u1100-\u11ff\u2e80-\u2fdf\u3040-\u30ff\u3100-\u312f'
+              '\u3130-\u318f\u31a0-\u31bf\u31f0-\u31ff\u3400-\u4dbf'
+              '\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff')
+'''Unicode ranges of Chinese, Japanese and Korean characters.'''
+
+_WORD_REGEX = re.compile('[{0}]+|[^\\W{0}]+'.format(_CJK_CHARS))
+_CJK_REGEX  = re.compile('[{}]'.format(_CJK_CHARS))
+_QUERY_REGEX = re.compile(r'(-?)(?:"([^"]*)"|(\S+))')
+
+
+# Tokenization.
+# .............................................................................
+
+def tokenize(text):
+    '''Returns the list of index terms in 'text', in order.'''
+    tokens = []
+    for word in _WORD_REGEX.findall(text.lower()):
+        if len(word) > 1 and _CJK_REGEX.match(word):
+            tokens += [word[i:i+2] for i in range(len(word) - 1)]
+        else:
+            tokens.append(word)
+    return tokens
+
+
+def entry_text(entry):
+    '''Returns the list of index terms for the description and readme of
+    'entry', and the list of their positions.'''
+    tokens = []
+    positions = []
+    start = 0
+    for field in ('description', 'readme'):
+        value = entry.get(field)
+        if not isinstance(value, str) or not value:
+            continue
+        words = tokenize(value)
+        tokens += words
+        positions += range(start, start + len(words))
+        start += len(words) + _FIELD_GAP
+    return (tokens, positions)
+
+
+# Main class.
+# .............................................................................
+
+class TextIndex():
+    def __init__(self):
+        '''Creates an empty index.  Use add() or update() to fill it, or
+        build it with text_index_from_db(), or use TextIndex.load().'''
+        self.postings   = {}   # term -> {id: array of positions}
+        self.lengths    = {}   # id -> number of terms
+        self.languages  = {}   # id -> tuple of text_languages
+        self.terms      = {}   # id -> tuple of distinct terms, for remove()
+        self.total_length = 0
+
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+    def __contains__(self, id):
+        return id in self.lengths
+
+
+    def add(self, entry):
+        '''Adds 'entry' to the index, replacing any previous version of it.
+        Entries with neither a description nor a readme are not indexed.'''
+        id = entry['_id']
+        if id in self.lengths:
+            self.remove(id)
+        (tokens, positions) = entry_text(entry)
+        if not tokens:
+            return
+        doc_postings = {}
+        for (token, position) in zip(tokens, positions):
+            if token in doc_postings:
+                doc_postings[token].append(position)
+            else:
+                doc_postings[token] = array('I', [position])
+        for (token, found) in doc_postings.items():
+            if token in self.postings:
+                self.postings[token][id] = found
+            else:
+                self.postings[token] = {id: found}
+        self.lengths[id] = len(tokens)
+        self.terms[id] = tuple(doc_postings)
+        self.total_length += len(tokens)
+        languages = entry.get('text_languages')
+        if isinstance(languages, list) and languages:
+            self.languages[id] = tuple(languages)
+
+
+    def update(self, entries):
+        '''Adds or replaces each of the given entries.'''
+        for entry in entries:
+            self.add(entry)
+
+
+    def remove(self, id):
+        '''Removes the entry with the given id, if it is in the index.'''
+        if id not in self.lengths:
+            return
+        for token in self.terms.pop(id):
+            found = self.postings[token]
+            del found[id]
+            if not found:
+                del self.postings[token]
+        self.total_length -= self.lengths.pop(id)
+        self.languages.pop(id, None)
+
+
+    def search(self, query, limit=None, languages=None):
+        '''Returns a list of (id, score) tuples for the entries matching
+        'query' (see the module documentation for the syntax), best first.
+        If 'languages' is given, only entries whose text_languages include
+        one of those ISO 639-1 codes are returned.'''
+        (groups, excluded) = parse_query(query)
+        if not groups:
+            return []
+        matches = None
+        for group in sorted(groups, key=self._estimate):
+            ids = set()
+            for phrase in group:
+                ids |= self._phrase_ids(phrase)
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                return []
+        for phrase in excluded:
+            matches -= self._phrase_ids(phrase)
+        if languages is not None:
+            wanted = set(languages)
+            matches = {id for id in matches
+                       if wanted.intersection(self.languages.get(id, ()))}
+        tokens = {token for group in groups for phrase in group
+                  for token in phrase}
+        scores = self._scores(matches, tokens)
+        if limit is None:
+            return sorted(scores.items(), key=lambda item: -item[1])
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+
+    def count(self, query, languages=None):
+        '''Returns the number of entries matching 'query'.'''
+        return len(self.search(query, languages=languages))
+
+
+    def save(self, path):
+        '''Writes the index to a compressed file at 'path'.'''
+        with gzip.open(path, 'wb', compresslevel=1) as f:
+            pickle.dump(self.__dict__, f, pickle.HIGHEST_PROTOCOL)
+
+
+    @classmethod
+    def load(cls, path):
+        '''Reads an index written by save().'''
+        index = cls()
+        with gzip.open(path, 'rb') as f:
+            index.__dict__.update(pickle.load(f))
+        return index
+
+
+    def _estimate(self, group):
+        # Rough size of the result of a group, for ordering intersections.
+        return sum(min(len(self.postings.get(token, ())) for token in phrase)
+                   for phrase in group)
+
+
+    def _phrase_ids(self, phrase):
+        # Returns the set of ids containing the tokens of 'phrase' in order.
+        lists = [self.postings.get(token) for token in phrase]
+        if any(found is None for found in lists):
+            return set()
+        smallest = min(lists, key=len)
+        ids = set(smallest)
+        for found in lists:
+            if found is not smallest:
+                ids.intersection_update(found)
+        if len(phrase) == 1:
+            return ids
+        matched = set()
+        for id in ids:
+            starts = set(lists[0][id])
+            for (offset, found) in enumerate(lists[1:], 1):
+                starts.intersection_update(p - offset for p in found[id])
+                if not starts:
+                    break
+            if starts:
+                matched.add(id)
+        return matched
+
+
+    def _scores(self, ids, tokens):
+        num_docs = len(self.lengths)
+        average = self.total_length/num_docs if num_docs else 1
+        scores = dict.fromkeys(ids, 0.0)
+        for token in tokens:
+            found = self.postings.get(token)
+            if not found:
+                continue
+            idf = math.log(1 + (num_docs - len(found) + 0.5)/(len(found) + 0.5))
+            for id in ids:
+                positions = found.get(id)
+                if positions:
+                    tf = len(positions)
+                    norm = 1 - _BM25_B + _BM25_B*self.lengths[id]/average
+                    scores[id] += idf*tf*(_BM25_K1 + 1)/(tf + _BM25_K1*norm)
+        return scores
+
+
+# Queries.
+# .............................................................................
+
+def parse_query(query):
+    '''Parses a query string into a list of groups that must all match, each
+    being a list of alternative phrases (tuples of terms), and a list of
+    phrases that must not match.'''
+    groups = []
+    excluded = []
+    join_next = False
+    for (negated, quoted, word) in _QUERY_REGEX.findall(query):
+        if word == 'OR' and not negated:
+            join_next = bool(groups)
+            continue
+        phrase = tuple(tokenize(quoted if quoted else word))
+        if not phrase:
+            continue
+        if negated:
+            excluded.append(phrase)
+        elif join_next:
+            groups[-1].append(phrase)
+        else:
+            groups.append([phrase])
+        join_next = False
+    return (groups, excluded)
+
+
+# Building indexes.
+# .............................................................................
+
+def build_text_index(entries):
+    '''Builds a TextIndex from an iterable of entries, which need only have
+    the '_id' field and the fields in _TEXT_FIELDS.'''
+    index = TextIndex()
+    index.update(entries)
+    return index
+
+
+def text_index_from_db(collection, query=None):
+    '''Builds a TextIndex from the entries in 'collection' matching 'query'.'''
+    return build_text_index(iter_repos(collection, query, fields=_TEXT_FIELDS))
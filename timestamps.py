@@ -7,6 +7,7 @@ __author__  = 'Michael Hucka <mhucka@caltech.edu>'
 __email__   = 'mhucka@caltech.edu'
 __license__ = 'GPLv3'
 
+import re
 from datetime import datetime
 from dateutil import parser
 from time     import time, mktime
@@ -42,6 +43,29 @@ def canonicalize_timestamp(value):
 
         return value
 
+
+_ISO_UTC = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)'
+                      r'(?:\.\d+)?(?:Z|[+-]00:?00)?$')
+
+def canonicalize_timestamps(values):
+    '''Returns a list of the results of canonicalize_timestamp() for each of
+    the given values.  Strings in the ISO 8601 format used by GitHub (in
+    UTC) are converted without going through the general-purpose dateutil
+    parser, which is the bulk of the cost of converting one value at a time;
+    the results are the same.  Anything else is passed to
+    canonicalize_timestamp().'''
+    results = []
+    for value in values:
+        match = _ISO_UTC.match(value) if isinstance(value, str) else None
+        if match:
+            (year, month, day, hour, minute, second) = map(int, match.groups())
+            results.append(mktime((year, month, day, hour, minute, second,
+                                   0, 0, 0)))
+        else:
+            results.append(canonicalize_timestamp(value))
+    return results
+
+
 def now_timestamp():
     '''Returns a UTC-aware POSIX date/time stamp for "now", as a float.'''
     return mktime(datetime.now().utctimetuple())